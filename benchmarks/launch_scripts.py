@@ -0,0 +1,53 @@
+"""
+Benchmark of the launch script assembly for a large sweep, where every job gets its own instance.
+
+    python benchmarks/launch_scripts.py --jobs 10000
+
+Builds one Simple runner per job, and the launch script of its instance with make_launch_script, the way
+the EC2 and GCE launchers do. Reports scripts per second, and the peak memory of keeping all of them.
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+from jaynes.jaynes import RUN
+from jaynes.launchers.base_launcher import make_launch_script
+from jaynes.mounts import S3Code, S3Output
+from jaynes.runners import Simple
+
+
+def train(seed, lr=0.1):
+    return seed, lr
+
+
+def main(jobs):
+    with tempfile.TemporaryDirectory() as local_path:
+        RUN.config_root = local_path
+        with open(os.path.join(local_path, "train.py"), "w") as f:
+            f.write("print('hello')\n")
+        mounts = [S3Code(prefix="s3://bucket/jaynes", local_path=local_path, host_path="/tmp/code", pypath=True),
+                  S3Output(prefix="s3://bucket/outputs", container_path="/outputs", host_path="/tmp/outputs")]
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        scripts = []
+        for seed in range(jobs):
+            runner = Simple(mounts=mounts, work_dir="/tmp/code", pypath="/tmp/code", startup="source ~/.bashrc")
+            runner.build(train, seed, lr=0.3)
+            scripts.append(make_launch_script(runners=[runner], mounts=mounts, unpack_on_host=True, type="ec2",
+                                              launch_dir="/tmp/jaynes-launch", terminate_after=True,
+                                              instance_name=f"sweep-{seed}"))
+        seconds = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    print(f"{jobs} launch scripts in {seconds:.2f}s, {jobs / seconds:.0f} scripts/s, "
+          f"{len(scripts[-1])} bytes each, peak memory {peak / 2 ** 20:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=10000)
+    main(parser.parse_args().jobs)
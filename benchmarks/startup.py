@@ -0,0 +1,48 @@
+"""
+Start-up benchmark for :code:`import jaynes` and :code:`python -m jaynes.entry`, over the bare interpreter.
+
+    python benchmarks/startup.py --runs 20 --max-import-ms 30 --max-entry-ms 100
+
+Exits with 1 when the median start-up regresses past the thresholds. The entry runs a payload that calls
+:code:`print`, so that it measures jaynes alone.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def median_ms(cmd, runs, env=None):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - started)
+    return 1000 * statistics.median(times)
+
+
+def main(runs, max_import_ms, max_entry_ms):
+    from jaynes.constants import JAYNES_PARAMS_KEY
+    from jaynes.param_codec import serialize
+
+    env = dict(os.environ, PYTHONPATH=ROOT, **{JAYNES_PARAMS_KEY: serialize(print, ("hello",))})
+    bare = median_ms([sys.executable, "-c", "pass"], runs, env)
+    import_ms = median_ms([sys.executable, "-c", "import jaynes"], runs, env) - bare
+    entry_ms = median_ms([sys.executable, "-m", "jaynes.entry"], runs, env) - bare
+
+    print(f"python: {bare:.1f} ms, import jaynes: +{import_ms:.1f} ms (max {max_import_ms}), "
+          f"python -m jaynes.entry: +{entry_ms:.1f} ms (max {max_entry_ms})")
+    return import_ms <= max_import_ms and entry_ms <= max_entry_ms
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--max-import-ms", type=float, default=30)
+    parser.add_argument("--max-entry-ms", type=float, default=100)
+    args = parser.parse_args()
+    sys.exit(0 if main(args.runs, args.max_import_ms, args.max_entry_ms) else 1)
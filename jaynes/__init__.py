@@ -1,3 +1,34 @@
-from . import mounts, runners
-from .jaynes import Jaynes, config, add, chain, execute, run, listen, RUN
-from .helpers import tag_instance
+"""
+The attributes of the package are imported on first access, so that :code:`import jaynes`, and
+:code:`python -m jaynes.entry` on the workers, do not pay for yaml, the launchers and the cloud SDKs.
+"""
+import importlib
+
+_SUBMODULES = {"mounts", "runners", "launchers"}
+# name -> "module" or "module:attribute.path". jaynes.map is Jaynes.map, so that jaynes.jaynes does not shadow
+# the builtin map.
+_ATTRIBUTES = {
+    **{name: "jaynes.jaynes" for name in ["Jaynes", "config", "add", "chain", "execute", "run", "listen", "RUN"]},
+    "map": "jaynes.jaynes:Jaynes.map",
+    "tag_instance": "jaynes.helpers",
+}
+
+__all__ = sorted(_SUBMODULES | set(_ATTRIBUTES))
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f"jaynes.{name}")
+    if name in _ATTRIBUTES:
+        module, _, path = _ATTRIBUTES[name].partition(":")
+        value = importlib.import_module(module)
+        for part in (path or name).split("."):
+            value = getattr(value, part)
+        # cache it, so that __getattr__ is only called once per name.
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module 'jaynes' has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,19 +1,58 @@
+import asyncio
 import requests
 import json
+import os
 from urllib.parse import urlencode, quote
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .manifest import file_sha256
+
+
+def make_session(pool_size=10, retries=3, backoff_factor=0.3):
+    """
+    A keep-alive session with a connection pool.
+
+    Connection errors are retried for all methods because the request has not been sent yet. Bad
+    gateway responses are only retried for GET, because exec calls and uploads are not idempotent.
+    """
+    retry = Retry(total=retries, read=0, backoff_factor=backoff_factor,
+                  status_forcelist=(502, 503, 504), allowed_methods=frozenset({"GET", "HEAD"}))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 
 class JaynesClient:
+    # one pooled session per server, shared by all clients so that short-lived
+    # clients (one per mount upload, one per launch) reuse the open connections.
+    _sessions = {}
+
     def __init__(self, server="http://localhost:8092", token=None):
         self.server = server
+        if server not in self._sessions:
+            self._sessions[server] = make_session()
+        self.session = self._sessions[server]
+
+    def get(self, path, **kwargs):
+        if kwargs:
+            path += "?" + urlencode(kwargs)
+        r = self.session.get(self.server + path)
+        try:
+            return r.json()
+        except ValueError:
+            return r
 
     def post(self, path, data, **kwargs):
         if kwargs:
             path += "?" + urlencode(kwargs)
-        r = requests.post(self.server + path, data=data)
+        r = self.session.post(self.server + path, data=data)
         try:
             return r.json()
-        except:
+        except ValueError:
             return r
 
     def post_json(self, path, data, **kwargs):
@@ -23,38 +62,78 @@ class JaynesClient:
     def put(self, path, data, **kwargs):
         if kwargs:
             path += "?" + urlencode(kwargs)
-        r = requests.put(self.server + path, data=data)
+        r = self.session.put(self.server + path, data=data)
         if r.status_code > 200:
             print(r.text)
         try:
             return r.json()
-        except:
+        except ValueError:
             return r
 
     def gzip_local(self, dir, target):
         pass
 
-    def upload_file(self, file, remote_path=None):
-        """used to upload files that have been changed"""
+    def exists(self, remote_path):
+        return self.get("/uploads/" + quote(remote_path))['exists']
+
+    def upload_file(self, file, remote_path=None, resume=False):
+        """
+        streams the file to the server, which checks the sha256 digest on completion.
+
+        :param resume: continue an interrupted upload from the offset the server already has.
+        """
         if remote_path is None:
             remote_path = file
+        offset = 0
+        if resume:
+            offset = self.get("/uploads/" + quote(remote_path))['offset']
+        sha256 = file_sha256(file)
         with open(file, 'rb') as f:
-            text = f.read()
-        r = self.put("/files/" + quote(remote_path), data=text)
+            f.seek(offset)
+            r = self.put("/files/" + quote(remote_path), data=f, offset=offset, sha256=sha256,
+                         size=os.path.getsize(file))
         return r
 
+    def upload_stream(self, chunks, remote_path):
+        """
+        streams an iterable of bytes with chunked encoding, e.g. a tar ball while it is being packed. The
+        size is not known upfront, so neither resume nor the digest check apply.
+        """
+        return self.put("/files/" + quote(remote_path), data=chunks)
+
     def update_file(self, file, remote_path=None, overwrite=True):
         """used to upload files that have been changed"""
         if remote_path is None:
             remote_path = file
         with open(file, 'rb') as f:
-            text = f.read()
-        r = self.post("/files/" + quote(remote_path), data=text, overwrite=overwrite)
+            r = self.post("/files/" + quote(remote_path), data=f, overwrite=overwrite)
         return r
 
     def unzip_remote(self, dir):
         pass
 
+    def enqueue(self, queue, *thunks):
+        """:return: the task ids of the thunks, in order."""
+        return self.post_json("/queue/" + quote(queue), dict(thunks=thunks))['ids']
+
+    def dequeue(self, queue, timeout=30, lease=None):
+        """
+        long-polls for the next thunk. :return: (task_id, thunk), or None after the timeout.
+
+        :param lease: seconds to post the result in, before the task goes back into the queue. Default to the
+                      lease of the server.
+        """
+        r = self.get("/queue/" + quote(queue), timeout=timeout, **({"lease": lease} if lease else {}))
+        return (r['id'], r['thunk']) if r['id'] else None
+
+    def post_result(self, task_id, result):
+        return self.post_json("/results/" + quote(task_id), result)
+
+    def get_result(self, task_id, timeout=0):
+        """long-polls for the result of a task. :return: the result, or None if it is not done yet."""
+        r = self.get("/results/" + quote(task_id), timeout=timeout)
+        return r['result'] if r['done'] else None
+
     def execute(self, cmd, timeout=None):
         return self.post_json("/exec", dict(cmd=cmd, timeout=timeout))
 
@@ -62,6 +141,99 @@ class JaynesClient:
         return self.post_json("/exec", dict(cmds=cmds, timeout=None))
 
 
+class AsyncJaynesClient:
+    """
+    asyncio version of the JaynesClient, for fanning out uploads and exec calls to many
+    servers at once. Requires :code:`aiohttp`.
+
+    .. code:: python
+
+        clients = [AsyncJaynesClient(host) for host in hosts]
+        results = await broadcast(clients, "execute", "nvidia-smi")
+
+    :param server: the url of the Jaynes server.
+    :param pool_size: the maximum number of open connections to this server.
+    """
+
+    def __init__(self, server="http://localhost:8092", token=None, pool_size=10):
+        self.server = server
+        self.pool_size = pool_size
+        self._session = None
+
+    @property
+    def session(self):
+        # aiohttp needs a running event loop to create the session.
+        if self._session is None or self._session.closed:
+            import aiohttp
+
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def request(self, method, path, data=None, **kwargs):
+        if kwargs:
+            path += "?" + urlencode(kwargs)
+        async with self.session.request(method, self.server + path, data=data) as r:
+            if r.status > 200:
+                print(await r.text())
+            try:
+                return await r.json(content_type=None)
+            except ValueError:
+                return r
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, data, **kwargs):
+        return await self.request("POST", path, data=data, **kwargs)
+
+    async def post_json(self, path, data, **kwargs):
+        return await self.post(path, data=json.dumps(data), **kwargs)
+
+    async def put(self, path, data, **kwargs):
+        return await self.request("PUT", path, data=data, **kwargs)
+
+    async def upload_file(self, file, remote_path=None, resume=False):
+        """streams the file to the server. See :code:`JaynesClient.upload_file`."""
+        if remote_path is None:
+            remote_path = file
+        offset = 0
+        if resume:
+            offset = (await self.get("/uploads/" + quote(remote_path)))['offset']
+        sha256 = await asyncio.get_running_loop().run_in_executor(None, file_sha256, file)
+        with open(file, 'rb') as f:
+            f.seek(offset)
+            return await self.put("/files/" + quote(remote_path), data=f, offset=offset, sha256=sha256,
+                                  size=os.path.getsize(file))
+
+    async def update_file(self, file, remote_path=None, overwrite=True):
+        if remote_path is None:
+            remote_path = file
+        with open(file, 'rb') as f:
+            return await self.post("/files/" + quote(remote_path), data=f, overwrite=overwrite)
+
+    async def execute(self, cmd, timeout=None):
+        return await self.post_json("/exec", dict(cmd=cmd, timeout=timeout))
+
+    async def map(self, *cmds):
+        return await self.post_json("/exec", dict(cmds=cmds, timeout=None))
+
+
+async def broadcast(clients, method, *args, **kwargs):
+    """calls the same method on all clients concurrently. Failures are returned in place of the results."""
+    return await asyncio.gather(*[getattr(c, method)(*args, **kwargs) for c in clients], return_exceptions=True)
+
+
 if __name__ == '__main__':
     from .server import run
     # test this
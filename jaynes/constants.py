@@ -1 +1,5 @@
 JAYNES_PARAMS_KEY = "JAYNES_PARAMS_KEY"
+# names the environment variable that holds the index into a comma separated payload table, e.g. SLURM_ARRAY_TASK_ID
+JAYNES_INDEX_VAR_KEY = "JAYNES_INDEX_VAR"
+# the number of processes that run a payload table in one jaynes.entry, forked after the shared imports.
+JAYNES_WORKERS_KEY = "JAYNES_WORKERS"
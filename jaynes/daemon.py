@@ -1,25 +1,136 @@
-from .client import JaynesClient
+import asyncio
+import os
+import shlex
+import time
+
+from .client import AsyncJaynesClient
+from .manifest import DEFAULT_EXCLUDES, diff, scan
 
 
 class JaynesDaemon:
-    def __init__(self, server_configs=tuple()):
+    """
+    Watches a local folder, and pushes the files that changed to a list of servers.
+
+    The daemon keeps a manifest of :code:`(path, mtime, size, sha256)` for :code:`local_path`. On
+    every change it waits until the tree has been quiet for :code:`debounce` seconds, so that a burst
+    of edits (a branch checkout, a formatter run) goes out as one batch. Then it uploads only the
+    changed files to every server at once, and removes the deleted ones.
+
+    :param server_configs: the urls of the Jaynes servers.
+    :param local_path: the local directory to watch.
+    :param remote_path: the directory on the servers to sync to, e.g. the :code:`host_path` of the mount.
+        Default to :code:`$JYNMNT/<name of local_path>`, interpolated by the server.
+    :param excludes: tar-style exclude patterns.
+    :param interval: seconds between two scans.
+    :param debounce: seconds the tree has to stay unchanged before a batch is pushed.
+    :param max_concurrency: the maximum number of concurrent uploads per server.
+    """
+
+    def __init__(self, server_configs=tuple(), local_path=".", remote_path=None, excludes=DEFAULT_EXCLUDES,
+                 interval=1, debounce=0.5, max_concurrency=8):
         """watch local folder and upload to a list of servers"""
         self.server_configs = server_configs
-        self.sleep = 3
-        self.clients = [JaynesClient(c) for c in server_configs]
+        self.local_path = os.path.abspath(local_path)
+        self.remote_path = remote_path or f"$JYNMNT/{os.path.basename(self.local_path)}"
+        self.excludes = excludes
+        self.sleep = interval
+        self.debounce = debounce
+        self.max_concurrency = max_concurrency
+        self.clients = [AsyncJaynesClient(c) for c in server_configs]
+        self.manifest = None
 
-    def run(self):
-        print('Jaynes daemon just started!')
-        print('watching local folder...')
-        print('gziping...')
+    def scan(self, previous=None):
+        return scan(self.local_path, self.excludes, previous=previous)
+
+    async def push_one(self, client, changed, deleted):
+        """:return: seconds it took to sync this server."""
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def update(rel_path):
+            async with semaphore:
+                r = await client.update_file(os.path.join(self.local_path, rel_path), f"{self.remote_path}/{rel_path}")
+            assert isinstance(r, dict) and r.get("status"), f"failed to update {rel_path}: {r}"
+
+        await asyncio.gather(*[update(p) for p in changed])
+        if deleted:
+            # only quote the relative paths, so that the server still expands variables in the remote path.
+            await client.execute("rm -f " + " ".join(f"{self.remote_path}/{shlex.quote(p)}" for p in deleted))
+        return time.perf_counter() - started
+
+    async def push(self, changed, deleted):
+        """pushes the delta to all servers concurrently, and reports the sync latency of each."""
+        results = await asyncio.gather(*[self.push_one(c, changed, deleted) for c in self.clients],
+                                       return_exceptions=True)
+        for client, result in zip(self.clients, results):
+            if isinstance(result, BaseException):
+                print(f"  {client.server}: sync failed, {result!r}")
+            else:
+                print(f"  {client.server}: synced in {result * 1000:.0f} ms")
+        return results
+
+    async def wait_until_quiet(self, manifest):
+        """keeps rescanning until nothing changes for a full debounce window."""
+        loop = asyncio.get_running_loop()
         while True:
-            import time
-            time.sleep(self.sleep)
-            # add logic to upload files
-            print('change detected, now upload...')
-            print('upload complete...')
+            await asyncio.sleep(self.debounce)
+            newer = await loop.run_in_executor(None, self.scan, manifest)
+            if newer == manifest:
+                return manifest
+            manifest = newer
+
+    async def sync_once(self):
+        """:return: (changed, deleted) since the last sync."""
+        loop = asyncio.get_running_loop()
+        manifest = await loop.run_in_executor(None, self.scan, self.manifest)
+        changed, deleted = diff(self.manifest, manifest)
+        if not changed and not deleted:
+            return changed, deleted
+
+        manifest = await self.wait_until_quiet(manifest)
+        changed, deleted = diff(self.manifest, manifest)
+        if changed or deleted:
+            size = sum(manifest[p].size for p in changed)
+            print(f"change detected: {len(changed)} changed ({size / 1024:.1f} KB), {len(deleted)} deleted, now upload...")
+            results = await self.push(changed, deleted)
+            if any(isinstance(r, BaseException) for r in results):
+                # keep the old manifest, so that the same delta is pushed again on the next tick.
+                return changed, deleted
+        self.manifest = manifest
+        return changed, deleted
+
+    async def watch(self, initial_sync=False):
+        loop = asyncio.get_running_loop()
+        self.manifest = {} if initial_sync else await loop.run_in_executor(None, self.scan)
+        print(f"watching {self.local_path}, {len(self.manifest)} files")
+        try:
+            while True:
+                await self.sync_once()
+                await asyncio.sleep(self.sleep)
+        finally:
+            for client in self.clients:
+                await client.close()
+
+    def run(self, initial_sync=False):
+        """
+        :param initial_sync: push every file on start. By default, the servers are assumed to be up
+            to date, e.g. from the tar ball uploaded by the mount.
+        """
+        print('Jaynes daemon just started!')
+        asyncio.run(self.watch(initial_sync=initial_sync))
 
 
 if __name__ == '__main__':
-    daemon = JaynesDaemon()
-    daemon.run()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Sync a local folder to Jaynes servers.')
+    parser.add_argument('servers', nargs='*', default=["http://localhost:8092"], help='urls of the servers')
+    parser.add_argument('--local-path', dest='local_path', type=str, default=".")
+    parser.add_argument('--remote-path', dest='remote_path', type=str, default=None)
+    parser.add_argument('--debounce', dest='debounce', type=float, default=0.5)
+    parser.add_argument('--initial-sync', dest='initial_sync', action='store_true')
+
+    args = parser.parse_args()
+    daemon = JaynesDaemon(args.servers, local_path=args.local_path, remote_path=args.remote_path,
+                          debounce=args.debounce)
+    daemon.run(initial_sync=args.initial_sync)
@@ -1,11 +1,149 @@
 import os
+import sys
+import time
+import traceback
 
+# the workers start up with param_codec alone. The rest of jaynes is imported when a thunk needs it.
 from .param_codec import deserialize
-from .constants import JAYNES_PARAMS_KEY
+from .constants import JAYNES_INDEX_VAR_KEY, JAYNES_PARAMS_KEY, JAYNES_WORKERS_KEY
 
-if __name__ == "__main__":
+# the thunks of a batch, deserialized before the workers are forked so that they share the imports.
+THUNKS = []
+
+
+def decode(thunk_string):
+    # the payload lives in a thunk store, the environment variable only holds the reference, see stores.is_ref.
+    # The row of an indexed kubernetes job can be a reference itself.
+    while "://" in thunk_string:
+        from .stores import fetch
+
+        thunk_string = fetch(thunk_string).decode("ascii")
+    return deserialize(thunk_string, with_result=True)
+
+
+def run_thunk(index):
+    """
+    Catches the errors, so that one thunk does not stop the batch. Posts the return value, or the error and
+    its traceback, to the result channel of the thunk if it has one.
+
+    :return: (index, error, seconds).
+    """
+    fn, args, kwargs, channel = THUNKS[index]
+    started = time.perf_counter()
+    value = tb = None
+    try:
+        value = fn(*args, **kwargs)
+        if channel:
+            from .results import encode_value
+
+            # in the worker, so that a return value that does not pickle fails this thunk alone.
+            value = encode_value(value)
+        error = None
+    except BaseException as e:
+        tb = traceback.format_exc()
+        print(tb, file=sys.stderr, flush=True)
+        error, value = repr(e), None
+    seconds = time.perf_counter() - started
+    if channel:
+        from .results import post
+
+        try:
+            post(channel, dict(value=value, error=error, traceback=tb, seconds=seconds))
+        except Exception as e:
+            traceback.print_exc()
+            error = error or f"posting the result failed with {e!r}"
+    return index, error, seconds
+
+
+def run_batch(codes, workers=1):
+    """
+    runs a table of thunks in this process, or in a pool of processes forked after the imports.
+
+    :return: the number of thunks that failed.
+    """
+    THUNKS[:] = [decode(code) for code in codes]
+    if workers > 1:
+        import multiprocessing
+
+        # one fresh fork per thunk, so that they do not share state other than the imports.
+        with multiprocessing.get_context("fork").Pool(workers, maxtasksperchild=1) as pool:
+            results = pool.imap_unordered(run_thunk, range(len(THUNKS)))
+            return report(results)
+    return report(run_thunk(i) for i in range(len(THUNKS)))
+
+
+def report(results):
+    failed = 0
+    for index, error, seconds in results:
+        failed += error is not None
+        status = "ok" if error is None else f"failed with {error}"
+        print(f"jaynes thunk {index}: {status} in {seconds:.2f}s", file=sys.stderr, flush=True)
+    return failed
+
+
+def work(source, queue="default", idle_timeout=None, poll=30):
+    """
+    A warm worker: keeps this interpreter, its imports and the GPU context, and runs the thunks it pulls
+    from the queue one after another, see :code:`jaynes.queues`.
+
+    :param source: the url of a Jaynes server, or a queue directory.
+    :param idle_timeout: exits after this many seconds without work. Runs forever when None.
+    :param poll: seconds a single pull waits for a thunk.
+    """
+    from .queues import open_queue
+
+    tasks = open_queue(source, queue)
+    print(f"jaynes worker {os.getpid()} is pulling from {source} {queue}", file=sys.stderr, flush=True)
+    idle_since = time.time()
+    while True:
+        task = tasks.get(timeout=poll if idle_timeout is None else min(poll, idle_timeout))
+        if task is None:
+            if idle_timeout is not None and time.time() - idle_since >= idle_timeout:
+                return
+            continue
+        task_id, thunk_string = task
+        try:
+            THUNKS[:] = [decode(thunk_string)]
+            _, error, seconds = run_thunk(0)
+        except Exception as e:
+            # the thunk does not decode, e.g. a module the worker can not import.
+            traceback.print_exc()
+            error, seconds = repr(e), 0
+        tasks.done(task_id, dict(error=error, seconds=seconds))
+        report([(task_id, error, seconds)])
+        idle_since = time.time()
+
+
+if __name__ == "__main__" and "--worker" in sys.argv:
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run thunks from a queue in a long-lived worker.')
+    parser.add_argument('--worker', dest='source', required=True, help='url of a Jaynes server, or a queue directory')
+    parser.add_argument('--queue', dest='queue', default="default")
+    parser.add_argument('--idle-timeout', dest='idle_timeout', type=float, default=None)
+
+    args = parser.parse_args()
+    work(args.source, args.queue, idle_timeout=args.idle_timeout)
+
+elif __name__ == "__main__":
     thunk_string = os.environ.get(JAYNES_PARAMS_KEY)
     assert thunk_string is not None, f"environment variable {JAYNES_PARAMS_KEY} does not exist!"
-    # consider catching exceptions.
-    fn, args, kwargs = deserialize(thunk_string)
+    # job arrays share one payload table, and each task picks its row by the index the scheduler sets.
+    index_var = os.environ.get(JAYNES_INDEX_VAR_KEY)
+    if index_var:
+        index = int(os.environ[index_var])
+        # a directory holds the table as one file per row, e.g. the ConfigMap of an indexed kubernetes job.
+        thunk_string = f"{thunk_string}{index}" if thunk_string.endswith("/") else thunk_string.split(",")[index]
+
+    if JAYNES_WORKERS_KEY in os.environ:
+        # a batch, where one process imports once and runs all the thunks in the table.
+        failed = run_batch(thunk_string.split(","), workers=int(os.environ[JAYNES_WORKERS_KEY]))
+        sys.exit(1 if failed else 0)
+
+    THUNKS[:] = [decode(thunk_string)]
+    fn, args, kwargs, channel = THUNKS[0]
+    if channel:
+        # the error goes to the result channel, and the exit code tells the scheduler.
+        _, error, _ = run_thunk(0)
+        sys.exit(1 if error else 0)
     fn(*args, **kwargs)
@@ -73,26 +73,79 @@ def memoize(f):
     return wrapper
 
 
+class Lazy:
+    """
+    A tagged node of the .jaynes.yml, e.g. a :code:`!mounts.S3Code`. The object is only constructed when the
+    config of the selected mode is hydrated, so that the mounts of the other modes cost nothing. Holds plain
+    data until then, so that the parsed config can be pickled.
+    """
+    __slots__ = ("tag", "kwargs", "value")
+
+    def __init__(self, tag, kwargs):
+        self.tag = tag
+        self.kwargs = kwargs
+        self.value = None
+
+    def __getstate__(self):
+        return self.tag, self.kwargs
+
+    def __setstate__(self, state):
+        self.tag, self.kwargs = state
+        self.value = None
+
+
+def lazy(_, node):
+    """the yaml constructor for the tags that hydrate constructs."""
+    return Lazy(node.tag, _.construct_mapping(node, deep=True))
+
+
 # note: now we properly handle the node types.
-def hydrate(Constructor, ctx):
-    def _fn(_, node):
-        kwargs = {}
-        for k, v in _.construct_mapping(node).items():
-            if isinstance(v, str):
-                try:
-                    kwargs[k] = v.format(**ctx)
-                except AttributeError as e:
-                    raise Exception(f"during comprehension of <{k}: {v}>: {str(e)}")
-            else:
-                kwargs[k] = v
-        try:
-            return Constructor(**kwargs)
-        except Exception as e:
-            print(f"{Constructor} and {kwargs} fails to instantiate")
-            raise e
-
-    return _fn
+def hydrate(node, constructors, ctx):
+    """
+    Constructs the Lazy nodes inside node, replacing them in place. Each Lazy is constructed once, so that a
+    yaml anchor keeps pointing at the same object.
+
+    :param constructors: a dictionary from the yaml tag to the class.
+    :param ctx: the context for the string interpolation of the keyword arguments.
+    """
+    if isinstance(node, Lazy):
+        if node.value is None:
+            Constructor = constructors[node.tag]
+            kwargs = {}
+            for k, v in node.kwargs.items():
+                v = hydrate(v, constructors, ctx)
+                if isinstance(v, str):
+                    try:
+                        kwargs[k] = v.format(**ctx)
+                    except AttributeError as e:
+                        raise Exception(f"during comprehension of <{k}: {v}>: {str(e)}")
+                else:
+                    kwargs[k] = v
+            try:
+                node.value = Constructor(**kwargs)
+            except Exception as e:
+                print(f"{Constructor} and {kwargs} fails to instantiate")
+                raise e
+        return node.value
+    if isinstance(node, dict):
+        for k, v in node.items():
+            node[k] = hydrate(v, constructors, ctx)
+    elif isinstance(node, list):
+        for i, v in enumerate(node):
+            node[i] = hydrate(v, constructors, ctx)
+    elif isinstance(node, tuple):
+        return tuple(hydrate(v, constructors, ctx) for v in node)
+    return node
 
 
 def snake2camel(word):
     return ''.join(x.capitalize() or '_' for x in word.split('_'))
+
+
+def get_cache_dir(*parts):
+    """returns a persistent cache directory, created on demand. Override the root with $JAYNES_CACHE_DIR."""
+    import os
+    root = os.environ.get("JAYNES_CACHE_DIR") or os.path.join(get_home_dir(), ".cache", "jaynes")
+    path = os.path.join(root, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
@@ -13,7 +13,8 @@ import jaynes.launchers
 import jaynes.launchers.base_launcher
 import jaynes.mounts
 import jaynes.runners
-from jaynes.helpers import cwd_ancestors, hydrate
+import jaynes.stores
+from jaynes.helpers import cwd_ancestors, get_cache_dir, hydrate, lazy
 
 
 class RUN:
@@ -43,17 +44,24 @@ class Jaynes:
     mounts = []
     launcher = None
     runner_config = None
+    thunk_store = None
+    # with a result channel, add, run and map return handles to the results, see jaynes.results.
+    result_channel = None
 
     _raw_config = None
     _secret = None
 
     @classmethod
     def format_context(cls, config_root=None, **ext):
-        try:
-            with open(config_root + "/.secret.yml", 'r') as f:
-                secret = yaml.safe_load(f)
-        except FileNotFoundError:
-            secret = dict()
+        # the secret file is read once per config root, instead of once per job.
+        if cls._secret is None or cls._secret[0] != config_root:
+            try:
+                with open(config_root + "/.secret.yml", 'r') as f:
+                    secret = yaml.safe_load(f)
+            except FileNotFoundError:
+                secret = dict()
+            cls._secret = config_root, secret
+        secret = cls._secret[1] or dict()
 
         return dict(env=SimpleNamespace(**os.environ), now=RUN.now, uuid=uuid4(), RUN=RUN,
                     secret=SimpleNamespace(**secret), **ext)
@@ -75,27 +83,72 @@ class Jaynes:
         return os.path.dirname(config_path), config_path
 
     @classmethod
-    def raw_config(cls, config_path=None, ctx={}):
-        if cls._raw_config:
-            return cls._raw_config
-
+    def constructors(cls):
+        """:return: the classes behind the yaml tags of the .jaynes.yml, which hydrate constructs lazily."""
         from inspect import isclass
 
-        # add env class for interpolation
-        yaml.SafeLoader.add_constructor("!ENV", hydrate(dict, ctx), )
-
+        constructors = {"!ENV": dict, "!host": lambda **args: args}
         for k, c in jaynes.mounts.__dict__.items():
             if isclass(c):
-                yaml.SafeLoader.add_constructor("!mounts." + k, hydrate(c, ctx), )
+                constructors["!mounts." + k] = c
+        for k, c in jaynes.stores.__dict__.items():
+            if isclass(c) and issubclass(c, jaynes.stores.Store):
+                constructors["!stores." + k] = c
+        return constructors
+
+    # bump when the parsed form changes, to invalidate the parse caches on disk.
+    CONFIG_CACHE_VERSION = 1
+    # pickles the parsed .jaynes.yml under ~/.cache/jaynes/configs, so that the next launch skips the yaml parsing.
+    config_cache = True
+
+    @classmethod
+    def raw_config(cls, config_path=None):
+        """
+        Parses the .jaynes.yml. Tagged nodes such as mounts are kept as Lazy nodes, and constructed by config
+        for the selected mode only. The parse is cached on disk, keyed by the modification time and size of
+        the file, and by its sha256 when those change.
+        """
+        if cls._raw_config:
+            return cls._raw_config
+
+        import pickle
+        from hashlib import sha256
+
+        for tag in cls.constructors():
+            yaml.SafeLoader.add_constructor(tag, lazy)
 
         for k, c in jaynes.runners.__dict__.items():
             if hasattr(c, 'from_yaml'):
                 yaml.SafeLoader.add_constructor("!runners." + k, c.from_yaml)
 
-        yaml.SafeLoader.add_constructor("!host", hydrate(lambda **args: args, ctx))
-
-        with open(config_path, 'r') as f:
-            raw = yaml.safe_load(f)
+        stat = os.stat(config_path)
+        key = sha256(os.path.abspath(config_path).encode()).hexdigest()[:16]
+        cache_path = os.path.join(get_cache_dir("configs"), f"{key}.pkl") if cls.config_cache else None
+        cached = None
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path, "rb") as f:
+                    cached = pickle.load(f)
+            except Exception:
+                # e.g. a cache written by another version of jaynes.
+                cached = None
+            if cached and cached["version"] != cls.CONFIG_CACHE_VERSION:
+                cached = None
+
+        if cached and (cached["mtime_ns"], cached["size"]) == (stat.st_mtime_ns, stat.st_size):
+            raw = cached["raw"]
+        else:
+            with open(config_path, 'rb') as f:
+                text = f.read()
+            digest = sha256(text).hexdigest()
+            # the file was touched, but not changed.
+            raw = cached["raw"] if cached and cached["digest"] == digest else yaml.safe_load(text)
+            if cache_path:
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(dict(version=cls.CONFIG_CACHE_VERSION, mtime_ns=stat.st_mtime_ns, size=stat.st_size,
+                                     digest=digest, raw=raw), f)
+                os.replace(tmp_path, cache_path)
 
         # order or precendence: mode -> run -> root
         cls._raw_config = raw
@@ -103,16 +156,68 @@ class Jaynes:
 
     host_unpacked = None
 
-    _uploaded = []
+    # the mounts that are already uploaded. Keyed on identity, because the same tree can go to several destinations.
+    _uploaded = set()
+    # the maximum number of mounts that are uploaded concurrently.
+    upload_workers = 4
 
     @classmethod
     def upload_mount(J, mounts, verbose=None, **host, ):
+        """
+        uploads the mounts concurrently, and reports the time each took. On the first failure the uploads
+        that have not started yet are cancelled, the commands of the running ones are terminated, and all
+        failures are raised together. Transfers that run in-process, e.g. with :code:`transfer="python"`,
+        run to completion. Prunes the tar ball cache once the uploads are done, keeping the tar balls they used.
+        """
+        from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+        from jaynes.shell import Cancellation, Cancelled
+
+        pending = []
         for mount in mounts:
             if mount in J._uploaded:
                 print('this package is already uploaded')
-            else:
-                J._uploaded.append(mount)
+            elif mount not in pending:
+                pending.append(mount)
+        if not pending:
+            return
+
+        cancellation = Cancellation()
+
+        def upload(mount):
+            started = time.perf_counter()
+            with cancellation.joined():
                 mount.upload(verbose=verbose, **host)
+            return time.perf_counter() - started
+
+        started = time.time()
+        with ThreadPoolExecutor(min(J.upload_workers, len(pending))) as pool:
+            futures = {pool.submit(upload, mount): mount for mount in pending}
+            try:
+                done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+            except BaseException:
+                # e.g. ctrl-c, which does not reach the commands in their own process groups.
+                cancellation.cancel()
+                raise
+            for future in not_done:
+                future.cancel()
+            if not_done:
+                cancellation.cancel()
+            wait(not_done)
+        jaynes.mounts.prune_tar_cache(since=started)
+
+        errors = []
+        for future, mount in futures.items():
+            name = type(mount).__name__
+            if future.cancelled() or isinstance(future.exception(), Cancelled):
+                print(f"{name} upload is cancelled")
+            elif future.exception():
+                errors.append(f"{name}: {future.exception()!r}")
+            else:
+                J._uploaded.add(mount)
+                print(f"{name} is uploaded in {future.result():.1f}s")
+        if errors:
+            raise RuntimeError("mount upload failed\n" + "\n".join(errors))
 
     @classmethod
     def config(cls, mode=None, *, config_path=None, runner=None, launch=None, verbose=None,
@@ -140,17 +245,20 @@ class Jaynes:
         RUN.config_root, config_path = cls.config_root(config_path)
 
         ctx = cls.format_context(RUN.config_root, **ext)
-        config = cls.raw_config(config_path, ctx).copy()
+        raw = cls.raw_config(config_path)
+        config = {k: v for k, v in raw.items() if k not in ('modes', 'run')}
 
         if mode:
-            modes = config.get('modes', {})
+            modes = raw.get('modes', {})
             config.update(modes[mode])
             # config = modes[mode]
         else:
-            run = config.get('run')
+            run = raw.get('run')
             assert run, "`run` field in .jaynes.yml can not be empty when using default config"
             config.update(run)
             # config = run
+        # only the mounts and stores of the selected mode are constructed.
+        hydrate(config, cls.constructors(), ctx)
 
         if verbose is not None:
             cls.verbose = verbose
@@ -178,6 +286,8 @@ class Jaynes:
             cls.launcher = getattr(jaynes.launchers, launch_type)(**launch_config)
 
             cls.mounts = config.get('mounts', [])
+            cls.thunk_store = config.get('thunk_store', None)
+            cls.result_channel = config.get('result_channel', None)
 
             cls.upload_mount(**launch_config, mounts=cls.mounts, verbose=cls.verbose)
         else:
@@ -239,20 +349,40 @@ class Jaynes:
         if not cls.launcher:
             cls.config(cls.mode)
 
-        if cls.launcher.last_runner:
+        last_runner = cls.launcher.last_runner
+        if last_runner and last_runner.pack:
+            # e.g. a slurm job array, where all thunks go out in one submission.
+            last_runner.pack(fn, *args, **kwargs)
+            return cls.last_handle()
+
+        if last_runner:
             cls.launcher.plan_instance(cls.verbose)
 
         Runner, hydrated_config = cls.process_runner_config()
 
         runner = Runner(**hydrated_config, mounts=cls.mounts)
+        runner.thunk_store = cls.thunk_store
+        runner.result_channel = cls.result_channel
         runner.build(fn, *args, **kwargs)
         cls.launcher.add_runner(runner)
 
-        return cls
+        return cls.last_handle()
+
+    @classmethod
+    def last_handle(cls):
+        """:return: the handle of the last thunk with a result channel, and cls without one, for chaining."""
+        if not cls.result_channel:
+            return cls
+        return cls.launcher.last_runner.handles[-1]
 
     @classmethod
     def chain(cls, fn, *args, **kwargs):
         assert cls.launcher.last_runner, "launcher must already contain a runner"
+        if cls.launcher.last_runner.pack:
+            # batched runners run the chained thunk in the same entry process.
+            cls.launcher.last_runner.pack(fn, *args, **kwargs)
+            return cls.last_handle()
+
         if cls.launcher.last_runner.chain is None:
             # In Docker for example, chaining should just add another runner.
             # return cls.add(fn, *args, **kwargs)
@@ -262,6 +392,8 @@ class Jaynes:
             Runner, hydrated_config = cls.process_runner_config()
 
             runner = Runner(**hydrated_config, mounts=cls.mounts)
+            runner.thunk_store = cls.thunk_store
+            runner.result_channel = cls.result_channel
             runner.build(fn, *args, **kwargs)
             cls.launcher.add_runner(runner)
 
@@ -274,7 +406,43 @@ class Jaynes:
             cls.launcher.last_runner.__init__(**hydrated_config)
             cls.launcher.last_runner.chain(fn, *args, **kwargs)
 
-        return cls
+        return cls.last_handle()
+
+    @classmethod
+    def map(cls, fn, kwargs_iterable, *args, verbose=None, **common_kwargs):
+        """
+        Launches :code:`fn(*args, **common_kwargs, **kwargs)` for each kwargs in a parameter sweep.
+
+        The function is pickled once. With a thunk store, it is uploaded once, and each job only ships
+        its own arguments. All jobs go out in one execute, through the batched path of the launcher.
+
+        :param fn: the function to run.
+        :param kwargs_iterable: an iterable of keyword argument dictionaries, one per job.
+        :param args: positional arguments shared by all jobs.
+        :param common_kwargs: keyword arguments shared by all jobs.
+        :return: what the launcher returns from execute. With a result channel, the list of handles, and
+                 in local mode, the list of return values.
+        """
+        from jaynes.param_codec import serialize_thunk
+
+        if cls.mode == "local":
+            return [fn(*args, **common_kwargs, **kwargs) for kwargs in kwargs_iterable]
+
+        if not cls.launcher:
+            cls.config(cls.mode)
+
+        thunk = serialize_thunk(fn)
+        if cls.thunk_store:
+            thunk = cls.thunk_store.put(thunk)
+
+        handles = [cls.add(thunk, *args, **{**common_kwargs, **kwargs}) for kwargs in kwargs_iterable]
+        assert handles, "kwargs_iterable is empty"
+        launch = cls.execute(verbose=verbose)
+        if not cls.result_channel:
+            return launch
+        for handle in handles:
+            handle.launch = launch
+        return handles
 
     @classmethod
     def launch_instance(cls, verbose=None):
@@ -287,6 +455,8 @@ class Jaynes:
     def execute(J, verbose=None):
         verbose = verbose or J.verbose
         J.launcher.setup_host(verbose=verbose)
+        if J.thunk_store:
+            J.thunk_store.flush(verbose=verbose, **J.launcher.config)
         if J.launcher.last_runner:
             return J.launcher.execute(verbose=verbose)
         else:
@@ -297,30 +467,45 @@ class Jaynes:
         if J.mode == "local":
             return fn(*args, **kwargs)
 
-        J.add(fn, *args, **kwargs)
-        return J.execute()
+        handle = J.add(fn, *args, **kwargs)
+        launch = J.execute()
+        if not J.result_channel:
+            return launch
+        # handle.result(timeout) blocks until the thunk returns, and raises what it raised.
+        handle.launch = launch
+        return handle
 
 
-def listen(timeout=None, interval=math.pi * 5, command=None, backoff_limit=None):
-    """Just a for-loop, to keep ths process connected to the ssh session"""
+def listen(timeout=None, interval=math.pi * 5, command=None, backoff_limit=None, jobs=None, watcher=None):
+    """
+    Keeps this process connected to the ssh session, until the timeout, the command succeeds or the jobs finish.
 
+    :param interval: seconds between two runs of the command, and the longest wait between two polls of the jobs.
+    :param jobs: ids returned by jaynes.execute, or handles. Returns once they all finish, see jaynes.wait.
+    :param watcher: the jaynes.wait.Watcher for the jobs. Inferred when None.
+    """
     cprint('Jaynes pipe-back is now listening...', "blue")
     if command:
         print(command)
 
+    if jobs is not None:
+        from jaynes.wait import wait
+
+        return wait(jobs, watcher, timeout=timeout, maximum=interval, verbose=True)
+
     if timeout:
         time.sleep(timeout)
         cprint(f'jaynes.listen(timeout={timeout}) is now timed out. remote routine is still running.', 'green')
     else:
-        backoff = 0
+        tries = 0
         cprint('Listening to pipe back...', 'blue')
-        while backoff_limit is None or backoff_limit > backoff:
+        while backoff_limit is None or backoff_limit > tries:
             if command is not None:
                 status = os.system(command)
                 if status == 0:
                     break
             time.sleep(interval)
-            backoff += 1
+            tries += 1
 
 
 config = Jaynes.config
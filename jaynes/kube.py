@@ -0,0 +1,511 @@
+"""
+A small client for the Kubernetes API, for the Kube launcher.
+
+Jobs are created with server-side apply, over one pooled session, a few at a time. Each job succeeds or
+fails on its own, and throttled requests (429) are retried with backoff, honoring :code:`Retry-After`.
+
+:code:`Monitor` follows the jobs of a launch, with one watch stream for the Jobs and one for the Pods of the namespace,
+and multiplexes the logs of the pods into one output.
+
+The credentials come from the kubeconfig (:code:`$KUBECONFIG` or :code:`~/.kube/config`), from the service
+account when running inside a cluster, or from the :code:`server` and :code:`token` arguments.
+"""
+import base64
+import json
+import os
+import sys
+import threading
+import time
+
+IN_CLUSTER_DIR = "/var/run/secrets/kubernetes.io/serviceaccount"
+
+# the label of the Jobs and Pods jaynes creates, with the name of the job.
+JOB_LABEL = "jaynes/job"
+INDEX_ANNOTATION = "batch.kubernetes.io/job-completion-index"
+
+# the plural resource paths of the kinds jaynes creates.
+RESOURCES = {
+    ("batch/v1", "Job"): "jobs",
+    ("v1", "ConfigMap"): "configmaps",
+    ("v1", "Pod"): "pods",
+}
+
+
+class KubeError(Exception):
+    def __init__(self, status, message, obj=None):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.obj = obj
+
+
+# the directory of the certificates and keys of the kubeconfig, made once per process and removed at exit.
+_data_dir = None
+_data_lock = threading.Lock()
+
+
+def _data_file(data, suffix):
+    """writes the *-data fields of the kubeconfig out, because requests takes paths."""
+    global _data_dir
+    import hashlib
+
+    with _data_lock:
+        if _data_dir is None:
+            import atexit
+            import shutil
+
+            from .helpers import get_temp_dir
+
+            _data_dir = get_temp_dir()
+            atexit.register(shutil.rmtree, _data_dir, ignore_errors=True)
+        # named by the content, so that the clients of several contexts do not overwrite each other's.
+        path = os.path.join(_data_dir, f"kube-{hashlib.sha256(data.encode()).hexdigest()[:16]}{suffix}")
+        if not os.path.exists(path):
+            with open(path + ".tmp", "wb") as f:
+                f.write(base64.b64decode(data))
+            os.replace(path + ".tmp", path)
+    return path
+
+
+def load_config(kubeconfig=None, context=None):
+    """
+    :return: dict(server, token, verify, cert, namespace) for the context of the kubeconfig, or of the service
+             account inside a cluster. The namespace is None when the context does not set one.
+    """
+    path = kubeconfig or os.environ.get("KUBECONFIG", "~/.kube/config").split(os.pathsep)[0]
+    path = os.path.expanduser(path)
+    if not os.path.exists(path) and os.environ.get("KUBERNETES_SERVICE_HOST"):
+        with open(os.path.join(IN_CLUSTER_DIR, "token")) as f:
+            token = f.read().strip()
+        namespace = None
+        if os.path.exists(os.path.join(IN_CLUSTER_DIR, "namespace")):
+            with open(os.path.join(IN_CLUSTER_DIR, "namespace")) as f:
+                namespace = f.read().strip() or None
+        server = f"https://{os.environ['KUBERNETES_SERVICE_HOST']}:{os.environ.get('KUBERNETES_SERVICE_PORT', 443)}"
+        return dict(server=server, token=token, verify=os.path.join(IN_CLUSTER_DIR, "ca.crt"), cert=None,
+                    namespace=namespace)
+
+    import yaml
+
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    context = context or config["current-context"]
+    ctx, = [c["context"] for c in config["contexts"] if c["name"] == context]
+    cluster, = [c["cluster"] for c in config["clusters"] if c["name"] == ctx["cluster"]]
+    user, = [u.get("user") or {} for u in config.get("users", []) if u["name"] == ctx.get("user")] or [{}]
+
+    verify = True
+    if cluster.get("insecure-skip-tls-verify"):
+        verify = False
+    elif cluster.get("certificate-authority-data"):
+        verify = _data_file(cluster["certificate-authority-data"], "-ca.crt")
+    elif cluster.get("certificate-authority"):
+        verify = cluster["certificate-authority"]
+
+    cert = None
+    if user.get("client-certificate-data"):
+        cert = _data_file(user["client-certificate-data"], ".crt"), _data_file(user["client-key-data"], ".key")
+    elif user.get("client-certificate"):
+        cert = user["client-certificate"], user["client-key"]
+
+    token = user.get("token")
+    if user.get("exec"):
+        # e.g. the aws and gcloud credential plugins.
+        import subprocess
+
+        plugin = user["exec"]
+        env = dict(os.environ, **{e["name"]: e["value"] for e in plugin.get("env") or []})
+        output = subprocess.check_output([plugin["command"], *plugin.get("args", [])], env=env)
+        token = json.loads(output)["status"]["token"]
+
+    return dict(server=cluster["server"], token=token, verify=verify, cert=cert, namespace=ctx.get("namespace"))
+
+
+def resource_path(obj, namespace=None, name=None):
+    """:return: the api path of the object, e.g. /apis/batch/v1/namespaces/default/jobs/<name>."""
+    api_version, kind = obj["apiVersion"], obj["kind"]
+    prefix = f"/api/{api_version}" if "/" not in api_version else f"/apis/{api_version}"
+    namespace = namespace or obj["metadata"].get("namespace") or "default"
+    path = f"{prefix}/namespaces/{namespace}/{RESOURCES[api_version, kind]}"
+    name = name or obj["metadata"].get("name")
+    return f"{path}/{name}" if name else path
+
+
+def timed_out(e):
+    """:return: whether e is a read timeout, which requests raises as a ConnectionError in the middle of a stream."""
+    import requests
+    from urllib3.exceptions import ReadTimeoutError
+
+    if isinstance(e, requests.ReadTimeout):
+        return True
+    return isinstance(e, requests.ConnectionError) and bool(e.args) and isinstance(e.args[0], ReadTimeoutError)
+
+
+def log_time(stamp):
+    """:return: a sortable key of the RFC3339Nano timestamp of a log line, which drops trailing zeros."""
+    seconds, _, fraction = stamp.rstrip("Z").partition(".")
+    return seconds, fraction.ljust(9, "0")
+
+
+class KubeClient:
+    """
+    :param server: the url of the API server. Read from the kubeconfig when None.
+    :param token: the bearer token.
+    :param namespace: the namespace of the requests that do not name one. Default to the namespace of the
+                      context or of the service account, then to "default".
+    :param pool_size: the number of pooled connections, at least the concurrency of apply_all.
+    :param max_retries: the number of retries of a throttled request.
+    :param field_manager: the owner of the fields in server-side apply.
+    """
+
+    def __init__(self, server=None, token=None, verify=True, cert=None, kubeconfig=None, context=None,
+                 namespace=None, pool_size=16, max_retries=8, field_manager="jaynes"):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        if server is None:
+            config = load_config(kubeconfig, context)
+            server, token, verify, cert = config["server"], token or config["token"], config["verify"], config["cert"]
+            namespace = namespace or config.get("namespace")
+        self.server = server.rstrip("/")
+        self.namespace = namespace or "default"
+        self.max_retries = max_retries
+        self.field_manager = field_manager
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.verify = verify
+        self.session.cert = cert
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def request(self, method, path, **kwargs):
+        """retries 429s with backoff. :return: the decoded response. Raises KubeError on the other errors."""
+        from .wait import backoff
+
+        intervals = backoff(initial=0.5, maximum=30)
+        for attempt in range(self.max_retries + 1):
+            r = self.session.request(method, self.server + path, **kwargs)
+            if r.status_code != 429 or attempt == self.max_retries:
+                break
+            retry_after = r.headers.get("Retry-After")
+            time.sleep(float(retry_after) if retry_after else next(intervals))
+        if r.status_code >= 400:
+            try:
+                message = r.json().get("message", r.text)
+            except ValueError:
+                message = r.text
+            raise KubeError(r.status_code, message)
+        return r.json() if r.content else None
+
+    def stream(self, path, params=None, timeout=None):
+        """:return: the streaming response. The read timeout is None, for the streams that idle, e.g. logs."""
+        r = self.session.get(self.server + path, params=params, stream=True, timeout=(10, timeout))
+        if r.status_code >= 400:
+            r.close()
+            raise KubeError(r.status_code, r.text)
+        return r
+
+    def apply(self, obj, dry_run=False):
+        """creates or updates the object with server-side apply."""
+        params = dict(fieldManager=self.field_manager, force="true")
+        if dry_run:
+            params["dryRun"] = "All"
+        namespace = obj["metadata"].get("namespace") or self.namespace
+        return self.request("PATCH", resource_path(obj, namespace), params=params, data=json.dumps(obj),
+                            headers={"Content-Type": "application/apply-patch+yaml"})
+
+    def adopt(self, obj, owner):
+        """makes owner the owner of obj, so that obj is garbage collected with it. :return: the patched obj."""
+        namespace = obj["metadata"].get("namespace") or self.namespace
+        owner = self.request("GET", resource_path(owner, owner["metadata"].get("namespace") or self.namespace))
+        reference = dict(apiVersion=owner["apiVersion"], kind=owner["kind"], name=owner["metadata"]["name"],
+                         uid=owner["metadata"]["uid"], blockOwnerDeletion=True)
+        return self.request("PATCH", resource_path(obj, namespace),
+                            data=json.dumps({"metadata": {"ownerReferences": [reference]}}),
+                            headers={"Content-Type": "application/merge-patch+json"})
+
+    def list(self, api_version, kind, namespace=None, label_selector=None, limit=500):
+        """yields the objects of a kind, a page of limit at a time."""
+        path = resource_path(dict(apiVersion=api_version, kind=kind, metadata={}), namespace or self.namespace)
+        params = dict(limit=limit)
+        if label_selector:
+            params["labelSelector"] = label_selector
+        while True:
+            page = self.request("GET", path, params=params)
+            yield from page["items"]
+            if not page["metadata"].get("continue"):
+                return
+            params["continue"] = page["metadata"]["continue"]
+
+    def watch(self, api_version, kind, namespace=None, label_selector=None, timeout=None, stop=None, opened=None,
+              read_timeout=None):
+        """
+        yields the (type, object) events of the kind, starting with an ADDED event for every existing object.
+        Reconnects from the last resourceVersion when the server closes the stream, and relists when that
+        version has expired.
+
+        :param timeout: seconds, forever when None.
+        :param stop: a threading.Event that ends the watch, checked between events and at least once a minute.
+        :param opened: called with every stream the watch opens, e.g. to close it from another thread.
+        :param read_timeout: seconds without an event, after which the watch checks stop and reconnects.
+        """
+        path = resource_path(dict(apiVersion=api_version, kind=kind, metadata={}), namespace or self.namespace)
+        deadline = None if timeout is None else time.time() + timeout
+        resource_version = None
+        while not (stop and stop.is_set()):
+            remaining = 60 if deadline is None else min(60, int(deadline - time.time()))
+            if remaining <= 0:
+                return
+            params = dict(watch="true", timeoutSeconds=remaining, allowWatchBookmarks="true")
+            if label_selector:
+                params["labelSelector"] = label_selector
+            if resource_version:
+                params["resourceVersion"] = resource_version
+            try:
+                with self.stream(path, params, timeout=read_timeout or remaining + 30) as r:
+                    if opened:
+                        opened(r)
+                    for line in r.iter_lines():
+                        if not line:
+                            continue
+                        event = json.loads(line)
+                        obj = event["object"]
+                        if event["type"] == "ERROR":
+                            if obj.get("code") != 410:
+                                raise KubeError(obj.get("code"), obj.get("message"))
+                            resource_version = None
+                            break
+                        resource_version = obj["metadata"].get("resourceVersion") or resource_version
+                        if event["type"] != "BOOKMARK":
+                            yield event["type"], obj
+                        if stop and stop.is_set():
+                            return
+            except Exception as e:
+                if not (read_timeout and timed_out(e)):
+                    raise
+
+    def apply_all(self, objs, concurrency=8, chunk_size=100, dry_run=False, verbose=False):
+        """
+        applies the objects, concurrency at a time. Submits chunk_size objects at once, so that thousands of
+        jobs do not all sit in the queue of the pool.
+
+        :return: a list of (name, error) for every object, where error is None on success.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        def apply(obj):
+            try:
+                self.apply(obj, dry_run=dry_run)
+                return obj["metadata"]["name"], None
+            except Exception as e:
+                return obj["metadata"]["name"], e
+
+        results = []
+        with ThreadPoolExecutor(concurrency) as pool:
+            for i in range(0, len(objs), chunk_size):
+                for name, error in pool.map(apply, objs[i:i + chunk_size]):
+                    if verbose or error:
+                        print(f"{name}: {'applied' if error is None else f'failed with {error}'}")
+                    results.append((name, error))
+        return results
+
+
+def job_state(job):
+    """:return: the wait state of a Job, from its conditions."""
+    from .wait import DONE, FAILED, RUNNING
+
+    conditions = [c["type"] for c in (job.get("status") or {}).get("conditions") or [] if c["status"] == "True"]
+    return FAILED if "Failed" in conditions else DONE if "Complete" in conditions else RUNNING
+
+
+class Monitor:
+    """
+    Follows the jobs of a launch: prints the phase transitions of the Jobs and of their Pods, and the logs of the
+    pods, each line prefixed by its job and index. Everything goes through one watch stream for the Jobs and one
+    for the Pods of the namespace, filtered by the jaynes labels.
+
+    The memory stays bounded with hundreds of pods. At most max_streams logs are followed at a time, and the
+    other pods wait for a free stream. The lines go through a queue of at most buffer lines, which holds the
+    streams back while the output is slow, and are cut at max_line bytes. The streams are closed, and their
+    threads end, when run returns.
+
+    A stream that has no data for read_timeout seconds reconnects: a watch from its last resourceVersion, and
+    a log from the timestamp of its last line. This is also how long a thread takes to notice that run returned.
+
+    :param client: a KubeClient.
+    :param jobs: the names of the jobs, as returned by Kube.execute.
+    :param namespace: default to the namespace of the client.
+    :param logs: follows the logs of the pods when True, only the transitions otherwise.
+    :param out: the file to write to, default to stdout.
+    """
+
+    def __init__(self, client, jobs, namespace=None, logs=True, out=None, max_streams=32, buffer=1000,
+                 max_line=4096, read_timeout=3):
+        import collections
+        import queue
+
+        self.client = client
+        self.namespace = namespace or client.namespace
+        self.logs = logs
+        self.out = out or sys.stdout
+        self.max_line = max_line
+        self.read_timeout = read_timeout
+        self.states = {name: None for name in jobs}
+        self.pods = {}
+        self.followed = set()
+        # the pods that wait for a stream, and the number of streams.
+        self.waiting = collections.deque()
+        self.following = 0
+        self.max_streams = max_streams
+        self.queue = queue.Queue(maxsize=buffer)
+        self.stop = threading.Event()
+        # the open streams, closed when run returns.
+        self.responses = {}
+        self.lock = threading.Lock()
+
+    def write(self, prefix, line):
+        print(f"{prefix} | {line}", file=self.out, flush=True)
+
+    def _put(self, item):
+        """:return: False once the monitor stops, instead of blocking on a full queue."""
+        import queue
+
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _opened(self, key, r):
+        with self.lock:
+            self.responses[key] = r
+            if self.stop.is_set():
+                r.close()
+
+    def _watch(self, kind, api_version):
+        try:
+            for event_type, obj in self.client.watch(api_version, kind, self.namespace, label_selector=JOB_LABEL,
+                                                     stop=self.stop, opened=lambda r: self._opened(kind, r),
+                                                     read_timeout=self.read_timeout):
+                if not self._put((kind, event_type, obj)):
+                    return
+        except Exception as e:
+            if not self.stop.is_set():
+                self._put(("error", kind, e))
+        finally:
+            with self.lock:
+                self.responses.pop(kind, None)
+
+    def _follow(self, pod, prefix, container):
+        path = resource_path(dict(apiVersion="v1", kind="Pod", metadata={}), self.namespace, pod) + "/log"
+        params = dict(follow="true", container=container, timestamps="true")
+        last = None
+        try:
+            while not self.stop.is_set():
+                try:
+                    with self.client.stream(path, params, timeout=self.read_timeout) as r:
+                        self._opened(pod, r)
+                        for line in r.iter_lines():
+                            stamp, _, text = line.partition(b" ")
+                            key = log_time(stamp.decode(errors="replace"))
+                            if last is not None and key <= last:
+                                # sent again, since the reconnect resumes at the start of the second.
+                                continue
+                            last = key
+                            if not self._put(("log", prefix, text[:self.max_line].decode(errors="replace"))):
+                                return
+                    # the container exited.
+                    return
+                except Exception as e:
+                    if not timed_out(e):
+                        raise
+                if last is not None:
+                    params["sinceTime"] = last[0] + "Z"
+        except Exception as e:
+            if not self.stop.is_set():
+                self._put(("log", prefix, f"following the logs failed with {e!r}"))
+        finally:
+            with self.lock:
+                self.responses.pop(pod, None)
+            self._put(("end", pod, None))
+
+    def _start_streams(self):
+        while self.waiting and self.following < self.max_streams:
+            self.following += 1
+            threading.Thread(target=self._follow, args=self.waiting.popleft(), name="jaynes-monitor",
+                             daemon=True).start()
+
+    def on_job(self, event_type, job):
+        name = job["metadata"]["name"]
+        if name not in self.states:
+            return
+        from .wait import FAILED
+
+        state = FAILED if event_type == "DELETED" else job_state(job)
+        if state != self.states[name]:
+            self.write(name, f"job {self.states[name] or 'submitted'} -> {state}")
+            self.states[name] = state
+
+    def on_pod(self, event_type, pod):
+        meta = pod["metadata"]
+        job = meta.get("labels", {}).get(JOB_LABEL)
+        if job not in self.states:
+            return
+        name = meta["name"]
+        if event_type == "DELETED":
+            self.pods.pop(name, None)
+            return
+        index = meta.get("annotations", {}).get(INDEX_ANNOTATION)
+        prefix = job if index is None else f"{job}[{index}]"
+        phase = (pod.get("status") or {}).get("phase", "Pending")
+        if phase != self.pods.get(name):
+            self.write(prefix, f"pod {name} {self.pods.get(name) or 'created'} -> {phase}")
+            self.pods[name] = phase
+        if self.logs and phase != "Pending" and name not in self.followed:
+            self.followed.add(name)
+            self.waiting.append((name, prefix, pod["spec"]["containers"][0]["name"]))
+            self._start_streams()
+
+    def run(self, timeout=None):
+        """
+        blocks until all the jobs finish, and the logs of their pods end.
+
+        :return: the states of the jobs, RUNNING for those that did not finish before the timeout.
+        """
+        import queue
+        from .wait import RUNNING
+
+        deadline = None if timeout is None else time.time() + timeout
+        for kind, api_version in [("Job", "batch/v1"), ("Pod", "v1")]:
+            threading.Thread(target=self._watch, args=(kind, api_version), name="jaynes-monitor", daemon=True).start()
+        try:
+            while self.following or self.waiting or not all(s not in (None, RUNNING) for s in self.states.values()):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                try:
+                    kind, a, b = self.queue.get(timeout=1 if remaining is None else min(1, remaining))
+                except queue.Empty:
+                    continue
+                if kind == "log":
+                    self.write(a, b)
+                elif kind == "end":
+                    self.following -= 1
+                    self._start_streams()
+                elif kind == "Job":
+                    self.on_job(a, b)
+                elif kind == "Pod":
+                    self.on_pod(a, b)
+                else:
+                    raise b
+        finally:
+            # ends the threads, which check stop between lines, and at the latest after a read timeout.
+            self.stop.set()
+            with self.lock:
+                for r in list(self.responses.values()):
+                    r.close()
+        return {name: state or RUNNING for name, state in self.states.items()}
@@ -1,11 +1,27 @@
-from .ec2_launch import EC2
-from .gcp_launch import GCE
-from .ssh_launch import SSH
-from .manager_launch import Manager
-from .kube_launch import Kube
-
-ec2 = EC2
-gce = GCE
-ssh = SSH
-manager = Manager
-kube = Kube
+import importlib
+
+# the launchers import their SDKs, e.g. requests for the Manager, so they are imported on first access.
+_LAUNCHERS = {
+    "EC2": "ec2_launch",
+    "GCE": "gcp_launch",
+    "SSH": "ssh_launch",
+    "Manager": "manager_launch",
+    "Kube": "kube_launch",
+    "Queue": "queue_launch",
+}
+_ALIASES = {"ec2": "EC2", "gce": "GCE", "ssh": "SSH", "manager": "Manager", "kube": "Kube", "queue": "Queue"}
+
+__all__ = sorted([*_LAUNCHERS, *_ALIASES])
+
+
+def __getattr__(name):
+    cls_name = _ALIASES.get(name, name)
+    if cls_name not in _LAUNCHERS:
+        raise AttributeError(f"module 'jaynes.launchers' has no attribute {name!r}")
+    value = getattr(importlib.import_module(f"jaynes.launchers.{_LAUNCHERS[cls_name]}"), cls_name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,10 +1,17 @@
 import os
-from textwrap import dedent
+import re
+from functools import lru_cache
+from textwrap import dedent, indent
 from typing import Sequence, Tuple, Union
 
 from jaynes.mounts import Mount
+from jaynes.param_codec import check_size
 from jaynes.runners import Runner
-from jaynes.templates import ec2_tag_instance, ec2_terminate, gce_terminate
+from jaynes.templates import Template, ec2_tag_instance, ec2_terminate, gce_terminate
+
+BLANK_LINES = re.compile("^[ \t]+$", re.MULTILINE)
+# the thunk stores an instance can fetch its launch script from on boot, with the aws and gsutil clis.
+BOOTSTRAP_SCHEMES = ("s3://", "gs://")
 
 
 class Launcher:
@@ -39,6 +46,88 @@ class Launcher:
     def execute(self, verbose=None):
         pass
 
+    # the thunk store that holds the launch scripts of the planned instances, see instance_script.
+    thunk_store = None
+
+    def bootstrap_store(self):
+        """:return: the thunk store of the runners, when the instances can fetch their launch scripts from it."""
+        store = self.runners[0].thunk_store
+        if self.config.get("bootstrap", True) and store is not None and store.prefix.startswith(BOOTSTRAP_SCHEMES):
+            return store
+        return None
+
+    def instance_script(self, launch_script, target, payloads=()):
+        """
+        :param target: "ec2" or "gce", for the size limit of the user data or the metadata.
+        :return: the script that goes into the user data or the metadata of the instance. With an s3 or gs thunk
+                 store, a bootstrap stub that fetches the launch script, see bootstrap_script. Set the
+                 :code:`bootstrap` option of the launcher to False to inline the launch script instead.
+        """
+        store = self.bootstrap_store()
+        if store is not None:
+            self.thunk_store = store
+            return bootstrap_script(launch_script, store, target)
+        # fails before any instance is launched.
+        check_size(launch_script, target, payloads)
+        return launch_script
+
+    def flush(self, verbose=None):
+        """uploads the launch scripts of the bootstrap stubs. Call before the instances are launched."""
+        if self.thunk_store is not None:
+            self.thunk_store.flush(**dict(self.config, verbose=verbose))
+
+
+def bootstrap_fetch(scheme, target="ec2", cache_dir="/var/cache/jaynes/scripts"):
+    """
+    :param scheme: of the thunk store, s3 or gs.
+    :return: the shell functions of the bootstrap stubs. :code:`jaynes_fetch <ref>` downloads a payload of the
+             store into cache_dir, verifies its digest, and sets JAYNES_PATH to it. When that fails, the instance
+             terminates, so that it does not sit idle without a launch script that would terminate it.
+    """
+    from jaynes.stores import download_command
+
+    terminate = ec2_terminate(0) if target == "ec2" else gce_terminate(0)
+    download = download_command("$1", "$JAYNES_PATH.tmp", scheme=scheme)
+    return "\n".join([
+        "jaynes_fail() {",
+        '    echo "jaynes bootstrap failed: $*" >&2',
+        # in a subshell, so that the shutdown runs even when the terminate call dies.
+        "    (",
+        indent(terminate.strip(), "        "),
+        "    )",
+        "    shutdown -h now",
+        "    exit 1",
+        "}",
+        "jaynes_fetch() {",
+        f"    JAYNES_PATH={cache_dir}/${{1##*/}}",
+        "    if [ ! -f $JAYNES_PATH ]; then",
+        f"        mkdir -p {cache_dir}",
+        f"        for i in 1 2 3 4 5; do {download} && break; sleep $i; done",
+        '        echo "${1##*/}  $JAYNES_PATH.tmp" | sha256sum -c --status || jaynes_fail "could not fetch $1"',
+        "        mv $JAYNES_PATH.tmp $JAYNES_PATH",
+        "    fi",
+        "}",
+    ])
+
+
+def bootstrap_script(launch_script, store, target="ec2", cache_dir="/var/cache/jaynes/scripts"):
+    """
+    stages the launch script in the thunk store, under its digest. The stub that replaces it is about a kilobyte,
+    so that big sweeps stay far below the limits of the user data and the metadata. It keeps the scripts in
+    cache_dir, so that an image with a script baked in, or a rebooted instance, does not fetch it again.
+
+    :return: the bootstrap stub.
+    """
+    ref = store.put(launch_script.encode())
+    return "\n".join([
+        "#!/bin/bash",
+        "# the launch script is in the thunk store, under its sha256 digest.",
+        bootstrap_fetch(ref.split("://", 1)[0], target, cache_dir),
+        f"jaynes_fetch {ref}",
+        "exec /bin/bash $JAYNES_PATH",
+        "",
+    ])
+
 
 def make_host_unpack_script(mounts: Sequence[Mount], launch_dir="/tmp/jaynes-mount", delay=None, root_config=None, **_):
     """
@@ -104,11 +193,6 @@ def make_launch_script(
     :param instance_name: less than 128 ascii characters
     :return:
     """
-    log_setup = dedent(f"""
-mkdir -p {launch_dir}
-JAYNES_LAUNCH_DIR={launch_dir}
-""").strip()
-
     if not pipe_out:
         log_path = os.path.join(launch_dir, "jaynes-launch.log")
         error_path = os.path.join(launch_dir, "jaynes-launch.err.log")
@@ -122,18 +206,16 @@ JAYNES_LAUNCH_DIR={launch_dir}
         host_unpack_script = ""
     if instance_name:
         assert len(instance_name) <= 128, "Error: ws limits instance tag to 128 unicode characters."
+    if terminate_after and type not in ("ec2", "gce"):
+        raise NotImplementedError(f"terminate_after is not supported with {type}")
 
-    # NOTE: path.join is running on local computer, so it might not be quite right if remote is say windows.
-    # NOTE: dedent is required by aws EC2.
-    terminate_commands = ""
-    if terminate_after:
-        if type == "ec2":
-            terminate_commands = ec2_terminate(delay)
-        elif type == "gce":
-            terminate_commands = gce_terminate(delay)
-        else:
-            raise NotImplementedError(f"terminate_after is not supported with {type}")
+    template = compile_launch_script(
+        type, launch_dir, pipe_out, setup, terminate_after, delay, bool(instance_name),
+        f"{root_config or ''}", upload_script, host_unpack_script,
+    )
 
+    for r in runners:
+        r.pack_table()
     setup_scripts = "\n".join([r.setup_script for r in runners if r.setup_script]).strip()
     # note: add wait at the end to terminate process only after all launch scripts finish. Always blocking
     if len(runners) == 1:
@@ -143,25 +225,54 @@ JAYNES_LAUNCH_DIR={launch_dir}
         run_scripts = " & \n".join([r.run_script.strip() for r in runners if r.run_script.strip()] + ["wait"])
     post_scripts = "\n".join([r.post_script for r in runners if r.post_script]).strip()
 
-    return dedent(f"""
+    # dedent used to blank the whitespace-only lines of the runner scripts, which keeps the scripts the same.
+    return template(JYNS_instance_name=instance_name or "", JYNS_setup_scripts=BLANK_LINES.sub("", setup_scripts),
+                    JYNS_run_scripts=BLANK_LINES.sub("", run_scripts),
+                    JYNS_post_scripts=BLANK_LINES.sub("", post_scripts))
+
+
+@lru_cache(maxsize=64)
+def compile_launch_script(type, launch_dir, pipe_out, setup, terminate_after, delay, tag_instance, root_config,
+                          upload_script, host_unpack_script):
+    """
+    The part of the launch script that only depends on the launch configuration and the mounts, dedented once.
+    The jobs of a sweep share it, and only fill in their runner scripts.
+
+    :return: a Template with the fields JYNS_instance_name, JYNS_setup_scripts, JYNS_run_scripts and
+             JYNS_post_scripts.
+    """
+    log_setup = dedent(f"""
+mkdir -p {launch_dir}
+JAYNES_LAUNCH_DIR={launch_dir}
+""").strip()
+
+    # NOTE: path.join is running on local computer, so it might not be quite right if remote is say windows.
+    # NOTE: dedent is required by aws EC2.
+    terminate_commands = ""
+    if terminate_after:
+        terminate_commands = ec2_terminate(delay) if type == "ec2" else gce_terminate(delay)
+
+    # the runner scripts go in after the dedent, so that it does not scan them for every job.
+    field = "\0{}\0".format
+    return Template.from_markers(dedent(f"""
 #!/bin/bash
 # to allow process substitution
 set +o posix
-{root_config or ""}
+{root_config}
 {log_setup or ""}
 {{
 # launch.setup script
 {setup or ""}
-{ec2_tag_instance(instance_name) if type == "ec2" and instance_name else ""}
+{ec2_tag_instance(field("JYNS_instance_name")) if type == "ec2" and tag_instance else ""}
 {host_unpack_script}
 # upload_script from within the host.
 {upload_script}
 # runner.setup script
-{setup_scripts}
+{field("JYNS_setup_scripts")}
 # run script
-{run_scripts}
+{field("JYNS_run_scripts")}
 # post script
-{post_scripts}
+{field("JYNS_post_scripts")}
 {terminate_commands}
 }} {pipe_out or ""}
-""").strip()
+""").strip())
@@ -1,7 +1,10 @@
 import base64
+import json
+from functools import lru_cache
 
 from jaynes.helpers import snake2camel
-from jaynes.launchers.base_launcher import Launcher, make_launch_script
+from jaynes.launchers.base_launcher import Launcher, bootstrap_fetch, bootstrap_script, make_launch_script
+from jaynes.param_codec import check_size
 
 
 # "image_id instance_type key_name security_group spot_price iam_instance_profile_arn "
@@ -9,6 +12,12 @@ from jaynes.launchers.base_launcher import Launcher, make_launch_script
 
 
 class EC2(Launcher):
+    """
+    Launches an instance per planned launch script. The instances with the same launch spec go out in one
+    request only with a bootstrap store, i.e. an s3 thunk store, from which each instance fetches its own launch
+    script, see requests. Without one, the launch script is the user data, and a sweep goes out one request
+    per instance.
+    """
     _instance_plan = None
 
     @property
@@ -25,6 +34,11 @@ class EC2(Launcher):
         launch_script = make_launch_script(runners=self.runners, mounts=self.all_mounts,
                                            unpack_on_host=True, **self.config)
         launch_config = self.runners[0].launch_config
+        # the scripts go into the store in execute, where the instances of a launch spec share one table.
+        self.thunk_store = self.bootstrap_store()
+        if self.thunk_store is None:
+            # fails before any instance is launched.
+            check_size(launch_script, "ec2", [p for r in self.runners for p in r.payloads or []])
         self.runners.clear()
 
         if verbose:
@@ -32,26 +46,104 @@ class EC2(Launcher):
 
         self.instance_plan.append(dict(launch_script=launch_script, **launch_config))
 
+    def requests(self):
+        """
+        groups the planned instances by their launch spec. With a bootstrap store, the instances of a spec go out in
+        one request, and each picks its launch script from a table, see launch_table. Without one, only the
+        instances with the same script can share a request, because the script is the user data.
+
+        :return: a list of (launch function, config, indices into the plan).
+        """
+        store = self.thunk_store
+        groups = {}
+        for i, instance_config in enumerate(self.instance_plan):
+            spec = {k: v for k, v in instance_config.items() if k != "launch_script"}
+            groups.setdefault(json.dumps(spec, sort_keys=True, default=str), (spec, []))[1].append(i)
+
+        requests = []
+        for spec, indices in groups.values():
+            scripts = [self.instance_plan[i]["launch_script"] for i in indices]
+            if store is not None and len(indices) > 1:
+                table = "\n".join(store.put(script.encode()) for script in scripts)
+                requests.append((launch_table, dict(spec, table=store.put(table.encode())), indices))
+            elif store is not None:
+                requests.append((launch_ec2, dict(spec, launch_script=bootstrap_script(scripts[0], store)), indices))
+            else:
+                same = {}
+                for i, script in zip(indices, scripts):
+                    same.setdefault(script, []).append(i)
+                requests += [(launch_ec2, dict(spec, launch_script=script), i) for script, i in same.items()]
+        return requests
+
     def execute(self, verbose=None):
+        """
+        launches the planned instances, a request per launch spec, see requests. The requests run concurrency at a
+        time, on one client per region.
+
+        :return: the spot request ids, or the instance ids, in the order of the plan.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
         self.plan_instance(verbose=verbose)
+        requests = self.requests()
+        self.flush(verbose=verbose)
 
-        ids = []
-        for instance_config in self.instance_plan:
-            request_id = launch_ec2(**instance_config, verbose=verbose)
-            ids.append(request_id)
+        concurrency = self.config.get("concurrency") or 8
+        # made before the threads, boto3 sessions are not thread-safe.
+        for region in {config.get("region") for _, config, _ in requests}:
+            ec2_client(region, concurrency)
+
+        def launch(request):
+            fn, config, indices = request
+            client = ec2_client(config.get("region"), concurrency)
+            launched = fn(**config, count=len(indices), client=client, verbose=verbose)
+            return [launched] if isinstance(launched, str) else launched
+
+        ids, errors = [None] * len(self.instance_plan), []
+        with ThreadPoolExecutor(concurrency) as pool:
+            for (_, config, indices), (launched, error) in zip(requests, pool.map(_capture(launch), requests)):
+                if error is not None:
+                    errors.append(f"{len(indices)} x {config.get('instance_type')} in {config.get('region')}: {error}")
+                    continue
+                for i, launch_id in zip(indices, launched):
+                    ids[i] = launch_id
 
         self.instance_plan.clear()
+        if errors:
+            launched = [i for i in ids if i is not None]
+            raise RuntimeError("ec2 launch failed\n" + "\n".join(errors) + f"\nlaunched: {launched}")
         return ids
 
 
-def launch_ec2(launch_script, image_id, instance_type, key_name, security_group, spot_price=None,
-               iam_instance_profile_arn=None, region=None, availability_zone=None,
-               dry=False, name=None, tags={}, verbose=False, **_):
-    from termcolor import cprint
+def _capture(fn):
+    """:return: fn that returns (result, None), or (None, error) when it raises, so that one request does not
+    stop the others."""
+
+    def wrapped(*args):
+        try:
+            return fn(*args), None
+        except Exception as e:
+            return None, e
+
+    return wrapped
+
+
+@lru_cache(maxsize=None)
+def ec2_client(region=None, concurrency=8):
+    """
+    one client per region, shared by the threads. Adaptive retries back off on RequestLimitExceeded, and rate
+    limit the requests on the client side once EC2 starts to throttle.
+    """
     import boto3
-    if verbose:
-        print('Using the default AWS Profile')
+    from botocore.config import Config
+
+    config = Config(max_pool_connections=max(10, concurrency), retries=dict(mode="adaptive", max_attempts=10))
+    return boto3.session.Session().client("ec2", region_name=region, config=config)
 
+
+def instance_spec(image_id, instance_type, key_name, security_group, iam_instance_profile_arn=None,
+                  availability_zone=None, name=None, tags={}, **_):
+    """:return: (the launch specification, the tags) of the instances."""
     instance_config = dict(ImageId=image_id, KeyName=key_name, InstanceType=instance_type,
                            SecurityGroups=(security_group,),
                            IamInstanceProfile={'Arn': iam_instance_profile_arn})
@@ -61,10 +153,24 @@ def launch_ec2(launch_script, image_id, instance_type, key_name, security_group,
     tags = {snake2camel(k): v for k, v in tags.items()}
     if name:
         tags["Name"] = name
-    tag_str = [dict(Key=k, Value=v) for k, v in tags.items()]
+    return instance_config, [dict(Key=k, Value=v) for k, v in tags.items()]
+
+
+def launch_ec2(launch_script, spot_price=None, region=None, dry=False, verbose=False, count=1, client=None, **spec):
+    """
+    :param count: the number of instances, all with this launch script, in one request.
+    :param client: the ec2 client, see ec2_client.
+    :param spec: the launch spec, see instance_spec.
+    :return: the spot request id, or the instance id. A list of the count ids when count is more than 1.
+    """
+    from termcolor import cprint
+    if verbose:
+        print('Using the default AWS Profile')
+
+    instance_config, tag_str = instance_spec(**spec)
 
     # note: region needs to agree with availability_zone.
-    ec2 = boto3.client("ec2", region_name=region)
+    ec2 = client or ec2_client(region)
     if spot_price:
         # for detailed settings see:
         #     http://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Client.request_spot_instances
@@ -72,26 +178,86 @@ def launch_ec2(launch_script, image_id, instance_type, key_name, security_group,
         instance_config.update(UserData=base64.b64encode(launch_script.encode()).decode("utf-8"))
         if verbose:
             print(instance_config)
+        # the tags are applied with the request, instead of a create_tags call after.
+        tag_spec = dict(TagSpecifications=[dict(ResourceType="spot-instances-request", Tags=tag_str)]) if tag_str else {}
         response = ec2.request_spot_instances(
-            InstanceCount=1, LaunchSpecification=instance_config,
-            SpotPrice=str(spot_price), DryRun=dry)
-        spot_request_id = response['SpotInstanceRequests'][0]['SpotInstanceRequestId']
+            InstanceCount=count, LaunchSpecification=instance_config,
+            SpotPrice=str(spot_price), DryRun=dry, **tag_spec)
+        ids = [r['SpotInstanceRequestId'] for r in response['SpotInstanceRequests']]
         if verbose:
             import yaml
             print(yaml.dump(response))
-        if tags:
-            ec2.create_tags(DryRun=dry, Resources=[spot_request_id], Tags=tag_str)
-        cprint(f'made instance request {spot_request_id}', 'blue')
-        return spot_request_id
+        cprint(f'made instance request {", ".join(ids)}', 'blue')
     else:
         instance_config.update(UserData=launch_script)
         if verbose:
             print(instance_config)
-        response = ec2.run_instances(MaxCount=1, MinCount=1, **instance_config, DryRun=dry)
-        instance_id = response['Instances'][0]['InstanceId']
+        tag_spec = dict(TagSpecifications=[dict(ResourceType="instance", Tags=tag_str)]) if tag_str else {}
+        response = ec2.run_instances(MaxCount=count, MinCount=count, **instance_config, DryRun=dry, **tag_spec)
+        ids = [i['InstanceId'] for i in response['Instances']]
         if verbose:
             print(response)
-        if tags:
-            ec2.create_tags(DryRun=dry, Resources=[instance_id], Tags=tag_str)
-        cprint(f'launched instance {instance_id}', 'green')
-        return instance_id
+        cprint(f'launched instance {", ".join(ids)}', 'green')
+    return ids[0] if count == 1 else ids
+
+
+def table_script(table, offset=0, cache_dir="/var/cache/jaynes/scripts"):
+    """
+    :param table: the reference to the table of the launch scripts in the thunk store, one reference per line.
+    :param offset: the row of the instance with launch index 0.
+    :return: the bootstrap stub that runs the script in the row of the ami-launch-index of the instance.
+    """
+    return "\n".join([
+        "#!/bin/bash",
+        "# the launch scripts are in the thunk store. The table lists them in the order of the ami-launch-index.",
+        bootstrap_fetch(table.split("://", 1)[0], "ec2", cache_dir),
+        # IMDSv2, which takes a session token, and which is the only version on instances that require it.
+        'JAYNES_IMDS_TOKEN="$(curl -sf -X PUT -H "X-aws-ec2-metadata-token-ttl-seconds: 300" '
+        'http://169.254.169.254/latest/api/token)" || jaynes_fail "could not get a metadata token"',
+        'JAYNES_INDEX="$(curl -sf -H "X-aws-ec2-metadata-token: $JAYNES_IMDS_TOKEN" '
+        'http://169.254.169.254/latest/meta-data/ami-launch-index)" || jaynes_fail "could not read the ami-launch-index"',
+        f"jaynes_fetch {table}",
+        f'JAYNES_REF="$(sed -n "$((JAYNES_INDEX + {offset} + 1))p" $JAYNES_PATH)"',
+        '[ -n "$JAYNES_REF" ] || jaynes_fail "no launch script for the index $JAYNES_INDEX"',
+        "jaynes_fetch $JAYNES_REF",
+        "exec /bin/bash $JAYNES_PATH",
+        "",
+    ])
+
+
+def launch_table(table, count, spot_price=None, region=None, dry=False, verbose=False, client=None, **spec):
+    """
+    launches count instances in one request, each of which runs a row of the table, see table_script. Spot
+    instances go through run_instances as well, because the launch index only counts within one reservation.
+    When EC2 does not have the capacity for all of them, launches what it has, and the rest with the next requests.
+
+    :return: the instance ids, in the order of the table.
+    """
+    from termcolor import cprint
+
+    instance_config, tag_str = instance_spec(**spec)
+    if spot_price:
+        instance_config["InstanceMarketOptions"] = dict(MarketType="spot", SpotOptions=dict(
+            MaxPrice=str(spot_price), SpotInstanceType="one-time", InstanceInterruptionBehavior="terminate"))
+    tag_spec = dict(TagSpecifications=[dict(ResourceType="instance", Tags=tag_str)]) if tag_str else {}
+
+    from botocore.exceptions import ClientError
+
+    ec2 = client or ec2_client(region)
+    ids, min_count = [], count
+    while len(ids) < count:
+        instance_config.update(UserData=table_script(table, offset=len(ids)))
+        if verbose:
+            print(instance_config)
+        remaining = count - len(ids)
+        try:
+            response = ec2.run_instances(MinCount=min(min_count, remaining), MaxCount=remaining, **instance_config,
+                                         DryRun=dry, **tag_spec)
+        except ClientError as e:
+            if min_count == 1 or e.response["Error"]["Code"] != "InsufficientInstanceCapacity":
+                raise
+            min_count = 1
+            continue
+        ids += [i['InstanceId'] for i in sorted(response['Instances'], key=lambda i: i['AmiLaunchIndex'])]
+    cprint(f'launched instance {", ".join(ids)}', 'green')
+    return ids
@@ -146,6 +146,7 @@ class GCE(Launcher):
         launch_script = make_launch_script(runners=self.runners, mounts=self.all_mounts,
                                            unpack_on_host=True, **self.config)
         launch_config = self.runners[0].launch_config
+        launch_script = self.instance_script(launch_script, "gce", [p for r in self.runners for p in r.payloads or []])
         self.runners.clear()
 
         if verbose:
@@ -156,12 +157,14 @@ class GCE(Launcher):
         instance_config = gce_instance_config(launch_script, **launch_config)
         request = compute.instances().insert(**instance_config)
 
+        self.flush(verbose=verbose)
         return request.execute()['id']
 
     def plan_instance(self, verbose=None):
         launch_script = make_launch_script(runners=self.runners, mounts=self.all_mounts,
                                            unpack_on_host=True, **self.config)
         launch_config = self.runners[0].launch_config
+        launch_script = self.instance_script(launch_script, "gce", [p for r in self.runners for p in r.payloads or []])
         self.runners.clear()
 
         if verbose:
@@ -176,5 +179,6 @@ class GCE(Launcher):
         if self._gce_batch_request is None:
             return self.launch_instance(verbose=verbose)
         self.plan_instance(verbose=verbose)
+        self.flush(verbose=verbose)
         # todo: needs to return a list of request_ids.
         self.gce_batch_request.execute()
@@ -7,6 +7,7 @@ from jaynes.runners import Runner
 
 class Kube(Launcher):
     jobs = None
+    _client = None
 
     def __init__(
         self,
@@ -14,13 +15,38 @@ class Kube(Launcher):
         verbose=False,
         name=None,
         tags={},
+        kubeconfig=None,
+        context=None,
+        server=None,
+        token=None,
+        concurrency=8,
+        chunk_size=100,
+        dry=False,
         **_,
     ):
+        """
+        :param namespace: the namespace of the jobs. Default to the namespace of the context, or of the service
+                          account inside a cluster.
+        :param kubeconfig: the path to the kubeconfig. Default to $KUBECONFIG, then ~/.kube/config.
+        :param context: the context in the kubeconfig. Default to the current context.
+        :param server: the url of the API server, instead of the kubeconfig, e.g. with token.
+        :param token: the bearer token for the server.
+        :param concurrency: the number of jobs that are applied at the same time.
+        :param chunk_size: the number of jobs that are queued at a time.
+        :param dry: only write the yaml file of the jobs, and do not submit them.
+        """
         super().__init__(
             namespace=namespace,
             verbose=verbose,
             name=name or f"jaynes-job-{datetime.utcnow():%H%M%S}-{jaynes.RUN.count}",
             tags=tags,
+            kubeconfig=kubeconfig,
+            context=context,
+            server=server,
+            token=token,
+            concurrency=concurrency,
+            chunk_size=chunk_size,
+            dry=dry,
             **_,
         )
 
@@ -37,40 +63,90 @@ class Kube(Launcher):
     def plan_instance(self, verbose=False):
         while self.last_runner:
             runner = self.runners.pop(-1)
-            runner.job["metadata"]["namespace"] = runner.launch_config["namespace"]
-            self.jobs.append(runner.job)
-
-            if verbose:
-                print(runner.job)
-
-    def execute(self, verbose=None):
+            for obj in runner.manifests:
+                # without one, the client applies the job in its namespace.
+                if runner.launch_config["namespace"]:
+                    obj["metadata"]["namespace"] = runner.launch_config["namespace"]
+                self.jobs.append(obj)
+
+                if verbose:
+                    print(obj)
+
+    @property
+    def client(self):
+        """the API client of the launcher, with one connection pool for the submission and the watchers."""
+        if self._client is None:
+            from jaynes.kube import KubeClient
+
+            config = self.config
+            # the log streams of a Monitor hold a connection each.
+            self._client = KubeClient(server=config.get("server"), token=config.get("token"),
+                                      kubeconfig=config.get("kubeconfig"), context=config.get("context"),
+                                      namespace=config.get("namespace"),
+                                      pool_size=max(config.get("concurrency") or 8, 32))
+        return self._client
+
+    def watcher(self):
+        """:return: the jaynes.wait watcher for the jobs of this launcher."""
+        from jaynes.wait import KubeJobs
+
+        return KubeJobs(namespace=self.client.namespace, client=self.client)
+
+    def follow(self, jobs, logs=True, timeout=None, **kwargs):
+        """
+        prints the phase transitions of the jobs and of their pods, and the logs of the pods, until the jobs
+        finish. See jaynes.kube.Monitor for the kwargs.
+
+        :param jobs: the names returned by execute.
+        :return: the states of the jobs.
+        """
+        from jaynes.kube import Monitor
+
+        return Monitor(self.client, jobs, self.client.namespace, logs=logs, **kwargs).run(timeout)
+
+    def dump(self, path=None):
+        """writes the jobs out as a multi-document yaml file, for review or for kubectl. :return: the path."""
         import yaml
 
-        self.plan_instance(verbose=verbose)
+        if path is None:
+            from tempfile import NamedTemporaryFile
 
-        from tempfile import NamedTemporaryFile
+            with NamedTemporaryFile(mode="w+", suffix="jaynes-kube.yaml", delete=False) as f:
+                path = f.name
+        with open(path, "w") as f:
+            yaml.dump_all(self.jobs, f, default_flow_style=False)
+        return path
 
-        # packing all jobs into one request and launch
-        with NamedTemporaryFile(
-            mode="w+",
-            suffix="jaynes-kube.yaml",
-            delete=not verbose,
-        ) as config_file:
-            yaml.dump_all(self.jobs, config_file, default_flow_style=False)
+    def execute(self, verbose=None):
+        """
+        applies the jobs through the Kubernetes API, concurrency at a time. With dry, writes the yaml file and
+        submits nothing. The ConfigMap of an indexed job is then owned by the job, and deleted with it.
 
+        :return: the names of the jobs, or the path to the yaml file with dry.
+        """
+        self.plan_instance(verbose=verbose)
+        if self.config.get("dry"):
+            path = self.dump()
             self.jobs.clear()
-
-            if verbose:
-                print("dumping the kubernetes job yaml file to " + config_file.name)
-
-            from subprocess import Popen, PIPE
-
-            proc = Popen("kubectl apply -f " + config_file.name, shell=True, stdout=PIPE)
-            outs = []
-            while True:
-                out = proc.stdout.read1().decode("utf-8")
-                outs.append(out[:-8])
-                print(out, end="")
-                if out == "":
-                    break
-            return outs
+            print("dumping the kubernetes job yaml file to " + path)
+            return path
+
+        from jaynes.kube import JOB_LABEL
+
+        results = self.client.apply_all(self.jobs, concurrency=self.config.get("concurrency") or 8,
+                                        chunk_size=self.config.get("chunk_size") or 100, verbose=verbose)
+        errors = {name: error for name, error in results if error is not None}
+        jobs = {obj["metadata"]["name"]: obj for obj in self.jobs if obj["kind"] == "Job"}
+        for obj in self.jobs:
+            name, job = obj["metadata"]["name"], obj["metadata"].get("labels", {}).get(JOB_LABEL)
+            if obj["kind"] == "ConfigMap" and job in jobs and not ({name, job} & errors.keys()):
+                try:
+                    self.client.adopt(obj, jobs[job])
+                except Exception as e:
+                    errors[name] = e
+        self.jobs.clear()
+
+        if errors:
+            raise RuntimeError(f"{len(errors)} of {len(results)} kubernetes jobs failed\n"
+                               + "\n".join(f"{name}: {error}" for name, error in errors.items()))
+        return list(jobs)
@@ -17,6 +17,7 @@ def launch_local_docker(mounts, runners, unpack_host=True, log_dir="/tmp/jaynes-
         [m.host_setup for m in mounts if hasattr(m, "host_setup") and m.host_setup]
     )
 
+    runners[0].pack_table()
     remote_script = dedent(f"""
 #!/bin/bash
 # to allow process substitution
@@ -0,0 +1,36 @@
+from jaynes.launchers.base_launcher import Launcher
+
+
+class Queue(Launcher):
+    """
+    Submits the thunks to warm workers that pull from a queue, instead of starting new processes. Start the
+    workers with :code:`python -m jaynes.entry --worker <source> --queue <queue>`.
+
+    .. code:: yaml
+
+        launch: !ENV
+          type: queue
+          source: http://my-gpu-box:8092  # or a directory on a shared file system
+          queue: eval
+
+    :param source: the url of a Jaynes server, or a queue directory.
+    :param queue: the name of the queue.
+    :param token: the token of the Jaynes server.
+    """
+
+    def __init__(self, source, queue="default", token=None, **kwargs):
+        super().__init__(source=source, queue=queue, token=token, **kwargs)
+
+    # the runners are collected until execute, and submitted in one request.
+    def plan_instance(self, verbose=None):
+        pass
+
+    def execute(self, verbose=None):
+        """:return: the task ids of the submitted thunks."""
+        from jaynes.queues import open_queue
+
+        thunks = [thunk for runner in self.runners for thunk in runner.payloads]
+        self.runners.clear()
+        if verbose:
+            print(f"submitting {len(thunks)} thunks to {self.config['source']} {self.config['queue']}")
+        return open_queue(self.config['source'], self.config['queue'], token=self.config['token']).put(*thunks)
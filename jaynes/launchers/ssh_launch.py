@@ -134,6 +134,10 @@ class SSH(Launcher):
         pass
 
     def execute(self, verbose=None):
+        """:return: the array job ids with Slurm job arrays, what ssh returns otherwise."""
+        from jaynes.runners import Slurm
+
+        arrays = any(isinstance(r, Slurm) and r.pack is not None for r in self.runners)
         self.launch_script = make_launch_script(
             runners=self.runners, mounts=self.all_mounts, unpack_on_host=self.host_unpacked, **self.config
         )
@@ -141,4 +145,10 @@ class SSH(Launcher):
         if verbose:
             print(self.launch_script)
 
-        return ssh(self.launch_script, **self.config)
+        if not arrays or self.config.get("dry"):
+            return ssh(self.launch_script, **self.config)
+        # the array job ids are in the output of sbatch, which returns as soon as the jobs are queued.
+        stdout, stderr = ssh(self.launch_script, **dict(self.config, block=True))
+        sys.stdout.write(stdout.decode(errors="replace"))
+        sys.stderr.write(stderr.decode(errors="replace"))
+        return Slurm.job_ids(stdout)
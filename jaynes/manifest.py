@@ -0,0 +1,146 @@
+"""
+File manifests for a local directory tree.
+
+A manifest maps the relative path of every file that is not excluded to its
+:code:`(mtime_ns, size, sha256)`. Files whose mtime and size did not change since the
+previous scan reuse the previous digest, so a rescan only reads the files that were touched.
+"""
+import hashlib
+import os
+import shlex
+from collections import namedtuple
+from fnmatch import fnmatch
+
+Entry = namedtuple("Entry", ["mtime_ns", "size", "sha256"])
+
+DEFAULT_EXCLUDES = ("*__pycache__", "*.git", "*.idea", "*.egg-info")
+
+# the list GNU tar uses for --exclude-vcs
+VCS_EXCLUDES = ("CVS", "RCS", "SCCS", ".git", ".gitignore", ".gitmodules", ".gitattributes", ".cvsignore",
+                ".svn", ".arch-ids", "{arch}", "=RELEASE-ID", "=meta-update", "=update", ".bzr", ".bzrignore",
+                ".bzrtags", ".hg", ".hgignore", ".hgtags", "_darcs")
+
+
+def tar_excludes(tar_options):
+    """
+    Translates the exclude options of a tar command line into patterns.
+
+    :param tar_options: e.g. :code:`"--exclude='*__pycache__' --exclude-vcs --exclude-from='.gitignore'"`
+    :return: the list of exclude patterns.
+    """
+    patterns = []
+    args = shlex.split(tar_options or "")
+    for i, arg in enumerate(args):
+        if arg.startswith("--exclude="):
+            patterns.append(arg[len("--exclude="):])
+        elif arg == "--exclude" and i + 1 < len(args):
+            patterns.append(args[i + 1])
+        elif arg == "--exclude-vcs":
+            patterns.extend(VCS_EXCLUDES)
+        elif arg.startswith("--exclude-from="):
+            with open(arg[len("--exclude-from="):], "r") as f:
+                patterns.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    return patterns
+
+
+def is_excluded(rel_path, excludes):
+    """
+    Follows the default (unanchored) semantics of :code:`tar --exclude`: a pattern excludes a
+    path when it matches any sequence of its components, or its leading directories.
+    """
+    parts = rel_path.split("/")
+    for i in range(len(parts)):
+        for j in range(i + 1, len(parts) + 1):
+            sub_path = "/".join(parts[i:j])
+            if any(fnmatch(sub_path, pattern) for pattern in excludes):
+                return True
+    return False
+
+
+def walk(root, excludes=DEFAULT_EXCLUDES, include_dirs=False):
+    """
+    yields the relative paths of the files under root, pruning excluded directories.
+
+    :param include_dirs: also yield the directories before their content, and the symlinks to directories,
+        the way tar lists them.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+        rel_dir = "" if rel_dir == "." else rel_dir + "/"
+        # like tar, symlinks to directories are listed as links, and not followed.
+        links = [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]
+        dirnames[:] = sorted(d for d in dirnames if d not in links and not is_excluded(rel_dir + d, excludes))
+        if include_dirs and rel_dir:
+            yield rel_dir[:-1]
+        for name in sorted(filenames + links if include_dirs else filenames):
+            rel_path = rel_dir + name
+            if not is_excluded(rel_path, excludes):
+                yield rel_path
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def scan(root, excludes=DEFAULT_EXCLUDES, previous=None):
+    """
+    :param root: the directory to scan.
+    :param excludes: tar-style exclude patterns.
+    :param previous: the last manifest. Digests of files with the same mtime and size are reused.
+    :return: the manifest, a dictionary from relative paths to entries.
+    """
+    previous = previous or {}
+    manifest = {}
+    for rel_path in walk(root, excludes):
+        try:
+            stat = os.stat(os.path.join(root, rel_path))
+        except FileNotFoundError:
+            # deleted in the middle of the scan.
+            continue
+        old = previous.get(rel_path)
+        if old and old.mtime_ns == stat.st_mtime_ns and old.size == stat.st_size:
+            manifest[rel_path] = old
+        else:
+            try:
+                sha256 = file_sha256(os.path.join(root, rel_path))
+            except FileNotFoundError:
+                continue
+            manifest[rel_path] = Entry(stat.st_mtime_ns, stat.st_size, sha256)
+    return manifest
+
+
+def fingerprint(root, file_mask=".", excludes=DEFAULT_EXCLUDES, salt=""):
+    """
+    A fast fingerprint of a tree, from the path, size and mtime of every file. Does not read the
+    file content, in the spirit of the rsync quick check.
+
+    :param root: the directory tar runs in.
+    :param file_mask: the space separated paths under root that tar packs.
+    :param excludes: tar-style exclude patterns.
+    :param salt: anything else that changes the tar ball, such as the tar options.
+    :return: 32 hex characters, short enough for kubernetes names.
+    """
+    hasher = hashlib.sha256(salt.encode())
+    for mask in file_mask.split():
+        path = os.path.normpath(os.path.join(root, mask))
+        rel_paths = walk(path, excludes) if os.path.isdir(path) else [""]
+        for rel_path in rel_paths:
+            try:
+                stat = os.stat(os.path.join(path, rel_path) if rel_path else path)
+            except FileNotFoundError:
+                continue
+            hasher.update(f"{mask}/{rel_path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return hasher.hexdigest()[:32]
+
+
+def diff(old, new):
+    """
+    :return: (changed, deleted). Files that were only touched, with the same content, are not changed.
+    """
+    changed = [p for p, e in new.items() if p not in old or old[p].sha256 != e.sha256]
+    deleted = [p for p in old if p not in new]
+    return changed, deleted
@@ -1,24 +1,160 @@
 import os
+import subprocess
+import sys
 from os.path import join as pathJoin
 from textwrap import dedent
 from uuid import uuid4
 
-from jaynes.shell import check_call
+from jaynes.shell import call, check_call, popen
 
-from .helpers import get_temp_dir
+from .helpers import get_cache_dir
+from .manifest import fingerprint, tar_excludes
+
+# tar balls are kept in an LRU cache up to this many bytes, so that re-launching unchanged code skips packing.
+TAR_CACHE_SIZE = int(os.environ.get("JAYNES_TAR_CACHE_SIZE", 4 << 30))
+
+DEFAULT_EXCLUDES = "--exclude='*__pycache__' --exclude='*.git' --exclude='*.idea' --exclude='*.egg-info'"
+
+
+def tree_digest(local_abs, file_mask, excludes, tar_options, compress):
+    """fingerprints the files tar would pack, together with the options it packs them with."""
+    options = f"{excludes} {tar_options}"
+    return fingerprint(local_abs, file_mask, tar_excludes(options), salt=f"{options} {file_mask} {compress}")
+
+
+def prune_tar_cache(max_bytes=None, since=None):
+    """
+    removes the least recently used tar balls until the cache fits in max_bytes, default to TAR_CACHE_SIZE.
+
+    :param since: a timestamp. Keeps the tar balls used since then, e.g. by the uploads of the current launch or
+        of a launch running next to it.
+    """
+    entries = []
+    for entry in os.scandir(get_cache_dir("tarballs")):
+        try:
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            pass  # removed by another launch.
+    max_bytes = TAR_CACHE_SIZE if max_bytes is None else max_bytes
+    total = 0
+    for mtime, size, path in sorted(entries, reverse=True):
+        total += size
+        if total > max_bytes and (since is None or mtime < since):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def make_packer(packer, local_abs, file_mask, excludes, tar_options, extra_options, compress):
+    """
+    :param packer: "python" packs in-process, on all cores, and streams the tar ball into the upload. "tar" shells
+        out to tar. "auto" packs in-process, unless there are tar options other than excludes, or the file_mask has
+        wildcards, which the shell expands for tar.
+    :param extra_options: the tar options passed as keyword arguments to the mount.
+    :return: a Packer, or None to use tar.
+    """
+    if packer == "tar" or packer == "auto" and (extra_options or any(c in file_mask for c in "*?[")):
+        return None
+    from .packer import Packer
+    return Packer(local_abs, file_mask, tar_excludes(f"{excludes} {tar_options}"), compress=compress)
+
+
+def gs_url(prefix):
+    """the GSCode prefix is documented without the gs:// scheme, the storage api needs it."""
+    return prefix if prefix.startswith("gs://") else f"gs://{prefix}"
+
+
+def unpack_once(digest, host_path, script):
+    """skips the download and unpacking on hosts that already unpacked this digest."""
+    marker = pathJoin(host_path, f".jaynes-{digest}")
+    return f"""
+                    if [ -f {marker} ]; then
+                        echo "{host_path} is already unpacked"
+                    else
+                    {script.strip()}
+                    touch {marker}
+                    fi
+                    """
 
 
 class Mount:
     local_script = None
+    local_tar = None
+
+    # with an in-process packer, the tar ball is piped into the stream_script, unless the exists_script succeeds.
+    packer = None
+    exists_script = None
+    stream_script = None
+
+    # with transfer="python", local_file is uploaded to remote_url in-process, instead of with the cli.
+    transfer = "cli"
+    transfer_options = None
+    remote_url = None
+    local_file = None
+    tar_script = None
 
     # used by kubernetes
     init_container = None
     volume_mount = None
 
+    def key_on_tree(self, local_abs, file_mask, excludes, tar_options, extra_options, compress, packer):
+        """
+        keys the tar ball on the tree, so that unchanged code is neither re-packed nor re-uploaded. Sets the digest,
+        None when local_abs is not a directory, and the packer of the tree.
+        """
+        self.digest = None
+        if os.path.isdir(local_abs):
+            self.digest = tree_digest(local_abs, file_mask, excludes, tar_options, compress)
+            self.packer = make_packer(packer, local_abs, file_mask, excludes, tar_options, extra_options, compress)
+        return self.digest
+
     def upload(self, verbose=None, **_):
+        if self.transfer == "python" and self.remote_url:
+            return self.transfer_upload(verbose=verbose)
+        if self.packer and self.stream_script:
+            return self.stream_upload(verbose=verbose)
         if self.local_script is None:
             return
         assert not check_call(dedent(self.local_script or ""), verbose=verbose, shell=True)
+        self.touch_cache()
+
+    def touch_cache(self):
+        if self.local_tar and os.path.exists(self.local_tar):
+            # mark as recently used. The cache is pruned after all the uploads, see Jaynes.upload_mount.
+            os.utime(self.local_tar)
+
+    def stream_upload(self, verbose=None):
+        """packs in-process, and pipes the tar ball into the upload command, so that packing and transfer overlap."""
+        if self.exists_script and not call(self.exists_script, verbose=verbose, shell=True,
+                                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL):
+            print(f"{self.digest} is already uploaded")
+            return
+        proc = popen(self.stream_script, verbose=verbose, shell=True, stdin=subprocess.PIPE, bufsize=0)
+        try:
+            self.packer.pack(proc.stdin, verbose=verbose)
+        except BrokenPipeError:
+            pass  # the upload command exited early, the exit code says why.
+        finally:
+            proc.stdin.close()
+        assert proc.wait() == 0, f"streaming upload failed: {self.stream_script}"
+
+    def transfer_upload(self, verbose=None):
+        """uploads with multipart, parallel transfers, without the start up cost of the aws and gsutil clis."""
+        from . import transfer
+
+        if self.digest and transfer.exists(self.remote_url, **self.transfer_options):
+            print(f"{self.digest} is already uploaded")
+            return
+        if self.packer:
+            return transfer.upload_stream(lambda sink: self.packer.pack(sink, verbose=verbose), self.remote_url,
+                                          **self.transfer_options)
+        if self.tar_script:
+            assert not check_call(dedent(self.tar_script), verbose=verbose, shell=True)
+        transfer.upload(self.local_file, self.remote_url, **self.transfer_options)
+        self.touch_cache()
 
 
 class Host(Mount):
@@ -68,8 +204,9 @@ class S3Code(Mount):
 
     :param local_path: path to the local directory. Doesn't have to be absolute.
     :param prefix: The s3 prefix including the s3: protocol, the bucket, and the path prefix.
-    :param host_path: The path on the remote instance. Default /tmp/{uuid4()}
-    :param name: the name for the tar ball. Default to {uuid4()}
+    :param host_path: The path on the remote instance. Default /tmp/{name}
+    :param name: the name of the mount, used for the default host path. Default to the fingerprint of the directory,
+                 so that hosts which already unpacked the same code skip the download.
     :param container_path: The path for the docker instance. Can be something like /Users/ge/project-folder/blah
     :param remote_tar: we usually automatically generate this so you do not have to provide it manually.
     :param pypath (bool): Whether this directory should be added to the python path
@@ -83,6 +220,12 @@ class S3Code(Mount):
     :param region: The region to upload the s3 object to. Default to None.
     :param exclude_vcs: Whether to exclude version control files. Default to True.
     :param exclude_from: The path to the file containing the exclude patterns. Default to None.
+    :param packer: "auto", "python" or "tar". The python packer compresses on all cores and streams the tar ball
+                   straight into the upload. "auto" falls back to tar when there are extra tar options.
+    :param transfer: "cli" uploads with the aws cli. "python" uploads in-process with boto3, in parallel parts.
+    :param endpoint_url: the url of an S3 compatible endpoint, such as MinIO. Default to AWS.
+    :param part_size: the multipart part size in bytes, for transfer="python". Default to 8 MB.
+    :param concurrency: the number of parts transferred at once, for transfer="python". Default to 8.
 
     :param cpu: The cpu request for the init container. Default to 1.
     :param mem: The memory request for the init container. Default to "1Gi".
@@ -114,6 +257,11 @@ class S3Code(Mount):
         region=None,
         exclude_vcs=True,
         exclude_from=None,
+        packer="auto",
+        transfer="cli",
+        endpoint_url=None,
+        part_size=None,
+        concurrency=None,
         cpu=1,
         mem="1Gi",
         **tar_options,
@@ -124,6 +272,7 @@ class S3Code(Mount):
         local_path = os.path.expandvars(local_path)
         local_abs = os.path.join(RUN.config_root, local_path)
 
+        extra_options = tar_options
         tar_options = " ".join([f"--{key.replace('_', '-')}={value}" for key, value in tar_options.items()])
         if exclude_vcs:
             tar_options += " --exclude-vcs"
@@ -131,7 +280,16 @@ class S3Code(Mount):
             ignore_file_path = os.path.join(RUN.config_root, exclude_from)
             tar_options += f" --exclude-from='{ignore_file_path}'"
 
-        name = name or str(uuid4())
+        file_mask = file_mask or "."  # file_mask can Not be None or "".
+        excludes = excludes or DEFAULT_EXCLUDES
+        self.key_on_tree(local_abs, file_mask, excludes, tar_options, extra_options, compress, packer)
+
+        endpoint = f"--endpoint-url {endpoint_url}" if endpoint_url else ""
+        self.transfer = transfer
+        self.transfer_options = dict(endpoint_url=endpoint_url, region=region, acl=acl)
+        self.transfer_options.update({k: v for k, v in dict(part_size=part_size, concurrency=concurrency).items() if v})
+
+        name = name or self.digest or str(uuid4())
 
         sub_path = sub_path or name
         mount_path = mount_path or "/tmp"
@@ -144,38 +302,48 @@ class S3Code(Mount):
         else:
             self.container_path = local_abs
 
-        if os.path.isdir(local_path):
-            file_mask = file_mask or "."  # file_mask can Not be None or "".
-            excludes = excludes or "--exclude='*__pycache__' --exclude='*.git' --exclude='*.idea' --exclude='*.egg-info'"
-
-            tar_name = f"{name}.tar"
-            self.temp_dir = get_temp_dir()
-            local_tar = pathJoin(self.temp_dir, tar_name)
+        if self.digest:
+            tar_name = f"{self.digest}.tar"
+            self.temp_dir = get_cache_dir("tarballs")
+            self.local_tar = local_tar = pathJoin(self.temp_dir, tar_name)
 
+            self.tar_script = f"""
+                        type gtar >/dev/null 2>&1 && alias tar=`which gtar`
+                        mkdir -p {self.temp_dir}
+                        # Do not use absolute path in tar.
+                        [ -f {local_tar} ] || {{ tar {excludes} {tar_options} -c{"z" if compress else ""}f {local_tar}.part -C {local_abs} {file_mask} && mv {local_tar}.part {local_tar}; }}
+                    """
             self.local_script = f"""
-                    type gtar >/dev/null 2>&1 && alias tar=`which gtar`
-                    mkdir -p {self.temp_dir}
-                    # Do not use absolute path in tar.
-                    tar {excludes} {tar_options} -c{"z" if compress else ""}f {local_tar} -C {local_abs} {file_mask}
-                    aws s3 cp {local_tar} {prefix}/{tar_name} {'--acl {}'.format(acl) if acl else ''} {'--region {}'.format(region) if region else ''}
+                    if aws s3 ls {prefix}/{tar_name} {'--region {}'.format(region) if region else ''} {endpoint} >/dev/null 2>&1; then
+                        echo "{tar_name} is already uploaded"
+                    else
+                        {self.tar_script.strip()}
+                        aws s3 cp {local_tar} {prefix}/{tar_name} {'--acl {}'.format(acl) if acl else ''} {'--region {}'.format(region) if region else ''} {endpoint}
+                    fi
                     """
+            self.local_file = local_tar
+            self.remote_url = f"{prefix}/{tar_name}"
+            self.exists_script = f"aws s3 ls {prefix}/{tar_name} {'--region {}'.format(region) if region else ''} {endpoint}"
+            self.stream_script = f"aws s3 cp - {prefix}/{tar_name} {'--acl {}'.format(acl) if acl else ''} {'--region {}'.format(region) if region else ''} {endpoint}"
             remote_tar = remote_tar or f"/tmp/{tar_name}"
             self.host_path = host_path
-            self.host_setup = f"""
-                    aws s3 cp {pathJoin(prefix, tar_name)} {remote_tar} {'--no-sign-request' if no_signin else ''}
+            self.host_setup = unpack_once(self.digest, host_path, f"""
+                    aws s3 cp {pathJoin(prefix, tar_name)} {remote_tar} {'--no-sign-request' if no_signin else ''} {endpoint}
                     mkdir -p {host_path}
                     tar -{"z" if compress else ""}xf {remote_tar}{tar_name if remote_tar.endswith('/') else ""} -C {host_path}
-                    """
+                    """)
         else:
-            filename = os.path.basename(local_path)
+            filename = os.path.basename(local_abs)
             self.local_script = f"""
-                    aws s3 cp {local_path} {prefix}/{filename} {'--acl {}'.format(acl) if acl else ''} {'--region {}'.format(region) if region else ''}
+                    aws s3 cp {local_abs} {prefix}/{filename} {'--acl {}'.format(acl) if acl else ''} {'--region {}'.format(region) if region else ''} {endpoint}
                     """
+            self.local_file = local_abs
+            self.remote_url = f"{prefix}/{filename}"
             self.host_path = host_path
             host_dir = os.path.dirname(host_path)
             self.host_setup = f"""
                     mkdir -p {host_dir}
-                    aws s3 cp {prefix}/{filename} {host_path} {'--no-sign-request' if no_signin else ''}
+                    aws s3 cp {prefix}/{filename} {host_path} {'--no-sign-request' if no_signin else ''} {endpoint}
                     """
 
         self.pypath = pypath
@@ -239,8 +407,9 @@ class GSCode(Mount):
 
     :param local_path: path to the local directory. Doesn't have to be absolute.
     :param prefix: The GCS prefix including the bucket name, and the path prefix. Does not include gcp://
-    :param host_path: The path on the remote instance. Default /tmp/{uuid4()}
-    :param name: the name for the tar ball. Default to {uuid4()}
+    :param host_path: The path on the remote instance. Default /tmp/{name}
+    :param name: the name of the mount, used for the default host path. Default to the fingerprint of the directory,
+                 so that hosts which already unpacked the same code skip the download.
     :param container_path: The path for the docker instance. Can be something like /Users/ge/project-folder/blah
     :param pypath (bool): Whether this directory should be added to the python path
     :param excludes: The files paths to exclude, default to "--exclude='*__pycache__'"
@@ -248,6 +417,11 @@ class GSCode(Mount):
     :param compress: Whether to compress the tar ball. Default to true
     :param exclude_vcs: Whether to exclude version control files. Default to True.
     :param exclude_from: The path to the file containing the exclude patterns. Default to None.
+    :param packer: "auto", "python" or "tar". The python packer compresses on all cores and streams the tar ball
+                   straight into the upload. "auto" falls back to tar when there are extra tar options.
+    :param transfer: "cli" uploads with gsutil. "python" uploads in-process with google-cloud-storage, in parallel parts.
+    :param part_size: the multipart part size in bytes, for transfer="python". Default to 8 MB.
+    :param concurrency: the number of parts transferred at once, for transfer="python". Default to 8.
     :param cpu: The cpu request for the init container. Default to 1.
     :param mem: The memory request for the init container. Default to "1Gi".
     :return: self
@@ -274,6 +448,10 @@ class GSCode(Mount):
         compress=True,
         exclude_vcs=True,
         exclude_from=None,
+        packer="auto",
+        transfer="cli",
+        part_size=None,
+        concurrency=None,
         mem="1Gi",
         cpu=1,
         **tar_options,
@@ -284,6 +462,7 @@ class GSCode(Mount):
         local_path = os.path.expandvars(local_path)
         local_abs = os.path.join(RUN.config_root, local_path)
 
+        extra_options = tar_options
         tar_options = " ".join([f"--{key.replace('_', '-')}={value}" for key, value in tar_options.items()])
         if exclude_vcs:
             tar_options += " --exclude-vcs"
@@ -291,7 +470,14 @@ class GSCode(Mount):
             ignore_file_path = os.path.join(RUN.config_root, exclude_from)
             tar_options += f" --exclude-from='{ignore_file_path}'"
 
-        name = name or str(uuid4())
+        file_mask = file_mask or "."  # file_mask can Not be None or "".
+        excludes = excludes or DEFAULT_EXCLUDES
+        self.key_on_tree(local_abs, file_mask, excludes, tar_options, extra_options, compress, packer)
+
+        self.transfer = transfer
+        self.transfer_options = {k: v for k, v in dict(part_size=part_size, concurrency=concurrency).items() if v}
+
+        name = name or self.digest or str(uuid4())
 
         sub_path = sub_path or name
         mount_path = mount_path or "/tmp"
@@ -304,33 +490,43 @@ class GSCode(Mount):
         else:
             self.container_path = local_abs
 
-        if os.path.isdir(local_path):
-            file_mask = file_mask or "."  # file_mask can Not be None or "".
-            excludes = excludes or "--exclude='*__pycache__' --exclude='*.git' --exclude='*.idea' --exclude='*.egg-info'"
-
-            tar_name = f"{name}.tar"
-            self.temp_dir = get_temp_dir()
-            local_tar = pathJoin(self.temp_dir, tar_name)
+        if self.digest:
+            tar_name = f"{self.digest}.tar"
+            self.temp_dir = get_cache_dir("tarballs")
+            self.local_tar = local_tar = pathJoin(self.temp_dir, tar_name)
 
+            self.tar_script = f"""
+                        type gtar >/dev/null 2>&1 && alias tar=`which gtar`
+                        mkdir -p {self.temp_dir}
+                        # Do not use absolute path in tar.
+                        [ -f {local_tar} ] || {{ tar {excludes} {tar_options} -c{"z" if compress else ""}f {local_tar}.part -C {local_abs} {file_mask} && mv {local_tar}.part {local_tar}; }}
+                    """
             self.local_script = f"""
-                    type gtar >/dev/null 2>&1 && alias tar=`which gtar`
-                    mkdir -p {self.temp_dir}
-                    # Do not use absolute path in tar.
-                    tar {excludes} {tar_options} -c{"z" if compress else ""}f {local_tar} -C {local_abs} {file_mask}
-                    gsutil cp {local_tar} {prefix}/{tar_name}
+                    if gsutil -q stat {prefix}/{tar_name}; then
+                        echo "{tar_name} is already uploaded"
+                    else
+                        {self.tar_script.strip()}
+                        gsutil cp {local_tar} {prefix}/{tar_name}
+                    fi
                     """
+            self.local_file = local_tar
+            self.remote_url = f"{gs_url(prefix)}/{tar_name}"
+            self.exists_script = f"gsutil -q stat {prefix}/{tar_name}"
+            self.stream_script = f"gsutil cp - {prefix}/{tar_name}"
             remote_tar = remote_tar or f"/tmp/{tar_name}"
             self.host_path = host_path
-            self.host_setup = f"""
+            self.host_setup = unpack_once(self.digest, host_path, f"""
                     gsutil cp {pathJoin(prefix, tar_name)} {remote_tar}
                     mkdir -p {host_path}
                     tar -{"z" if compress else ""}xf {remote_tar}{tar_name if remote_tar.endswith('/') else ""} -C {host_path}
-                    """
+                    """)
         else:
-            filename = os.path.basename(local_path)
+            filename = os.path.basename(local_abs)
             self.local_script = f"""
-                    gsutil cp {local_path} {prefix}/{filename}
+                    gsutil cp {local_abs} {prefix}/{filename}
                     """
+            self.local_file = local_abs
+            self.remote_url = f"{gs_url(prefix)}/{filename}"
             self.host_path = host_path
             host_dir = os.path.dirname(host_path)
             self.host_setup = f"""
@@ -371,7 +567,8 @@ class GSCode(Mount):
 
 class S3Output(Mount):
     """
-    Mounting a remote directory to docker, and upload it's content periodically to s3.
+    Mounting a remote directory to docker, and upload it's content periodically to s3. Only the new and changed
+    files are uploaded on each sync.
 
     **To Avoid downloading to local during startup**: set local to None
 
@@ -386,13 +583,18 @@ class S3Output(Mount):
     :param name:
     :param prefix: Need slash at the end.
     :param local_path: When None, do not download those files
-    :param interval:
+    :param interval: seconds between two syncs. On hosts with inotify-tools, the host syncs on writes instead, at
+                     most once every interval seconds.
     :param pypath:
     :param sync_s3:
+    :param transfer: "cli" downloads with the aws cli. "python" downloads in-process with boto3, without the start
+                     up cost of the cli on every interval.
+    :param endpoint_url: the url of an S3 compatible endpoint, such as MinIO. Default to AWS.
     :return:
     """
 
-    def __init__(self, *, container_path, prefix, host_path=None, name=None, local_path=None, interval=15, pypath=False, sync_s3=True):
+    def __init__(self, *, container_path, prefix, host_path=None, name=None, local_path=None, interval=15, pypath=False, sync_s3=True,
+                 transfer="cli", endpoint_url=None):
         if host_path is None:
             host_path = f"/tmp/jaynes_mounts/{uuid4() if name is None else name}"
         else:
@@ -411,8 +613,14 @@ class S3Output(Mount):
             local_path = os.path.expandvars(local_path)
             local_abs = os.path.join(RUN.config_root, local_path)
 
-            download_script = f"""
-                aws s3 cp --recursive {prefix} {local_path} || echo "s3 bucket is EMPTY" """
+            endpoint = f"--endpoint-url {endpoint_url}" if endpoint_url else ""
+            if transfer == "python":
+                download_script = f"""
+                {sys.executable} -m jaynes.transfer sync {prefix} {local_path} {endpoint} || echo "s3 sync failed" """
+            else:
+                # sync only downloads the files that are new, or changed in size or mtime.
+                download_script = f"""
+                aws s3 sync {prefix} {local_path} {endpoint} --only-show-errors || echo "s3 bucket is EMPTY" """
             self.local_script = f"""
                 mkdir -p {local_abs}
                 while true; do
@@ -423,8 +631,21 @@ class S3Output(Mount):
         else:
             print("S3UploadMount(**{}) generated no local_script.".format(locals()))
             # pass
+        # sync only uploads what is new or changed since the last tick, instead of the whole directory.
         self.upload_script = f"""
-                aws s3 cp --recursive {host_path} {prefix} """  # --only-show-errors"""
+                aws s3 sync {host_path} {prefix} {f"--endpoint-url {endpoint_url}" if endpoint_url else ""} --only-show-errors """
+        # with inotify, the loop wakes up on writes instead of on a timer. The timeout is a fallback for
+        # the changes made while a sync is running, which inotifywait does not see.
+        wait_script = f"""
+                    if command -v inotifywait >/dev/null 2>&1; then
+                        inotifywait -qq -r -e close_write,moved_to,delete -t {max(interval or 0, 1) * 4} {host_path}
+                        # at most one sync every interval seconds. The sleep also lets a burst of writes settle,
+                        # e.g. a checkpoint and its metadata.
+                        wait_s=$(( last_sync + {interval or 1} - $(date +%s) ))
+                        sleep $(( wait_s > 1 ? wait_s : 1 ))
+                    else
+                        sleep {interval or 1}
+                    fi"""
         self.host_setup = f"""
                 echo 'making main_log directory {host_path}'
                 mkdir -p {host_path}
@@ -432,13 +653,14 @@ class S3Output(Mount):
             ""
             if not sync_s3
             else f"""
-                while true; do
+                while true; do {wait_script}
                     echo "uploading..." {self.upload_script}
-                    {f"sleep {interval}" if interval else ""}
+                    last_sync=$(date +%s)
                 done & echo "sync {host_path} initiated" 
                 while true; do
-                    if [ -z $(curl -Is http://169.254.169.254/latest/meta-data/spot/termination-time | head -1 | grep 404 | cut -d \  -f 2) ]
+                    if [ -z $(curl -Is http://169.254.169.254/latest/meta-data/spot/termination-time | head -1 | grep 404 | cut -d ' ' -f 2) ]
                     then
+                        # one last incremental flush, which only ships what the loop has not.
                         logger "Running shutdown hook." {self.upload_script}
                         break
                     else
@@ -465,11 +687,14 @@ class SSHCode(Mount):
     :param password: The password to use for untaring the code ball. Not used.
     :param local_path: path to the local directory. Doesn't have to be absolute.
     :param host_path: The path on the remote instance. Default /tmp/{uuid4()}
-    :param name: the name for the tar ball. Default to {uuid4()}
+    :param name: the name of the mount, used for the default host path. Default to the fingerprint of the directory,
+                 so that hosts which already unpacked the same code skip the download.
     :param container_path: The path for the docker instance. Can be something like /Users/ge/project-folder/blah
     :param pypath (bool): Whether this directory should be added to the python path
     :param excludes: The files paths to exclude, default to "--exclude='*__pycache__'"
     :param file_mask: The file mask for files to include. Default to "."
+    :param packer: "auto", "python" or "tar". The python packer compresses on all cores and streams the tar ball
+                   straight into the upload. "auto" falls back to tar when there are extra tar options.
     :return: self
     """
 
@@ -488,6 +713,7 @@ class SSHCode(Mount):
         compress=True,
         exclude_vcs=True,
         exclude_from=None,
+        packer="auto",
         **tar_options,
     ):
         # I fucking hate the behavior of python defaults. -- GY
@@ -495,11 +721,9 @@ class SSHCode(Mount):
         self.host_path = host_path
         self.container_path = container_path or host_path
         self.pypath = pypath
-        name = name or str(uuid4())
-        self.name = name
         self.compress = compress
 
-        self.excludes = excludes or "--exclude='*__pycache__' --exclude='*.git' --exclude='*.idea' --exclude='*.egg-info'"
+        self.excludes = excludes or DEFAULT_EXCLUDES
         self.file_mask = file_mask or "."  # file_mask can Not be None or "".
 
         from .jaynes import RUN
@@ -508,6 +732,7 @@ class SSHCode(Mount):
         local_abs = os.path.join(RUN.config_root, local_path)
         self.container_path = os.path.join(RUN.config_root, container_path) if container_path else local_abs
 
+        extra_options = tar_options
         tar_options = " ".join([f"--{key.replace('_', '-')}={value}" for key, value in tar_options.items()])
         if exclude_vcs:
             tar_options += " --exclude-vcs"
@@ -515,9 +740,15 @@ class SSHCode(Mount):
             ignore_file_path = os.path.join(RUN.config_root, exclude_from)
             tar_options += f" --exclude-from='{ignore_file_path}'"
 
+        self.digest = None
         if local_tar is None:
-            tar_name = f"{name}.tar"
-            self.temp_dir = get_temp_dir()
+            self.key_on_tree(local_abs, self.file_mask, self.excludes, tar_options, extra_options, compress, packer)
+        name = name or self.digest or str(uuid4())
+        self.name = name
+
+        if local_tar is None:
+            tar_name = f"{self.digest or name}.tar"
+            self.temp_dir = get_cache_dir("tarballs")
             self.local_tar = pathJoin(self.temp_dir, tar_name)
         else:
             tar_name = os.path.basename(local_tar)
@@ -526,17 +757,20 @@ class SSHCode(Mount):
 
         self.remote_tar = remote_tar or f"/tmp/{tar_name}"
 
+        tar_cmd = f"""tar {self.excludes} {tar_options} -c{"z" if self.compress else ""}f {self.local_tar}.part -C {local_abs} {self.file_mask} && mv {self.local_tar}.part {self.local_tar}"""
         self.tar_script = dedent(f"""
                 type gtar >/dev/null 2>&1 && alias tar=`which gtar`
                 mkdir -p {self.temp_dir}
                 # Do not use absolute path in tar.
-                tar {self.excludes} {tar_options} -c{"z" if self.compress else ""}f {self.local_tar} -C {local_abs} {self.file_mask}
+                {f"[ -f {self.local_tar} ] || {{ {tar_cmd}; }}" if self.digest else tar_cmd}
                 """)
 
         self.host_setup = dedent(f"""
                 mkdir -p {self.host_path}
                 tar -{"z" if self.compress else ""}xf {self.remote_tar}{tar_name if self.remote_tar.endswith('/') else ''} -C {self.host_path}
                 """)
+        if self.digest:
+            self.host_setup = dedent(unpack_once(self.digest, self.host_path, self.host_setup))
         # used by the docker runner
         self.docker_mount = f"-v {self.host_path}:{self.container_path}"
 
@@ -547,18 +781,31 @@ class SSHCode(Mount):
         ssh_string = f"ssh {_port} {_pem}" if _port or _pem else "ssh"
         mkdir_script = f"{ssh_string} {username}@{ip} mkdir -p {os.path.dirname(self.remote_tar)}"
         rsync_script = f"rsync -az -e '{ssh_string}' --info=progress2 {self.local_tar} {username}@{ip}:{self.remote_tar}"
+        exists_script = f"{ssh_string} {username}@{ip} test -f {self.remote_tar}"
         if password is not None:  # note: now supports password log in!
             # rsync_script = f'expect <<EOF\nspawn {rsync_script};expect \"password:\";send \"{password}\\r\"\nEOF'
             # need to install sshpass from:
             # https://gist.github.com/arunoda/7790979
             mkdir_script = f"sshpass -p '{password}' {mkdir_script}"
             rsync_script = f"sshpass -p '{password}' {rsync_script}"
+            exists_script = f"sshpass -p '{password}' {exists_script}"
 
         # # scp does not allow file rename.
         # remote_tar_dir = os.path.dirname(remote_tar)
         # scp_script = f"scp {port_.upper()} {pem} {self.local_tar} {username}@{ip}:{remote_tar_dir}"
 
+        if self.packer:
+            remote_dir = os.path.dirname(self.remote_tar)
+            self.exists_script = exists_script
+            self.stream_script = f"{ssh_string} {username}@{ip} 'mkdir -p {remote_dir} && cat > {self.remote_tar}.part && mv {self.remote_tar}.part {self.remote_tar}'"
+            if password is not None:
+                self.stream_script = f"sshpass -p '{password}' {self.stream_script}"
+            return self.stream_upload(verbose=verbose)
+
         self.local_script = dedent(self.tar_script) + mkdir_script + "\n" + rsync_script + "\n"
+        if self.digest:
+            # the remote tar ball is named by the digest, so an existing one is up to date.
+            self.local_script = f"if {exists_script}; then\necho '{self.remote_tar} is already uploaded'\nelse\n{self.local_script}fi\n"
 
         return super().upload(verbose=verbose)
 
@@ -582,24 +829,24 @@ class TarMount(Mount):
         compress=True,
         exclude_vcs=True,
         exclude_from=None,
+        packer="auto",
         **tar_options,
     ):
         self.local_path = local_path
         self.host_path = host_path
         self.container_path = container_path or host_path
         self.pypath = pypath
-        name = name or str(uuid4())
-        self.name = name
         self.compress = compress
 
         self.file_mask = file_mask or "."  # file_mask can Not be None or "".
-        self.excludes = excludes or "--exclude='*__pycache__' --exclude='*.git' --exclude='*.idea' --exclude='*.egg-info'"
+        self.excludes = excludes or DEFAULT_EXCLUDES
 
         from .jaynes import RUN
 
         local_path = os.path.expandvars(local_path)
         local_abs = os.path.join(RUN.config_root, local_path)
 
+        extra_options = tar_options
         tar_options = " ".join([f"--{key.replace('_', '-')}={value}" for key, value in tar_options.items()])
         if exclude_vcs:
             tar_options += " --exclude-vcs"
@@ -607,9 +854,15 @@ class TarMount(Mount):
             ignore_file_path = os.path.join(RUN.config_root, exclude_from)
             tar_options += f" --exclude-from='{ignore_file_path}'"
 
+        self.digest = None
+        if local_tar is None:
+            self.key_on_tree(local_abs, self.file_mask, self.excludes, tar_options, extra_options, compress, packer)
+        name = name or self.digest or str(uuid4())
+        self.name = name
+
         if local_tar is None:
-            tar_name = f"{name}.tar"
-            self.temp_dir = get_temp_dir()
+            tar_name = f"{self.digest or name}.tar"
+            self.temp_dir = get_cache_dir("tarballs")
             self.local_tar = pathJoin(self.temp_dir, tar_name)
         else:
             tar_name = os.path.basename(local_tar)
@@ -622,43 +875,42 @@ class TarMount(Mount):
                 type gtar >/dev/null 2>&1 && alias tar=`which gtar`
                 mkdir -p {self.temp_dir}
                 # Do not use absolute path in tar.
-                tar {self.excludes} {tar_options} -c{"z" if compress else ""}f {self.local_tar} -C {local_abs} {self.file_mask}
+                tar {self.excludes} {tar_options} -c{"z" if compress else ""}f {self.local_tar}.part -C {local_abs} {self.file_mask} && mv {self.local_tar}.part {self.local_tar}
                 """
         self.host_setup = f"""
                 mkdir -p {host_path}
                 tar -{"z" if compress else ""}xf {self.remote_tar} -C {host_path}
                 """
+        if self.digest:
+            self.host_setup = unpack_once(self.digest, host_path, self.host_setup)
 
     def upload(self, verbose=None, *, host, user=None, token=None, **_):
         from jaynes.client import JaynesClient
 
+        client = JaynesClient(host, token=token)
+        if self.packer:
+            if client.exists(self.remote_tar):
+                print("remote tar already exists", self.remote_tar)
+                return
+            # packs in a background thread, while the chunks are being sent.
+            r = client.upload_stream(self.packer.chunks(verbose=verbose), self.remote_tar)
+            assert isinstance(r, dict) and r.get("status"), f"file upload failed {r}"
+            return
+
         if os.path.exists(self.local_tar):
             print("local tar already exists", self.local_tar)
         else:
             script = dedent(self.local_script)
             check_call(script, verbose=verbose, shell=True)
 
-        parent_dir = os.path.dirname(self.remote_tar)
-        tar_name = os.path.basename(self.remote_tar)
+        self.touch_cache()
 
-        client = JaynesClient(host, token=token)
-
-        # grep to speed up transmission
-        stdout, stderr, error = client.execute(f"ls {parent_dir} | grep {tar_name}")
-
-        if tar_name in stdout:
+        # the server creates the parent directory, and checks the digest of the upload.
+        if client.exists(self.remote_tar):
             print("remote tar already exists", self.remote_tar)
             return
 
-        client.execute(f"mkdir -p {parent_dir}")
-        client.upload_file(self.local_tar, self.remote_tar)
-
-        stdout, *_ = client.execute(f"echo {parent_dir}")
+        r = client.upload_file(self.local_tar, self.remote_tar)
         if verbose:
-            print(
-                stdout,
-                parent_dir,
-                self.remote_tar,
-            )
-        stdout, *_ = client.execute(f"ls {parent_dir} | grep {tar_name}")
-        assert tar_name in stdout, "file upload failed" + stdout
+            print(r, self.remote_tar)
+        assert isinstance(r, dict) and r.get("status"), f"file upload failed {r}"
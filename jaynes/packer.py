@@ -0,0 +1,190 @@
+"""
+In-process tar packer with parallel gzip.
+
+Packs a directory with the same exclude semantics as the :code:`tar` command of the code mounts,
+and compresses it on all cores. The tar stream is cut into blocks that are compressed as independent
+gzip members in a thread pool (zlib releases the GIL). Concatenated gzip members are a valid gzip
+file, so the hosts still unpack with :code:`tar -zxf`.
+
+The output is written to any file-like sink as it is produced, so that packing overlaps with the
+upload and no intermediate file is written.
+"""
+import os
+import queue
+import tarfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .manifest import DEFAULT_EXCLUDES, walk
+
+
+def gzip_member(block, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+class ParallelGzipWriter:
+    """
+    A write-only file object that gzips blocks in parallel, and writes them to the sink in order.
+
+    :param sink: the file-like object to write the compressed stream to.
+    :param level: the gzip compression level.
+    :param block_size: the size of the blocks that are compressed independently.
+    :param workers: the number of compression threads. Default to the number of cores.
+    """
+
+    def __init__(self, sink, level=6, block_size=1 << 20, workers=None):
+        self.sink = sink
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.bytes_in = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_in += len(data)
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit(self, block):
+        self.pending.append(self.pool.submit(gzip_member, block, self.level))
+        # bounds the memory to a couple of blocks per worker.
+        while len(self.pending) > 2 * self.workers:
+            self.sink.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.sink.write(self.pending.popleft().result())
+        self.pool.shutdown()
+
+    def abort(self):
+        """stops the compression threads without writing the rest, e.g. when packing failed."""
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.pool.shutdown()
+
+
+class CountingWriter:
+    def __init__(self, sink):
+        self.sink = sink
+        self.bytes_out = 0
+
+    def write(self, data):
+        self.sink.write(data)
+        self.bytes_out += len(data)
+        return len(data)
+
+
+class Packer:
+    """
+    Packs :code:`file_mask` under :code:`root` the way :code:`tar -czf - -C root file_mask` does.
+
+    :param root: the directory to pack.
+    :param file_mask: the space separated paths under root to pack. Default to ".".
+    :param excludes: tar-style exclude patterns.
+    :param compress: gzip the tar ball.
+    :param workers: the number of compression threads. Default to the number of cores.
+    """
+
+    def __init__(self, root, file_mask=".", excludes=DEFAULT_EXCLUDES, compress=True, workers=None):
+        self.root = root
+        self.file_mask = file_mask
+        self.excludes = excludes
+        self.compress = compress
+        self.workers = workers
+
+    def members(self):
+        for mask in self.file_mask.split():
+            path = os.path.join(self.root, mask)
+            mask = os.path.normpath(mask)
+            yield mask
+            if os.path.isdir(path) and not os.path.islink(path):
+                for rel_path in walk(path, self.excludes, include_dirs=True):
+                    yield rel_path if mask == "." else f"{mask}/{rel_path}"
+
+    def pack(self, sink, verbose=False):
+        """
+        writes the tar ball to the sink.
+
+        :param verbose: reports the throughput.
+        :return: (bytes in, bytes out, seconds)
+        """
+        started = time.perf_counter()
+        counter = CountingWriter(sink)
+        writer = ParallelGzipWriter(counter, workers=self.workers) if self.compress else counter
+        try:
+            # "w|" is the streaming mode, it only ever calls write on the file object.
+            with tarfile.open(fileobj=writer, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+                for name in self.members():
+                    arcname = "." if name == "." else f"./{name}"
+                    tar.add(os.path.join(self.root, name), arcname=arcname, recursive=False)
+        except BaseException:
+            if self.compress:
+                writer.abort()
+            raise
+        if self.compress:
+            writer.close()
+
+        seconds = time.perf_counter() - started
+        bytes_in = writer.bytes_in if self.compress else counter.bytes_out
+        if verbose:
+            print(f"packed {self.root} {bytes_in / 1e6:.1f} MB -> {counter.bytes_out / 1e6:.1f} MB "
+                  f"in {seconds:.2f}s ({bytes_in / 1e6 / max(seconds, 1e-6):.1f} MB/s)")
+        return bytes_in, counter.bytes_out, seconds
+
+    def chunks(self, max_chunks=16, verbose=False):
+        """
+        packs in a background thread, and yields the tar ball chunk by chunk. Used for streaming http uploads.
+        The thread stops when the consumer does, e.g. on a failed upload.
+        """
+        chunks = queue.Queue(max_chunks)
+        error = []
+        cancelled = threading.Event()
+
+        def put(item):
+            while not cancelled.is_set():
+                try:
+                    return chunks.put(item, timeout=0.1)
+                except queue.Full:
+                    pass
+            raise BrokenPipeError("the consumer of the chunks stopped")
+
+        class QueueSink:
+            def write(self, data):
+                put(bytes(data))
+                return len(data)
+
+        def produce():
+            try:
+                self.pack(QueueSink(), verbose=verbose)
+            except BaseException as e:
+                error.append(e)
+            finally:
+                try:
+                    put(None)
+                except BrokenPipeError:
+                    pass
+
+        threading.Thread(target=produce, name="jaynes-packer", daemon=True).start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            cancelled.set()
+        if error:
+            raise error[0]
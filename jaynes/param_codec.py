@@ -1,29 +1,222 @@
+"""
+The payload codec. A payload is ascii, so that it fits in an environment variable and a shell command:
+
+    JYN<version><codec>.<base64 of the frame>
+
+where codec is :code:`n` (none), :code:`z` (zlib) or :code:`s` (zstd), and the frame holds the out-of-band
+buffers of pickle protocol 5, e.g. the data of numpy arrays, followed by the pickle. Payloads without the
+header are the base64 encoded pickles of earlier versions, and still decode.
+
+With a thunk store, the buffers of at least :code:`OOB_MIN_SIZE` bytes go into the store as blobs of their
+own, and the frame only holds their references. The worker memory-maps them, so a large array argument is
+neither inflated into base64 nor copied into memory.
+"""
 import base64
 import cloudpickle
 import pickle
+import struct
+import zlib
 from typing import Any, Dict, Tuple
 
+MAGIC = "JYN"
+# 2 adds the references of the buffers that are stored as blobs.
+VERSION = "2"
+PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
+# the smallest buffer that goes into the thunk store as a blob of its own.
+OOB_MIN_SIZE = 1 << 20
+
+# the size limits of the places a payload travels through, in bytes.
+LIMITS = {
+    # MAX_ARG_STRLEN, the longest single environment variable or argument on linux.
+    "env": 128 * 1024,
+    # EC2 UserData, before the base64 encoding.
+    "ec2": 16 * 1024,
+    # a GCE metadata value.
+    "gce": 256 * 1024,
+    # the data of a kubernetes ConfigMap.
+    "configmap": 1024 * 1024,
+}
+
+
+class PayloadTooLarge(ValueError):
+    pass
+
+
+def compress(blob, compression="zlib"):
+    """
+    :return: (codec, compressed). zstd is opt-in, because the workers need the zstandard module to decompress,
+             and it is not a dependency of jaynes.
+    """
+    if compression == "zstd":
+        import zstandard
+
+        return "s", zstandard.ZstdCompressor().compress(blob)
+    if compression == "zlib":
+        return "z", zlib.compress(blob)
+    if compression not in (None, "none"):
+        raise ValueError(f"unknown compression {compression}")
+    return "n", blob
+
+
+def decompress(codec, blob):
+    if codec == "s":
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompress(blob)
+    if codec == "z":
+        return zlib.decompress(blob)
+    if codec != "n":
+        raise ValueError(f"unknown codec {codec}")
+    return blob
+
+
+def encode(obj, protocol=PROTOCOL, compression="zlib", store=None, oob_min_size=OOB_MIN_SIZE):
+    """
+    :param store: a thunk store for the large out-of-band buffers. They are inlined when None.
+    :param oob_min_size: the smallest buffer that goes into the store.
+    """
+    buffers = []
+    blob = cloudpickle.dumps(obj, protocol=protocol, buffer_callback=buffers.append if protocol >= 5 else None)
+    buffers = [b.raw() for b in buffers]
+    # the store writes the memoryview out, without a copy.
+    refs = [store.put(b).encode() if store is not None and b.nbytes >= oob_min_size else b"" for b in buffers]
+    inline = [b for b, ref in zip(buffers, refs) if not ref]
+    n = len(buffers)
+    frame = b"".join([struct.pack(f"<I{n}Q{n}H", n, *(b.nbytes for b in buffers), *map(len, refs)),
+                      *refs, *inline, blob])
+    codec, compressed = compress(frame, compression)
+    if codec != "n" and len(compressed) >= len(frame):
+        # small or random payloads do not compress.
+        codec, compressed = "n", frame
+    return f"{MAGIC}{VERSION}{codec}." + base64.b64encode(compressed).decode("ascii")
+
+
+def split_frame(code):
+    """:return: (buffers, pickle) of a payload with a header. The buffers in the store are their references."""
+    version, codec = code[len(MAGIC)], code[len(MAGIC) + 1]
+    if version not in ("1", VERSION):
+        raise ValueError(f"payload version {version} is not supported, upgrade jaynes on the worker.")
+    # writable, so that the arrays that come out of the buffers are too.
+    frame = memoryview(bytearray(decompress(codec, base64.b64decode(code[len(MAGIC) + 3:]))))
+    n, = struct.unpack_from("<I", frame)
+    sizes = struct.unpack_from(f"<{n}Q", frame, 4)
+    offset = 4 + 8 * n
+    ref_lengths = [0] * n
+    if version != "1":
+        ref_lengths = struct.unpack_from(f"<{n}H", frame, offset)
+        offset += 2 * n
+    refs = []
+    for length in ref_lengths:
+        refs.append(bytes(frame[offset:offset + length]).decode())
+        offset += length
+    buffers = []
+    for size, ref in zip(sizes, refs):
+        if ref:
+            buffers.append(ref)
+            continue
+        buffers.append(frame[offset:offset + size])
+        offset += size
+    return buffers, frame[offset:]
+
+
+def map_blob(ref):
+    """
+    memory-maps a blob of the thunk store. Copy-on-write, so that the arrays on top are writable, and the
+    pages are only copied when written to.
+    """
+    import mmap
+    from .stores import fetch_path
+
+    with open(fetch_path(ref), "rb") as f:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+
+
+def decode(code):
+    if not code.startswith(MAGIC):
+        return cloudpickle.loads(base64.b64decode(code))
+    buffers, blob = split_frame(code)
+    return cloudpickle.loads(blob, buffers=[map_blob(b) if isinstance(b, str) else b for b in buffers])
+
+
+def describe(code):
+    """:return: the size stats of a payload, for reporting."""
+    if not code.startswith(MAGIC):
+        return dict(encoded=len(code), format="legacy")
+    buffers, blob = split_frame(code)
+    codec = {"n": "none", "z": "zlib", "s": "zstd"}[code[len(MAGIC) + 1]]
+    return dict(encoded=len(code), compression=codec, pickled=blob.nbytes,
+                buffers=sum(b.nbytes for b in buffers if not isinstance(b, str)),
+                stored=sum(isinstance(b, str) for b in buffers))
+
+
+def check_size(text, target, payloads=(), limit=None, warn_at=0.8):
+    """
+    raises PayloadTooLarge with the payload stats when text, a payload or a script with payloads inside, is
+    over the limit of the target, see LIMITS. Warns above warn_at of the limit.
+
+    :return: the size of text.
+    """
+    limit = limit or LIMITS[target]
+    size = len(text)
+    if size <= limit * warn_at:
+        return size
+
+    msg = f"the {target} payload is {size} bytes, {'over' if size > limit else 'close to'} the limit of {limit} bytes."
+    if payloads:
+        largest = max(payloads, key=len)
+        msg += f" It holds {len(payloads)} thunks, the largest is {describe(largest)}."
+    msg += " Configure a thunk_store to ship references instead, or pass less data in the arguments."
+    if size > limit:
+        raise PayloadTooLarge(msg)
+    import warnings
+
+    warnings.warn(msg, stacklevel=2)
+    return size
+
+
+def deserialize(code, with_result=False):
+    """:param with_result: also return the result channel of the thunk, None when it has none."""
+    data = decode(code)
+    thunk = data["thunk"]
+    if isinstance(thunk, str):
+        # jaynes.map ships the function once, as a reference into the thunk store.
+        from .stores import fetch
+
+        thunk = fetch(thunk)
+    if isinstance(thunk, bytes):
+        thunk = cloudpickle.loads(thunk)
+    if with_result:
+        return thunk, data["args"] or (), data["kwargs"] or {}, data.get("result")
+    return thunk, data["args"] or (), data["kwargs"] or {}
+
 
-def deserialize(code):
-    blob = base64.b64decode(code)
-    data = cloudpickle.loads(blob)
-    return data["thunk"], data["args"] or (), data["kwargs"] or {}
+def serialize_thunk(fn, protocol=PROTOCOL):
+    """pickles the function alone, so that a sweep can pickle it once and share it between jobs."""
+    return cloudpickle.dumps(fn, protocol=protocol)
 
 
 def serialize(
     fn,
     args: Tuple[Any] = None,
     kwargs: Dict[Any, Any] = None,
-    protocol=pickle.DEFAULT_PROTOCOL,
+    protocol=PROTOCOL,
+    result=None,
+    compression="zlib",
+    store=None,
 ):
     """
     for protocol see: https://stackoverflow.com/a/23582505/1560241
-    :param fn: the target function to serialize
+    :param fn: the target function to serialize. Can also be the output of serialize_thunk, or a thunk
+               store reference to it.
     :param args:
     :param kwargs:
     :param protocole:
+    :param result: the result channel that jaynes.entry posts the return value to, see jaynes.results.
+    :param compression: "zlib", "zstd" or None. zstd needs the zstandard module on the workers too.
+    :param store: a thunk store, for the large buffers of the arguments, e.g. numpy arrays.
     :return:
     """
     payload = dict(thunk=fn, args=args, kwargs=kwargs)
-    code = cloudpickle.dumps(payload, protocol=protocol)
-    return base64.b64encode(code).decode("ascii")
+    if result:
+        payload["result"] = result
+    return encode(payload, protocol=protocol, compression=compression, store=store)
@@ -0,0 +1,163 @@
+"""
+Thunk queues for warm workers.
+
+A worker, :code:`python -m jaynes.entry --worker <source>`, keeps the interpreter, the heavy imports and the GPU
+context alive, and runs the thunks it pulls from a queue one after another. The Queue launcher submits to it.
+The source is either the url of a Jaynes server, or a directory, e.g. on a shared file system.
+
+Both queues have the same interface: :code:`put(*thunks)` returns task ids, :code:`get(timeout)` returns
+:code:`(task_id, thunk)` or None, and :code:`done(task_id, result)` / :code:`result(task_id, timeout)` pass the
+result back.
+"""
+import json
+import os
+import threading
+import time
+from uuid import uuid4
+
+
+class FileQueue:
+    """
+    A queue in a directory. Tasks are files named by submission time, and workers claim one by renaming it,
+    which is atomic on POSIX file systems.
+
+    The worker holds a lease on the claimed task, and renews it by touching the claimed file while the task
+    runs. When the worker dies, the lease expires, and the next get puts the task back into the queue. After
+    max_attempts leases, the task fails instead.
+
+    :param root: the queue directory.
+    :param poll: seconds between two looks at the directory.
+    :param lease: seconds without renewal, after which a claimed task goes back into the queue.
+    """
+
+    def __init__(self, root, poll=0.5, lease=60, max_attempts=3):
+        self.root = os.path.expanduser(root)
+        self.poll = poll
+        self.lease = lease
+        self.max_attempts = max_attempts
+        # task id -> the event that stops the renewal of its lease.
+        self.renewals = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    def renew(self, path, stop):
+        while not stop.wait(self.lease / 3):
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return
+
+    def requeue_expired(self):
+        """puts the claimed tasks whose lease expired back into the queue, or fails them after max_attempts."""
+        now = time.time()
+        for name in os.listdir(self.root):
+            if not name.endswith(".running"):
+                continue
+            task_id = name[:-len(".running")]
+            claimed = os.path.join(self.root, name)
+            try:
+                if os.path.getmtime(claimed) > now - self.lease:
+                    continue
+                attempts_path = os.path.join(self.root, f"{task_id}.attempts")
+                with open(attempts_path, "a+") as f:
+                    f.write("x")
+                    f.seek(0)
+                    attempts = len(f.read())
+                if attempts < self.max_attempts:
+                    os.rename(claimed, os.path.join(self.root, f"{task_id}.thunk"))
+                else:
+                    self.done(task_id, {"error": f"the lease of the task expired {attempts} times", "seconds": 0})
+            except FileNotFoundError:
+                # another worker was faster.
+                continue
+
+    def put(self, *thunks):
+        ids = []
+        for thunk in thunks:
+            task_id = f"{time.time_ns()}-{uuid4().hex[:8]}"
+            tmp_path = os.path.join(self.root, f".{task_id}.tmp")
+            with open(tmp_path, "w") as f:
+                f.write(thunk)
+            os.replace(tmp_path, os.path.join(self.root, f"{task_id}.thunk"))
+            ids.append(task_id)
+        return ids
+
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self.requeue_expired()
+            for name in sorted(n for n in os.listdir(self.root) if n.endswith(".thunk")):
+                task_id = name[:-len(".thunk")]
+                claimed = os.path.join(self.root, f"{task_id}.running")
+                try:
+                    os.rename(os.path.join(self.root, name), claimed)
+                except FileNotFoundError:
+                    # another worker was faster.
+                    continue
+                # the rename keeps the time of the submission, this starts the lease.
+                os.utime(claimed)
+                stop = self.renewals[task_id] = threading.Event()
+                threading.Thread(target=self.renew, args=(claimed, stop), daemon=True).start()
+                with open(claimed) as f:
+                    return task_id, f.read()
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(self.poll)
+
+    def done(self, task_id, result):
+        tmp_path = os.path.join(self.root, f".{task_id}.result.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(result, f)
+        os.replace(tmp_path, os.path.join(self.root, f"{task_id}.result"))
+        self.renewals.pop(task_id, threading.Event()).set()
+        for suffix in (".running", ".attempts"):
+            try:
+                os.remove(os.path.join(self.root, task_id + suffix))
+            except FileNotFoundError:
+                pass
+
+    def result(self, task_id, timeout=0):
+        path = os.path.join(self.root, f"{task_id}.result")
+        deadline = time.time() + (timeout or 0)
+        while not os.path.exists(path):
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.poll)
+        with open(path) as f:
+            result = json.load(f)
+        os.remove(path)
+        return result
+
+
+class ServerQueue:
+    """
+    A named queue on a Jaynes server, see the /queue and /results routes of :code:`jaynes.server`. A claimed task
+    goes back into the queue when the worker does not post its result within the lease of the server.
+
+    :param server: the url of the Jaynes server.
+    :param queue: the name of the queue.
+    """
+
+    def __init__(self, server, queue="default", token=None):
+        from .client import JaynesClient
+
+        self.client = JaynesClient(server, token=token)
+        self.queue = queue
+
+    def put(self, *thunks):
+        return self.client.enqueue(self.queue, *thunks)
+
+    def get(self, timeout=30):
+        return self.client.dequeue(self.queue, timeout=timeout)
+
+    def done(self, task_id, result):
+        return self.client.post_result(task_id, result)
+
+    def result(self, task_id, timeout=0):
+        return self.client.get_result(task_id, timeout=timeout)
+
+
+def open_queue(source, queue="default", token=None):
+    """:param source: the url of a Jaynes server, or a directory."""
+    if source.startswith(("http://", "https://")):
+        return ServerQueue(source, queue, token=token)
+    return FileQueue(os.path.join(source, queue))
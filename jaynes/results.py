@@ -0,0 +1,149 @@
+"""
+Result channels, for the return values and exceptions of remote thunks.
+
+With a :code:`result_channel` in the config, every thunk gets its own channel, and :code:`jaynes.add` and
+:code:`jaynes.run` return a :code:`Handle` to it. :code:`jaynes.entry` posts the pickled return value, or the
+traceback, to the channel when the thunk finishes, and :code:`handle.result(timeout)` blocks until it arrives.
+
+.. code:: yaml
+
+    result_channel: http://my-gpu-box:8092  # long-polls the /results route of a Jaynes server
+    # result_channel: s3://ge-bair/jaynes-results
+    # result_channel: /shared/nfs/jaynes-results
+
+A channel is a url: :code:`http(s)://<server>/results/<id>`, :code:`s3://`, :code:`gs://` or :code:`file://`.
+The worker side only uses the standard library, and the aws and gsutil clis for s3 and gs. The polls of the
+launching side go through :code:`jaynes.transfer`, in-process.
+"""
+import base64
+import json
+import os
+import subprocess
+import time
+import urllib.request
+from uuid import uuid4
+
+
+class RemoteError(Exception):
+    """raised by :code:`Handle.result` when the remote thunk raised. Carries the remote traceback."""
+
+    def __init__(self, error, traceback=None):
+        super().__init__(error)
+        self.traceback = traceback
+
+    def __str__(self):
+        return f"{self.args[0]}\n\nremote traceback:\n{self.traceback}" if self.traceback else self.args[0]
+
+
+def new_channel(base):
+    """:return: a unique channel under the configured base."""
+    base = base.rstrip("/")
+    if base.startswith(("http://", "https://")):
+        return f"{base}/results/{uuid4().hex}"
+    if "://" not in base:
+        base = "file://" + os.path.abspath(os.path.expanduser(base))
+    return f"{base}/{uuid4().hex}.result"
+
+
+def encode_value(value):
+    import cloudpickle
+
+    return base64.b64encode(cloudpickle.dumps(value)).decode("ascii")
+
+
+def decode_value(code):
+    import cloudpickle
+
+    return cloudpickle.loads(base64.b64decode(code))
+
+
+def post(channel, result):
+    """writes the result dictionary to the channel. Called by :code:`jaynes.entry`."""
+    blob = json.dumps(result).encode()
+    if channel.startswith(("http://", "https://")):
+        request = urllib.request.Request(channel, data=blob, method="POST",
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as r:
+            return r.read()
+    if channel.startswith("file://"):
+        path = channel[len("file://"):]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(blob)
+        return os.replace(path + ".tmp", path)
+    cmd = {"s3": ["aws", "s3", "cp", "--only-show-errors", "-", channel],
+           "gs": ["gsutil", "-q", "cp", "-", channel]}[channel.split("://")[0]]
+    subprocess.run(cmd, input=blob, check=True)
+
+
+def poll(channel, timeout=0):
+    """:return: the result dictionary, or None if it is not there yet. Http channels long-poll for timeout."""
+    if channel.startswith(("http://", "https://")):
+        with urllib.request.urlopen(f"{channel}?timeout={timeout}", timeout=timeout + 30) as r:
+            response = json.loads(r.read())
+        return response["result"] if response["done"] else None
+    if channel.startswith("file://"):
+        try:
+            with open(channel[len("file://"):], "rb") as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+    from . import transfer
+
+    blob = transfer.read(channel)
+    return json.loads(blob) if blob else None
+
+
+class Handle:
+    """
+    A future for the result of a remote thunk.
+
+    :param channel: the result channel of the thunk.
+    :param launch: what the launcher returned, e.g. the instance id. Set by :code:`jaynes.run`.
+    """
+
+    def __init__(self, channel, launch=None):
+        self.channel = channel
+        self.launch = launch
+        self._result = None
+
+    def __repr__(self):
+        return f"Handle({self.channel!r})"
+
+    def wait(self, timeout=None, max_interval=5):
+        """
+        blocks until the result arrives. Http channels long-poll, the other channels are checked with
+        exponential backoff, up to max_interval seconds apart.
+
+        :return: the result dictionary, or None after the timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        interval = 0.1
+        while self._result is None:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            if self.channel.startswith(("http://", "https://")):
+                self._result = poll(self.channel, timeout=min(30, remaining if remaining is not None else 30))
+            else:
+                self._result = poll(self.channel)
+            if self._result is not None or remaining == 0:
+                break
+            if not self.channel.startswith(("http://", "https://")):
+                time.sleep(min(interval, remaining) if remaining is not None else interval)
+                interval = min(interval * 2, max_interval)
+        return self._result
+
+    def done(self):
+        return self.wait(timeout=0) is not None
+
+    def exception(self, timeout=None):
+        result = self.wait(timeout)
+        if result is None:
+            raise TimeoutError(f"{self} is not done after {timeout} seconds.")
+        return RemoteError(result["error"], result.get("traceback")) if result["error"] else None
+
+    def result(self, timeout=None):
+        """:return: the return value of the thunk. Raises RemoteError if the thunk raised."""
+        error = self.exception(timeout)
+        if error:
+            raise error
+        return decode_value(self._result["value"])
@@ -5,8 +5,11 @@ from textwrap import dedent
 
 import jaynes
 
-from .constants import JAYNES_PARAMS_KEY
-from .param_codec import serialize
+from .constants import JAYNES_INDEX_VAR_KEY, JAYNES_PARAMS_KEY, JAYNES_WORKERS_KEY
+from .kube import JOB_LABEL
+from .param_codec import check_size, serialize
+from .results import Handle, new_channel
+from .templates import compile_template
 
 
 # fmt: off
@@ -26,6 +29,21 @@ class Runner:
 
     main_script = ""
 
+    # set by jaynes from the `thunk_store` config. Payloads are inlined when None.
+    thunk_store = None
+    # set by jaynes from the `result_channel` config. Each thunk then gets a channel, and a Handle in handles.
+    result_channel = None
+    handles = None
+
+    # runners that pack many thunks into one submission (a slurm job array, a batched entry process) set
+    # pack to add_thunk. jaynes.add and jaynes.chain then pack into the last runner, instead of adding one.
+    pack = None
+    # the encoded thunks of this runner. Packed runners run them as one table, the Queue launcher submits them.
+    payloads = None
+    # environment variables that tell jaynes.entry how to run the table.
+    table_env = ""
+    array_limit = None
+
     @classmethod
     def from_yaml(cls, _, node):
         return cls, _.construct_mapping(node)
@@ -56,16 +74,66 @@ class Runner:
             cmd += f"PYTHONPATH=$PYTHONPATH:{self.pypath}"
         return f"{cmd} {entry_env} {self.entry_script}"
 
+    def encode(self, fn, args, kwargs):
+        """
+        serializes the thunk, and swaps it for a short reference when a thunk store is configured. With a
+        result channel, also adds the handle of the thunk to self.handles.
+        """
+        channel = None
+        if self.result_channel:
+            channel = new_channel(self.result_channel)
+            if self.handles is None:
+                self.handles = []
+            self.handles.append(Handle(channel))
+        encoded_thunk = serialize(fn, args, kwargs, result=channel, store=self.thunk_store)
+        if self.thunk_store is None:
+            # the payload goes out in an environment variable.
+            check_size(encoded_thunk, "env")
+            return encoded_thunk
+        return self.thunk_store.put(encoded_thunk.encode("ascii"))
+
     def build(self, fn, *args, **kwargs):
-        encoded_thunk = serialize(fn, args, kwargs)
-        self.main_script = self.main_script_thunk.format(JYNS_encoded_thunk=encoded_thunk)
-        self.run_script = self.run_script_thunk.format(JYNS_main_script=self.main_script)
+        encoded_thunk = self.encode(fn, args, kwargs)
+        self.payloads = [encoded_thunk]
+        if self.pack is not None:
+            return self
+        self.main_script = compile_template(self.main_script_thunk)(JYNS_encoded_thunk=encoded_thunk)
+        self.run_script = compile_template(self.run_script_thunk)(JYNS_main_script=self.main_script)
+        return self
+
+    def add_thunk(self, fn, *args, **kwargs):
+        """adds a row to the payload table."""
+        self.payloads.append(self.encode(fn, args, kwargs))
+        return self
+
+    def payload_table(self):
+        """:return: the payload table the entry reads its thunks from, with the table_env."""
+        # base64 and store references do not contain commas.
+        table = ",".join(self.payloads)
+        check_size(table, "env", self.payloads)
+        return table
+
+    def pack_table(self):
+        """
+        sets main_script and run_script to run the payload table, once all thunks are packed. The launchers call
+        this before they read run_script.
+        """
+        if self.pack is None or not self.payloads:
+            return self
+        self.main_script = compile_template(self.main_script_thunk)(
+            JYNS_encoded_thunk=f"{self.payload_table()}{self.table_env}")
+        limit = f"%{self.array_limit}" if self.array_limit else ""
+        self.run_script = compile_template(self.run_script_thunk)(JYNS_main_script=self.main_script,
+                                                                  JYNS_array=f"0-{len(self.payloads) - 1}{limit}")
         return self
 
     def chain(self, fn, *args, __sep=" &\n", **kwargs):
-        encoded_thunk = serialize(fn, args, kwargs)
-        self.main_script += __sep + self.main_script_thunk.format(JYNS_encoded_thunk=encoded_thunk)
-        self.run_script = self.run_script_thunk.format(JYNS_main_script=self.main_script)
+        if self.pack is not None:
+            return self.pack(fn, *args, **kwargs)
+        encoded_thunk = self.encode(fn, args, kwargs)
+        self.payloads.append(encoded_thunk)
+        self.main_script += __sep + compile_template(self.main_script_thunk)(JYNS_encoded_thunk=encoded_thunk)
+        self.run_script = compile_template(self.run_script_thunk)(JYNS_main_script=self.main_script)
 
 
 class Slurm(Runner):
@@ -124,16 +192,30 @@ class Slurm(Runner):
     :param comment:
     :param label:
     :param post_script: a script attached to after run_script
+    :param array: bool, packs the thunks of consecutive :code:`jaynes.add` calls into a single
+                  :code:`sbatch --array` submission. Requires :code:`interactive=False`. Each task picks its
+                  payload by :code:`SLURM_ARRAY_TASK_ID`. The SSH launcher returns the array job ids from
+                  :code:`jaynes.execute`, for :code:`jaynes.wait`.
+    :param array_limit: int, the maximum number of array tasks that run at the same time (the :code:`%K` in
+                        :code:`--array=0-N%K`).
     :param options: you can specify extra options beyond what is offered above.
     """
 
+    ARRAY_JOB_MARKER = "jaynes-array-job-id: "
+
     def __init__(self, *, mounts=None, work_dir, pypath=None, setup="", startup=None, envs=None,
                  n_gpu=None, shell="/bin/sh", entry_script="python -u -m jaynes.entry",
                  partition=None, interactive=True, n_seq_jobs=1, time_limit: str = None, n_cpu=4, name=None,
-                 comment=None, label=False, args=None,
+                 comment=None, label=False, args=None, array=False, array_limit=None,
                  post_script="", **options):
         super().__init__(mounts, work_dir, pypath, startup, entry_script, post_script)
 
+        if array:
+            assert not interactive, "job arrays are submitted with sbatch, set interactive to False."
+            self.pack = self.add_thunk
+            self.array_limit = array_limit
+            self.table_env = f" {JAYNES_INDEX_VAR_KEY}=SLURM_ARRAY_TASK_ID"
+
         # --get-user-env
         setup_cmd = """printf "\\e[1;34m%-6s\\e[m\\n" "Running on login-node `hostname`"\n"""
         setup_cmd += (setup.strip() + '\n') if setup else ''
@@ -181,9 +263,15 @@ class Slurm(Runner):
             # sbatch_options = (f"--output {logfile}", f"--error {logfile}")
             # sbatch_options = "\n".join(["#SBATCH " + opt for opt in sbatch_options])
             sbatch_cmds = [setup_cmd]
+            # the range is only known once all thunks are packed, see run_script.
+            array_option = "--array={JYNS_array} --parsable" if array else ""
             for i in range(n_seq_jobs or 1):
-                sbatch_cmds += [f"{envs if envs else ''} sbatch {option_str} {extra_options} -d singleton"
-                                f"<<<'#!/bin/bash\n{{JYNS_main_script}} & wait'"]
+                sbatch_cmd = (f"{envs if envs else ''} sbatch {option_str} {extra_options} {array_option} -d singleton"
+                              f"<<<'#!/bin/bash\n{{JYNS_main_script}} & wait'")
+                if array:
+                    # --parsable only prints the job id. Mark it, so that callers can find it in the output.
+                    sbatch_cmd = f'JAYNES_ARRAY_JOB=$({sbatch_cmd}) && echo "{self.ARRAY_JOB_MARKER}$JAYNES_ARRAY_JOB"'
+                sbatch_cmds += [sbatch_cmd]
 
             # Note: The tailing leave Ghost processes running on the login node, which eventually
             #   max-outs the number of processes in the system. We remove this support because
@@ -204,6 +292,15 @@ class Slurm(Runner):
 
             self.run_script_thunk = '\n'.join(sbatch_cmds)
 
+    @classmethod
+    def job_ids(cls, output):
+        """:return: the array job ids in the output of the launch script, str or bytes."""
+        import re
+
+        if isinstance(output, bytes):
+            output = output.decode(errors="replace")
+        return re.findall(re.escape(cls.ARRAY_JOB_MARKER) + r"(\d+)", output)
+
 
 class Simple(Runner):
     """
@@ -221,7 +318,7 @@ class Simple(Runner):
 
     def __init__(self, *, mounts=None, pypath="", work_dir=None, setup=None, startup=None, envs=None,
                  shell="/bin/sh", entry_script="python -u -m jaynes.entry", pipe="",
-                 cleanup="", detach=False, post_script="", **_):
+                 cleanup="", detach=False, post_script="", batch=False, workers=1, **_):
         """
 
         :param mounts:
@@ -236,11 +333,17 @@ class Simple(Runner):
         :param cleanup:
         :param detach: keep the process running after ssh detachment.
         :param post_script: a script attached to after run_script
+        :param batch: packs the thunks of consecutive add and chain calls into one entry process, which
+                      imports once and runs them all.
+        :param workers: the number of batched thunks that run at once, in processes forked after the imports.
         :param _:
         """
         work_dir = work_dir or os.getcwd()
 
         super().__init__(mounts, work_dir, pypath, startup, entry_script, post_script)
+        if batch:
+            self.pack = self.add_thunk
+            self.table_env = f" {JAYNES_WORKERS_KEY}={workers}"
 
         self.post_script = post_script
 
@@ -394,14 +497,21 @@ class Docker(Runner):
     :param tty: almost never used. This is because when this script is ran, it is almost garanteed that the
                 ssh/bash session is not going to be tty.
     :param post_script: a script attached to after run_script
+    :param batch: packs the thunks of consecutive add and chain calls into one entry process inside the
+                  container, which imports once and runs them all.
+    :param workers: the number of batched thunks that run at once, in processes forked after the imports.
     :param **kwargs: passed in as parameters to docker command.
                 memory="4g" gets translated into `--memory 4g`
     """
 
     def __init__(self, *, image, mounts=None, work_dir=None, workdir=None, setup="", startup=None,
                  pypath=None, envs=None, shell="/bin/sh", entry_script="python -u -m jaynes.entry", name=None,
-                 docker_cmd="docker", ipc=None, tty=False, post_script="", net=None, **options):
+                 docker_cmd="docker", ipc=None, tty=False, post_script="", net=None, batch=False, workers=1,
+                 **options):
         super().__init__(mounts, work_dir, pypath, startup, entry_script, post_script)
+        if batch:
+            self.pack = self.add_thunk
+            self.table_env = f" {JAYNES_WORKERS_KEY}={workers}"
 
         mount_string = " ".join([m.docker_mount for m in mounts])
         self.setup_script = setup
@@ -490,10 +600,19 @@ class Container(Runner):
     :param tty: almost never used. This is because when this script is ran, it is almost guaranteed that the
                 ssh/bash session is not going to be tty.
     :param post_script: a script attached to after run_script
+    :param indexed: bool, packs the thunks of consecutive :code:`jaynes.add` calls into a single Job with
+                    :code:`completionMode: Indexed`, instead of one Job per thunk. The thunks go into a
+                    ConfigMap, one key per index, and each pod picks its own by :code:`JOB_COMPLETION_INDEX`.
+                    Configure a :code:`thunk_store` for large sweeps, so that the ConfigMap only holds references.
+    :param parallelism: int, the maximum number of pods of an indexed Job that run at the same time.
+    :param backoff_limit_per_index: int, the retries of each index of an indexed Job, on top of the backoff_limit
+                    of the whole Job. Requires Kubernetes 1.29, or the JobBackoffLimitPerIndex feature gate.
     :param **kwargs: Not used
     """
 
     job = None
+    # where the pods of an indexed job mount the ConfigMap of thunks.
+    THUNK_DIR = "/var/run/jaynes/thunks"
 
     def __init__(
         self,
@@ -528,10 +647,18 @@ class Container(Runner):
         restart_policy="Never",
         backoff_limit=1,
         ttl_seconds_after_finished=3600,
+        indexed=False,
+        parallelism=None,
+        backoff_limit_per_index=None,
         **options,
     ):
         super().__init__(mounts, work_dir, pypath, startup, entry_script, post_script)
 
+        if indexed:
+            self.pack = self.add_thunk
+            self.array_limit = parallelism
+            self.table_env = f" {JAYNES_INDEX_VAR_KEY}=JOB_COMPLETION_INDEX"
+
         # self.mounts reuses the mounts from the Runner class
         init_containers = [m.init_container for m in self.mounts]
         volume_mounts = [m.volume_mount for m in self.mounts]
@@ -567,10 +694,11 @@ class Container(Runner):
         self.job_template = {
             "apiVersion": "batch/v1",
             "kind": "Job",
-            # reuse the container name for the job
-            "metadata": {"name": docker_container_name},
+            # reuse the container name for the job. The label is for jaynes.kube.Monitor.
+            "metadata": {"name": docker_container_name, "labels": {JOB_LABEL: docker_container_name}},
             "spec": {
                 "template": {
+                    "metadata": {"labels": {JOB_LABEL: docker_container_name}},
                     "spec": {
                         "volumes": volumes,
                         "initContainers": init_containers,
@@ -582,6 +710,8 @@ class Container(Runner):
                 "ttlSecondsAfterFinished": ttl_seconds_after_finished,
             },
         }
+        if indexed and backoff_limit_per_index is not None:
+            self.job_template["spec"]["backoffLimitPerIndex"] = backoff_limit_per_index
         if image_pull_secret:
             self.job_template["spec"]["template"]["spec"]["imagePullSecrets"] = [{"name": image_pull_secret}]
 
@@ -598,8 +728,12 @@ class Container(Runner):
             self.job_template["spec"]["template"]["spec"]["affinity"] = affinity
 
     def build(self, fn, *args, __sep="\n", **kwargs):
-        encoded_thunk = serialize(fn, args, kwargs)
-        self.main_script = self.main_script_thunk.format(JYNS_encoded_thunk=encoded_thunk)
+        encoded_thunk = self.encode(fn, args, kwargs)
+        self.payloads = (self.payloads or []) + [encoded_thunk]
+        if self.pack is not None:
+            # the payloads are in the ConfigMap, and jaynes.entry reads the row of the index of the pod.
+            encoded_thunk = f"{self.payload_table()}{self.table_env}"
+        self.main_script = compile_template(self.main_script_thunk)(JYNS_encoded_thunk=encoded_thunk)
 
         if self.job is None:
             self.job = deepcopy(self.job_template)
@@ -607,10 +741,37 @@ class Container(Runner):
         container = deepcopy(self.container_template)
         container["command"].append(self.main_script)
         self.job["spec"]["template"]["spec"]["containers"].append(container)
+        if self.pack is not None:
+            name = self.job["metadata"]["name"]
+            container["volumeMounts"] = [*(container["volumeMounts"] or []),
+                                         {"name": "jaynes-thunks", "mountPath": self.THUNK_DIR, "readOnly": True}]
+            pod_spec = self.job["spec"]["template"]["spec"]
+            pod_spec["volumes"] = [*(pod_spec["volumes"] or []),
+                                   {"name": "jaynes-thunks", "configMap": {"name": f"{name}-thunks"}}]
+            self.job["spec"]["completionMode"] = "Indexed"
+
+    def payload_table(self):
+        """:return: the directory of the ConfigMap, which holds one row of the table per file, see manifests."""
+        return f"file://{self.THUNK_DIR}/"
+
+    @property
+    def manifests(self):
+        """:return: the objects to apply. An indexed job comes with the ConfigMap of its thunks, first."""
+        if self.pack is None:
+            return [self.job]
+        name = self.job["metadata"]["name"]
+        data = {str(i): payload for i, payload in enumerate(self.payloads)}
+        check_size("".join(data.values()), "configmap", self.payloads)
+        config_map = {"apiVersion": "v1", "kind": "ConfigMap",
+                      "metadata": {"name": f"{name}-thunks", "labels": {JOB_LABEL: name}}, "data": data}
+        self.job["spec"]["completions"] = len(self.payloads)
+        self.job["spec"]["parallelism"] = self.array_limit or len(self.payloads)
+        return [config_map, self.job]
 
     def chain(self, fn, *args, __sep=" &\n", **kwargs):
-        encoded_thunk = serialize(fn, args, kwargs)
-        self.main_script = self.main_script_thunk.format(JYNS_encoded_thunk=encoded_thunk)
+        encoded_thunk = self.encode(fn, args, kwargs)
+        self.payloads.append(encoded_thunk)
+        self.main_script = compile_template(self.main_script_thunk)(JYNS_encoded_thunk=encoded_thunk)
 
         assert self.job is not None
 
@@ -1,5 +1,8 @@
 import os
 import asyncio
+import hashlib
+import time
+from uuid import uuid4
 from aiofile import AIOFile, Reader, Writer
 from sanic import Sanic
 from sanic.response import json
@@ -52,47 +55,124 @@ def interpolate(path: str, envs, is_path=True):
 #  the client controls the process. This makes scripting
 #  easy.
 
+# uploads are streamed into this sibling file, and renamed into place once complete.
+PART_SUFFIX = ".jaynes-part"
+
+
+async def stream_to(request, f, hasher=None):
+    """writes the request body to the file chunk by chunk, so that memory use stays constant."""
+    while True:
+        body = await request.stream.read()
+        if body is None:
+            break
+        f.write(body)
+        if hasher is not None:
+            hasher.update(body)
+
+
+async def drain(request):
+    """reads the rest of a streamed body, which the connection would otherwise take for the next request."""
+    while await request.stream.read() is not None:
+        pass
+
+
+def hash_prefix(f, size, chunk_size=1 << 20):
+    """hashes the first `size` bytes of an already uploaded part, used when resuming."""
+    hasher = hashlib.sha256()
+    f.seek(0)
+    while size > 0:
+        chunk = f.read(min(chunk_size, size))
+        if not chunk:
+            break
+        hasher.update(chunk)
+        size -= len(chunk)
+    return hasher
+
+
 @app.route("/files/<path:path>", methods=["PUT"], stream=True)
 async def upload(request, path):
-    content = b''
+    """
+    Streams the upload to a part file, and atomically renames it into place on completion.
+
+    Query arguments:
+
+    - offset: resume an interrupted upload at this byte offset. Has to agree with
+        the size of the part on the server, which is reported by `GET /uploads/<path>`.
+    - partial: keep the part file open for more chunks, instead of completing the upload.
+    - sha256: hex digest of the full file, checked on completion.
+    - size: the length of the full file. A shorter upload, e.g. of a dropped connection, keeps the part to
+        resume from, instead of failing the digest check.
+    """
     path = interpolate(path, os.environ)
+    query_args = dict(request.query_args)
+    offset = int(query_args.get("offset", 0))
+    partial = query_args.get("partial", "false").lower() in ("1", "true")
+    sha256 = query_args.get("sha256", None)
+    expected_size = query_args.get("size", None)
+
     dirname = os.path.dirname(path)
     os.makedirs(dirname, exist_ok=True)
+    part_path = path + PART_SUFFIX
 
     print(">>", dirname, path)
 
-    # async with AIOFile(path, 'w+') as afp:
-    while True:
-        body = await request.stream.read()
-        if body is None:
-            break
-        content += body  # .decode('utf-8')
-        # await afp.write(content)
-        # await afp.fsync()
-    with open(path, "wb") as f:
-        f.write(content)
-    return json({"status": 1})
+    current = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset and offset != current:
+        await drain(request)
+        return json({"status": 0, "offset": current, "error": f"offset {offset} does not match the part size {current}"}, status=409)
+
+    with open(part_path, "r+b" if offset else "wb") as f:
+        hasher = None if not sha256 else hash_prefix(f, offset) if offset else hashlib.sha256()
+        f.seek(offset)
+        f.truncate()
+        await stream_to(request, f, hasher)
+        size = f.tell()
+
+    if partial:
+        return json({"status": 1, "offset": size})
+
+    if expected_size is not None and size < int(expected_size):
+        return json({"status": 0, "offset": size, "error": f"received {size} of {expected_size} bytes"}, status=409)
+
+    if sha256 and hasher.hexdigest() != sha256:
+        os.remove(part_path)
+        return json({"status": 0, "offset": 0, "error": f"sha256 mismatch, expected {sha256}, got {hasher.hexdigest()}"}, status=422)
+
+    os.replace(part_path, path)
+    return json({"status": 1, "offset": size})
+
+
+@app.route("/uploads/<path:path>", methods=["GET"])
+async def upload_status(request, path):
+    """reports the byte offset to resume an interrupted upload from."""
+    path = interpolate(path, os.environ)
+    part_path = path + PART_SUFFIX
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    return json({"offset": offset, "exists": os.path.exists(path)})
 
 
 @app.route("/files/<path:path>", methods=["POST"], stream=True)
 async def update(request, path):
     path = interpolate(path, os.environ)
     query_args = dict(request.query_args)
-    overwrite = query_args.get('overwrite', True)
-    content = b''
+    overwrite = query_args.get('overwrite', "True").lower() in ("1", "true")
     dirname = os.path.dirname(path)
     os.makedirs(dirname, exist_ok=True)
     # info: currently NFS has a c bug, causing file streaming to fail.
-    # async with AIOFile(path, 'w+' if overwrite else 'a') as afp:
-    while True:
-        body = await request.stream.read()
-        if body is None:
-            break
-        content += body  # .decode('utf-8')
-        # await afp.write(content)
-        # await afp.fsync()
-    with open(path, 'wb' if overwrite else 'ab') as f:
-        f.write(content)
+    if not overwrite:
+        with open(path, 'ab') as f:
+            await stream_to(request, f)
+        return json({"status": 1})
+
+    # unique, so that concurrent updates to the same file do not clobber each other.
+    tmp_path = f"{path}.{uuid4().hex[:8]}{PART_SUFFIX}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            await stream_to(request, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
     return json({"status": 1})
 
 
@@ -132,6 +212,116 @@ async def execute(request):
     return json([])
 
 
+# thunk queues of the warm workers, see `python -m jaynes.entry --worker`. In memory, so they do not
+# survive a restart of the server.
+QUEUES = {}
+# task id -> (queue, thunk, attempts, deadline) of the tasks that workers claimed and did not finish yet.
+CLAIMS = {}
+# task id -> (time, result), in the order they arrived.
+RESULTS = {}
+RESULT_EVENTS = {}
+
+# a claimed task goes back into its queue when its result does not arrive within the lease, e.g. because the
+# worker died, and fails after MAX_ATTEMPTS leases.
+LEASE_SECONDS = float(os.environ.get("JAYNES_LEASE_SECONDS", 24 * 3600))
+MAX_ATTEMPTS = int(os.environ.get("JAYNES_MAX_ATTEMPTS", 3))
+# results nobody fetched are dropped after RESULT_TTL seconds, and the oldest beyond MAX_RESULTS.
+RESULT_TTL = float(os.environ.get("JAYNES_RESULT_TTL", 24 * 3600))
+MAX_RESULTS = int(os.environ.get("JAYNES_MAX_RESULTS", 10_000))
+
+
+def get_queue(name):
+    if name not in QUEUES:
+        QUEUES[name] = asyncio.Queue()
+    return QUEUES[name]
+
+
+def result_event(task_id):
+    if task_id not in RESULT_EVENTS:
+        RESULT_EVENTS[task_id] = asyncio.Event()
+        # wakes the oldest long-polls, which then answer not done.
+        while len(RESULT_EVENTS) > MAX_RESULTS:
+            RESULT_EVENTS.pop(next(iter(RESULT_EVENTS))).set()
+    return RESULT_EVENTS[task_id]
+
+
+def store_result(task_id, result):
+    now = time.time()
+    RESULTS.pop(task_id, None)
+    RESULTS[task_id] = now, result
+    while RESULTS:
+        oldest = next(iter(RESULTS))
+        if len(RESULTS) <= MAX_RESULTS and RESULTS[oldest][0] > now - RESULT_TTL:
+            break
+        del RESULTS[oldest]
+    result_event(task_id).set()
+
+
+def requeue_expired():
+    """puts the claimed tasks whose lease expired back into their queue, or fails them after MAX_ATTEMPTS."""
+    now = time.time()
+    for task_id, (name, thunk, attempts, deadline) in list(CLAIMS.items()):
+        if deadline > now:
+            continue
+        del CLAIMS[task_id]
+        if attempts < MAX_ATTEMPTS:
+            get_queue(name).put_nowait((task_id, thunk, attempts))
+        else:
+            store_result(task_id, {"error": f"the lease of the task expired {attempts} times", "seconds": 0})
+
+
+@app.route("/queue/<name>", methods=["POST"])
+async def enqueue(request, name):
+    """adds the thunks to the queue, and returns their task ids."""
+    ids = []
+    for thunk in request.json.get("thunks", []):
+        task_id = uuid4().hex
+        get_queue(name).put_nowait((task_id, thunk, 0))
+        ids.append(task_id)
+    return json({"status": 1, "ids": ids})
+
+
+@app.route("/queue/<name>", methods=["GET"])
+async def dequeue(request, name):
+    """
+    long-polls for the next thunk, for up to `timeout` seconds. The worker has `lease` seconds to post the result,
+    after which the task goes back into the queue.
+    """
+    query_args = dict(request.query_args)
+    timeout = float(query_args.get("timeout", 30))
+    lease = float(query_args.get("lease", LEASE_SECONDS))
+    requeue_expired()
+    try:
+        task_id, thunk, attempts = await asyncio.wait_for(get_queue(name).get(), timeout)
+    except asyncio.TimeoutError:
+        return json({"id": None})
+    CLAIMS[task_id] = name, thunk, attempts + 1, time.time() + lease
+    return json({"id": task_id, "thunk": thunk})
+
+
+@app.route("/results/<task_id>", methods=["POST"])
+async def post_result(request, task_id):
+    """the result of a task, which also releases its claim."""
+    CLAIMS.pop(task_id, None)
+    store_result(task_id, request.json)
+    return json({"status": 1})
+
+
+@app.route("/results/<task_id>", methods=["GET"])
+async def get_result(request, task_id):
+    """long-polls for the result of a task, for up to `timeout` seconds. Results are handed out once."""
+    timeout = float(dict(request.query_args).get("timeout", 0))
+    if task_id not in RESULTS and timeout:
+        try:
+            await asyncio.wait_for(result_event(task_id).wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    if task_id not in RESULTS:
+        return json({"done": False})
+    RESULT_EVENTS.pop(task_id, None)
+    return json({"done": True, "result": RESULTS.pop(task_id)[1]})
+
+
 if __name__ == "__main__":
     import argparse
 
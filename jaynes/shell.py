@@ -1,10 +1,76 @@
+import os
+import signal
 import subprocess
+import threading
+from contextlib import contextmanager
+
+# the cancellation that the current thread joined, see Cancellation.joined.
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Cancellation:
+    """
+    Terminates the commands that the threads which joined it run through this module, e.g. the uploads of
+    Jaynes.upload_mount, once one of them fails.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.procs = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def joined(self):
+        """runs the commands of the current thread under this cancellation. Raises Cancelled on exit when cancelled."""
+        _local.cancellation = self
+        try:
+            yield self
+        finally:
+            _local.cancellation = None
+        if self.event.is_set():
+            raise Cancelled("cancelled")
+
+    def popen(self, *args, **kwargs):
+        with self.lock:
+            if self.event.is_set():
+                raise Cancelled("cancelled")
+            # in a process group of its own, so that the commands of a shell script are terminated with it.
+            proc = subprocess.Popen(*args, start_new_session=True, **kwargs)
+            self.procs.append(proc)
+        return proc
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            for proc in self.procs:
+                if proc.poll() is None:
+                    os.killpg(proc.pid, signal.SIGTERM)
+
+
+def _popen(*args, **kwargs):
+    cancellation = getattr(_local, "cancellation", None)
+    if cancellation is None:
+        return subprocess.Popen(*args, **kwargs)
+    return cancellation.popen(*args, **kwargs)
+
+
+def _call(*args, timeout=None, **kwargs):
+    with _popen(*args, **kwargs) as p:
+        try:
+            return p.wait(timeout=timeout)
+        except BaseException:
+            p.kill()
+            raise
 
 
 def popen(cmd, *args, verbose=False, **kwargs):
     if verbose:
         print(cmd, *args)
-    return subprocess.Popen(cmd, *args, **kwargs)
+    return _popen(cmd, *args, **kwargs)
 
 
 def call(cmd, *args, verbose=False, **kwargs):
@@ -21,16 +87,17 @@ def call(cmd, *args, verbose=False, **kwargs):
     """
     if verbose:
         print(cmd, *args)
-    return subprocess.call(cmd, *args, **kwargs)
+    return _call(cmd, *args, **kwargs)
 
 
 def check_call(cmd, *args, verbose=False, **kwargs) -> object:
     if verbose:
         print(cmd, *args)
-    try:
-        return subprocess.check_call(cmd, *args, **kwargs)
-    except subprocess.CalledProcessError as e:
-        print(e)
+    returncode = _call(cmd, *args, **kwargs)
+    if returncode:
+        print(subprocess.CalledProcessError(returncode, cmd))
+        return None
+    return 0
 
 
 def run(cmd, *args, verbose=False, **kwargs) -> [str, str]:
@@ -50,5 +117,5 @@ def run(cmd, *args, verbose=False, **kwargs) -> [str, str]:
     """
     if verbose:
         print(cmd, *args)
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+    process = _popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
     return process.communicate()
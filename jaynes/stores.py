@@ -0,0 +1,242 @@
+"""
+Content-addressed thunk stores.
+
+Instead of inlining the whole base64 payload into the launch script, a runner with a
+thunk store puts the payload under its sha256 digest and only passes a short reference,
+such as :code:`s3://bucket/thunks/<digest>`, through :code:`JAYNES_PARAMS_KEY`.
+:code:`jaynes.entry` then pulls the payload by digest and keeps a local cache.
+
+To configure in the yaml file, you can do:
+
+.. code:: yaml
+
+    thunk_store: !stores.S3
+      prefix: s3://ge-bair/jaynes-thunks
+
+Payloads are staged locally on :code:`put`, and shipped in one go by :code:`flush`, which
+:code:`jaynes.execute` calls right before launching.
+"""
+import hashlib
+import os
+
+from .helpers import get_cache_dir, get_temp_dir
+from .shell import check_call
+
+
+def digest(blob: bytes) -> str:
+    return hashlib.sha256(blob).hexdigest()
+
+
+def file_digest(path, chunk_size=1 << 20) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def is_ref(code: str) -> bool:
+    """base64 payloads never contain a colon, so anything with a scheme is a reference."""
+    return "://" in code
+
+
+class Store:
+    """
+    Base class for the thunk stores.
+
+    :param prefix: the location the payloads are uploaded to, without the trailing slash.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix.rstrip("/")
+        self.staged = {}
+        self._uploaded = set()
+        self._staging_dir = None
+
+    @property
+    def staging_dir(self):
+        if self._staging_dir is None:
+            self._staging_dir = get_temp_dir()
+        return self._staging_dir
+
+    def ref(self, key):
+        return f"{self.prefix}/{key}"
+
+    def put(self, blob: bytes) -> str:
+        """
+        stages the blob for upload, and returns the reference to it. The blob can be any bytes-like object,
+        e.g. the memoryview of an array, which is written out without a copy.
+        """
+        key = digest(blob)
+        if key not in self._uploaded and key not in self.staged:
+            path = os.path.join(self.staging_dir, key)
+            with open(path, "wb") as f:
+                f.write(blob)
+            self.staged[key] = path
+        return self.ref(key)
+
+    def flush(self, verbose=None, **launch_config):
+        """uploads all staged payloads. Takes the launch config, the same way as :code:`Mount.upload` does."""
+        if not self.staged:
+            return
+        self.upload(verbose=verbose, **launch_config)
+        for path in self.staged.values():
+            os.remove(path)
+        self._uploaded.update(self.staged)
+        self.staged.clear()
+
+    def upload(self, verbose=None, **_):
+        raise NotImplementedError
+
+
+class Local(Store):
+    """
+    Stores the payloads in a directory that the workers can read, e.g. a shared file system.
+
+    :param root: the directory to store the payloads in.
+    """
+
+    def __init__(self, root):
+        root = os.path.abspath(os.path.expanduser(root))
+        super().__init__(f"file://{root}")
+        self.root = root
+
+    def put(self, blob: bytes) -> str:
+        key = digest(blob)
+        path = os.path.join(self.root, key)
+        if not os.path.exists(path):
+            os.makedirs(self.root, exist_ok=True)
+            _atomic_write(path, blob)
+        return self.ref(key)
+
+
+class S3(Store):
+    """
+    :param prefix: The s3 prefix including the s3: protocol, the bucket, and the path prefix.
+    :param region: The region to upload the s3 objects to. Default to None.
+    """
+
+    def __init__(self, prefix, region=None):
+        super().__init__(prefix)
+        self.region = region
+
+    def upload(self, verbose=None, **_):
+        # sync skips the objects that are already in the bucket.
+        script = f"aws s3 sync {self.staging_dir} {self.prefix} --only-show-errors {'--region {}'.format(self.region) if self.region else ''}"
+        assert not check_call(script, verbose=verbose, shell=True)
+
+
+class GS(Store):
+    """
+    :param prefix: The GCS prefix including the gs: protocol, the bucket name, and the path prefix.
+    """
+
+    def upload(self, verbose=None, **_):
+        script = f"gsutil -m -q rsync {self.staging_dir} {self.prefix}"
+        assert not check_call(script, verbose=verbose, shell=True)
+
+
+class SSH(Store):
+    """
+    Rsyncs the payloads to a directory on the ssh host. Uses the ssh credentials of the launch config.
+
+    :param remote_dir: absolute path to the directory on the remote host.
+    """
+
+    def __init__(self, remote_dir):
+        super().__init__(f"file://{remote_dir}")
+        self.remote_dir = remote_dir
+
+    def upload(self, verbose=None, *, username, ip, pem=None, port=None, password=None, **_):
+        _port = "" if port is None else f"-p {port}"
+        _pem = "" if pem is None else f"-i {pem}"
+
+        ssh_string = f"ssh {_port} {_pem}" if _port or _pem else "ssh"
+        mkdir_script = f"{ssh_string} {username}@{ip} mkdir -p {self.remote_dir}"
+        rsync_script = f"rsync -az -e '{ssh_string}' {self.staging_dir}/ {username}@{ip}:{self.remote_dir}/"
+        if password is not None:
+            mkdir_script = f"sshpass -p '{password}' {mkdir_script}"
+            rsync_script = f"sshpass -p '{password}' {rsync_script}"
+
+        assert not check_call(mkdir_script + "\n" + rsync_script, verbose=verbose, shell=True)
+
+
+class Manager(Store):
+    """
+    Uploads the payloads to the host of the Jaynes server. Uses the host of the launch config.
+
+    :param remote_dir: absolute path to the directory on the server host.
+    """
+
+    def __init__(self, remote_dir):
+        super().__init__(f"file://{remote_dir}")
+        self.remote_dir = remote_dir
+
+    def upload(self, verbose=None, *, host, token=None, **_):
+        from jaynes.client import JaynesClient
+
+        client = JaynesClient(host, token=token)
+        for key, path in self.staged.items():
+            if verbose:
+                print(f"uploading thunk {key} to {host}")
+            client.upload_file(path, f"{self.remote_dir}/{key}")
+
+
+def _atomic_write(path, blob):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+
+def download_command(ref, path, scheme=None):
+    """
+    :return: the shell command that downloads the payload, with the aws or the gsutil cli.
+    :param scheme: of the reference, for when ref is a shell variable.
+    """
+    scheme = scheme or ref.split("://", 1)[0]
+    if scheme == "s3":
+        return f"aws s3 cp --only-show-errors {ref} {path}"
+    if scheme == "gs":
+        return f"gsutil -q cp {ref} {path}"
+    raise ValueError(f"thunk reference scheme {scheme}:// is not supported.")
+
+
+def _download(ref, path):
+    assert not check_call(download_command(ref, path), shell=True)
+
+
+def fetch_path(ref, cache_dir=None) -> str:
+    """
+    Pulls a payload by its reference into a local file, without reading it into memory. Downloads are verified
+    against the digest, and cached under :code:`cache_dir` so that repeated jobs on the same worker only
+    download each payload once.
+
+    :param ref: the reference returned by :code:`Store.put`.
+    :param cache_dir: default to :code:`~/.cache/jaynes/thunks`.
+    :return: the path to the payload.
+    """
+    if ref.startswith("file://"):
+        return ref[len("file://"):]
+
+    key = ref.rstrip("/").split("/")[-1]
+    cache_dir = cache_dir or get_cache_dir("thunks")
+    path = os.path.join(cache_dir, key)
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        _download(ref, tmp_path)
+        if file_digest(tmp_path) != key:
+            os.remove(tmp_path)
+            raise ValueError(f"digest mismatch for {ref}. The payload is corrupted.")
+        os.replace(tmp_path, path)
+    return path
+
+
+def fetch(ref, cache_dir=None) -> bytes:
+    """
+    Pulls a payload by its reference. Used by :code:`jaynes.entry` on the worker, see :code:`fetch_path`.
+
+    :return: the payload
+    """
+    with open(fetch_path(ref, cache_dir), "rb") as f:
+        return f.read()
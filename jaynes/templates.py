@@ -1,8 +1,52 @@
+from functools import lru_cache
+from string import Formatter
 from textwrap import dedent
 import os
 from os.path import join as pathJoin
 
 
+class Template:
+    """
+    A script template that is parsed once. Filling it in joins the literal parts with the values, instead of
+    parsing the template again for every job like str.format does.
+
+    :param source: a template in str.format syntax, e.g. the run_script_thunk of a runner.
+    """
+
+    def __init__(self, source):
+        # (literal, field name, None), or (literal, None, the field in str.format syntax) for the fields with a
+        # format spec, a conversion, or an attribute or index lookup, which str.format applies.
+        self.parts = []
+        for literal, field, spec, conversion in Formatter().parse(source):
+            if field is not None and (spec or conversion or not field.isidentifier()):
+                self.parts.append((literal, None, "{%s%s%s}" % (field, "!" + conversion if conversion else "",
+                                                                ":" + spec if spec else "")))
+            else:
+                self.parts.append((literal, field, None))
+
+    @classmethod
+    def from_markers(cls, source, marker="\0"):
+        """for sources that contain braces, e.g. bash. Fields are written as <marker>name<marker>."""
+        template = cls.__new__(cls)
+        pieces = source.split(marker)
+        template.parts = [(literal, field, None) for literal, field in zip(pieces[::2], pieces[1::2] + [None])]
+        return template
+
+    def __call__(self, **values):
+        pieces = []
+        for literal, field, fmt in self.parts:
+            pieces.append(literal)
+            if field is not None:
+                pieces.append(values[field])
+            elif fmt is not None:
+                pieces.append(fmt.format(**values))
+        return "".join(pieces)
+
+
+# runners of one sweep share their templates, so this is parsed once per configuration.
+compile_template = lru_cache(maxsize=256)(Template)
+
+
 def ec2_tag_instance(name):
     return dedent(f"""
         if [ `cat /sys/devices/virtual/dmi/id/bios_version` == 1.0 ] || [[ -f /sys/hypervisor/uuid && `head -c 3 /sys/hypervisor/uuid` == ec2 ]]; then
@@ -0,0 +1,223 @@
+"""
+Native S3 and GCS transfers, without the start up cost of the aws and gsutil command line tools.
+
+Uploads and downloads are multipart and parallel, with tunable part size and concurrency. The S3 calls go
+through boto3, and work with any S3 compatible endpoint (MinIO, moto) via :code:`endpoint_url`. GCS calls go
+through :code:`google-cloud-storage`. Both are optional, and only imported when used.
+
+Urls are :code:`s3://bucket/key` or :code:`gs://bucket/key`.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+DEFAULT_PART_SIZE = 8 << 20
+DEFAULT_CONCURRENCY = 8
+
+
+def parse_url(url):
+    """:return: (scheme, bucket, key)"""
+    scheme, _, path = url.partition("://")
+    bucket, _, key = path.partition("/")
+    assert scheme in ("s3", "gs") and bucket, f"{url} is not an s3:// or gs:// url"
+    return scheme, bucket, key
+
+
+@lru_cache(maxsize=None)
+def s3_client(endpoint_url=None, region=None, concurrency=DEFAULT_CONCURRENCY):
+    import boto3
+    from botocore.config import Config
+
+    # one connection per transfer thread.
+    config = Config(max_pool_connections=max(10, concurrency))
+    return boto3.session.Session().client("s3", endpoint_url=endpoint_url, region_name=region, config=config)
+
+
+@lru_cache(maxsize=None)
+def gs_client():
+    from google.cloud import storage
+
+    return storage.Client()
+
+
+def s3_config(part_size, concurrency):
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                          max_concurrency=concurrency, use_threads=concurrency > 1)
+
+
+def exists(url, endpoint_url=None, region=None, **_):
+    scheme, bucket, key = parse_url(url)
+    if scheme == "gs":
+        return gs_client().bucket(bucket).blob(key).exists()
+
+    from botocore.exceptions import ClientError
+
+    try:
+        s3_client(endpoint_url, region).head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+def upload(path, url, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY, endpoint_url=None, region=None,
+           acl=None):
+    """
+    uploads a local file, in parts of :code:`part_size` bytes, :code:`concurrency` parts at a time.
+
+    :param acl: the canned ACL of the s3 object, e.g. "public-read".
+    """
+    scheme, bucket, key = parse_url(url)
+    if scheme == "gs":
+        from google.cloud.storage import transfer_manager
+
+        blob = gs_client().bucket(bucket).blob(key)
+        if os.path.getsize(path) <= part_size:
+            return blob.upload_from_filename(path)
+        return transfer_manager.upload_chunks_concurrently(path, blob, chunk_size=part_size, max_workers=concurrency)
+
+    extra_args = {"ACL": acl} if acl else None
+    s3_client(endpoint_url, region, concurrency).upload_file(path, bucket, key, ExtraArgs=extra_args,
+                                                             Config=s3_config(part_size, concurrency))
+
+
+def upload_stream(write, url, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY, endpoint_url=None,
+                  region=None, acl=None):
+    """
+    uploads the bytes that :code:`write(sink)` produces, while they are being produced.
+
+    :param write: a function that writes the content to the file object it is given, e.g. :code:`Packer.pack`.
+    """
+    scheme, bucket, key = parse_url(url)
+    read_fd, write_fd = os.pipe()
+    error = []
+
+    def produce():
+        try:
+            with open(write_fd, "wb") as sink:
+                write(sink)
+        except BaseException as e:
+            error.append(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    with open(read_fd, "rb") as source:
+        if scheme == "gs":
+            blob = gs_client().bucket(bucket).blob(key)
+            # resumable upload, in chunks of part_size.
+            blob.chunk_size = part_size
+            blob.upload_from_file(source)
+        else:
+            extra_args = {"ACL": acl} if acl else None
+            s3_client(endpoint_url, region, concurrency).upload_fileobj(source, bucket, key, ExtraArgs=extra_args,
+                                                                        Config=s3_config(part_size, concurrency))
+    producer.join()
+    if error:
+        # the pipe closed early, so the object that was uploaded is truncated.
+        delete(url, endpoint_url=endpoint_url, region=region)
+        raise error[0]
+
+
+def read(url, endpoint_url=None, region=None, **_):
+    """:return: the content of a small object, in one request, or None when it does not exist."""
+    scheme, bucket, key = parse_url(url)
+    if scheme == "gs":
+        from google.api_core.exceptions import NotFound
+
+        try:
+            return gs_client().bucket(bucket).blob(key).download_as_bytes()
+        except NotFound:
+            return None
+
+    from botocore.exceptions import ClientError
+
+    try:
+        return s3_client(endpoint_url, region).get_object(Bucket=bucket, Key=key)["Body"].read()
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+
+def download(url, path, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY, endpoint_url=None,
+             region=None, **_):
+    """downloads an object with parallel ranged reads."""
+    scheme, bucket, key = parse_url(url)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if scheme == "gs":
+        from google.cloud.storage import transfer_manager
+
+        blob = gs_client().bucket(bucket).get_blob(key)
+        return transfer_manager.download_chunks_concurrently(blob, path, chunk_size=part_size, max_workers=concurrency)
+
+    s3_client(endpoint_url, region, concurrency).download_file(bucket, key, path,
+                                                               Config=s3_config(part_size, concurrency))
+
+
+def delete(url, endpoint_url=None, region=None, **_):
+    scheme, bucket, key = parse_url(url)
+    if scheme == "gs":
+        return gs_client().bucket(bucket).blob(key).delete()
+    s3_client(endpoint_url, region).delete_object(Bucket=bucket, Key=key)
+
+
+def list_objects(url, endpoint_url=None, region=None, **_):
+    """:return: a dictionary from the keys under the url prefix, relative to it, to the object sizes."""
+    scheme, bucket, prefix = parse_url(url)
+    prefix = prefix.rstrip("/") + "/" if prefix else ""
+    if scheme == "gs":
+        return {b.name[len(prefix):]: b.size for b in gs_client().list_blobs(bucket, prefix=prefix)}
+
+    objects = {}
+    paginator = s3_client(endpoint_url, region).get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            objects[obj["Key"][len(prefix):]] = obj["Size"]
+    return objects
+
+
+def sync(url, local_dir, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY, **options):
+    """
+    downloads the objects under the url prefix that are missing locally, or differ in size, the way
+    :code:`aws s3 sync` does.
+
+    :return: the relative paths that were downloaded.
+    """
+    changed = []
+    for rel_path, size in list_objects(url, **options).items():
+        if not rel_path or rel_path.endswith("/"):
+            continue
+        local_path = os.path.join(local_dir, rel_path)
+        if not os.path.exists(local_path) or os.path.getsize(local_path) != size:
+            changed.append(rel_path)
+
+    prefix = url.rstrip("/")
+    with ThreadPoolExecutor(concurrency) as pool:
+        # small objects in parallel, the parts of large ones are parallel already.
+        list(pool.map(lambda p: download(f"{prefix}/{p}", os.path.join(local_dir, p), part_size=part_size,
+                                         concurrency=1, **options), changed))
+    return changed
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Sync an s3:// or gs:// prefix to a local directory.')
+    parser.add_argument('command', choices=['sync'])
+    parser.add_argument('url')
+    parser.add_argument('local_dir')
+    parser.add_argument('--endpoint-url', dest='endpoint_url', default=None)
+    parser.add_argument('--region', dest='region', default=None)
+    parser.add_argument('--part-size', dest='part_size', type=int, default=DEFAULT_PART_SIZE)
+    parser.add_argument('--concurrency', dest='concurrency', type=int, default=DEFAULT_CONCURRENCY)
+
+    args = parser.parse_args()
+    options = dict(part_size=args.part_size, concurrency=args.concurrency)
+    if args.endpoint_url or args.region:
+        options.update(endpoint_url=args.endpoint_url, region=args.region)
+    for p in sync(args.url, args.local_dir, **options):
+        print(f"download: {args.url.rstrip('/')}/{p} to {os.path.join(args.local_dir, p)}")
@@ -0,0 +1,290 @@
+"""
+Waiting for launched jobs.
+
+:code:`wait(jobs)` blocks on many jobs at once, and returns as soon as the first, or all of them, finish.
+A watcher looks up the states of all pending jobs in one query per round: one :code:`sacct` call for Slurm,
+batched :code:`describe_instances` calls for EC2, a watch stream of the API for Kubernetes, and
+long-polls for the handles of a result channel. Between rounds of watchers that can not subscribe to events,
+:code:`wait` backs off exponentially.
+
+.. code:: python
+
+    ids = jaynes.execute()
+    done, pending = wait(ids, EC2Instances(region="us-west-2"), return_when=FIRST_COMPLETED)
+"""
+import random
+import shlex
+import subprocess
+import time
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+FIRST_COMPLETED = "FIRST_COMPLETED"
+ALL_COMPLETED = "ALL_COMPLETED"
+
+
+def backoff(initial=1, factor=2, maximum=60, jitter=0.1):
+    """yields the intervals of an exponential backoff, with a little jitter so that clients do not align."""
+    interval = initial
+    while True:
+        yield interval * (1 + random.uniform(-jitter, jitter))
+        interval = min(interval * factor, maximum)
+
+
+class Watcher:
+    """
+    Looks up the states of many jobs in bulk. Subclasses implement :code:`poll`, and :code:`watch` where the
+    backend can notify on changes.
+    """
+
+    def poll(self, jobs):
+        """:return: a dictionary of job to RUNNING, DONE or FAILED, for all jobs."""
+        raise NotImplementedError
+
+    def watch(self, jobs, timeout):
+        """
+        blocks until one of the jobs finishes, or the timeout.
+
+        :return: the states like poll, or None when the backend has no events, and wait should poll instead.
+        """
+        return None
+
+
+class Handles(Watcher):
+    """
+    the handles returned by jaynes.add and jaynes.run with a result channel, see jaynes.results.
+
+    :param max_polls: the number of handles long-polled at a time. Each round takes the next ones.
+    :param poll_timeout: seconds of each long-poll. A round ends at most this long after the first result.
+    """
+
+    def __init__(self, max_polls=8, poll_timeout=2):
+        self.max_polls = max_polls
+        self.poll_timeout = poll_timeout
+        self.rounds = 0
+
+    @staticmethod
+    def state(result):
+        return RUNNING if result is None else FAILED if result["error"] else DONE
+
+    def poll(self, jobs):
+        return {h: self.state(h.wait(timeout=0)) for h in jobs}
+
+    def watch(self, jobs, timeout):
+        if not all(h.channel.startswith(("http://", "https://")) for h in jobs):
+            return None
+        import threading
+        from concurrent.futures import ThreadPoolExecutor, wait as wait_futures, FIRST_COMPLETED as FIRST
+
+        # the server answers a long-poll as soon as its result arrives. The polls are short, and check stop in
+        # between, so that none outlives the round by more than poll_timeout.
+        stop = threading.Event()
+        deadline = time.time() + timeout
+
+        def long_poll(h):
+            while not stop.is_set() and time.time() < deadline:
+                if h.wait(max(0, min(self.poll_timeout, deadline - time.time()))) is not None:
+                    return
+
+        start = self.rounds * self.max_polls % len(jobs)
+        polled = (jobs[start:] + jobs[:start])[:self.max_polls]
+        self.rounds += 1
+        pool = ThreadPoolExecutor(len(polled), thread_name_prefix="jaynes-wait")
+        futures = [pool.submit(long_poll, h) for h in polled]
+        try:
+            wait_futures(futures, timeout=timeout + self.poll_timeout + 30, return_when=FIRST)
+        finally:
+            # nothing is queued, one thread per poll, and the running polls end on stop.
+            stop.set()
+            pool.shutdown(wait=False)
+        # the polled handles keep their results, the others are checked once, without waiting.
+        return self.poll(jobs)
+
+
+class SlurmJobs(Watcher):
+    """
+    Slurm job ids, e.g. the array job ids returned by :code:`jaynes.execute`. An array job is done when all of its
+    tasks are, and failed when one of them failed. Takes the configuration of the SSH launcher, to query the login
+    node.
+
+    :param ip: the login node, runs sacct locally when None.
+    """
+    FAILED_STATES = {"FAILED", "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL", "BOOT_FAIL", "DEADLINE",
+                     "PREEMPTED"}
+
+    def __init__(self, ip=None, port=None, username=None, pem=None, **_):
+        self.ssh = []
+        if ip:
+            self.ssh = ["ssh", "-o", "BatchMode=yes"] + (["-p", str(port)] if port else []) + \
+                       (["-i", pem] if pem else []) + [f"{username}@{ip}" if username else ip]
+
+    def poll(self, jobs):
+        cmd = ["sacct", "-n", "-P", "-X", "--format=JobID,State", "-j", ",".join(jobs)]
+        if self.ssh:
+            cmd = self.ssh + [shlex.join(cmd)]
+        return self.parse(subprocess.check_output(cmd).decode(), jobs)
+
+    @classmethod
+    def parse(cls, output, jobs):
+        """:param output: of sacct -P, with one JobID|State line per job, or per task of an array job."""
+        tasks = {job: [] for job in jobs}
+        for line in output.splitlines():
+            if "|" not in line:
+                continue
+            job_id, state = line.split("|")[:2]
+            # e.g. "CANCELLED by 1001"
+            state = state.split()[0] if state else "PENDING"
+            for key in {job_id, job_id.split("_")[0]}:
+                if key in tasks:
+                    tasks[key].append(state)
+        states = {}
+        for job, task_states in tasks.items():
+            if not task_states or any(s != "COMPLETED" and s not in cls.FAILED_STATES for s in task_states):
+                states[job] = RUNNING
+            else:
+                states[job] = FAILED if any(s in cls.FAILED_STATES for s in task_states) else DONE
+        return states
+
+
+class EC2Instances(Watcher):
+    """
+    instance ids, or the spot request ids returned by the EC2 launcher. An instance is done when it stops or
+    terminates, which the launch script does at the end, or when EC2 no longer lists it, about an hour after it
+    terminated. A spot request that closes without an instance failed.
+
+    :param batch_size: ids per describe call.
+    """
+
+    def __init__(self, region=None, batch_size=200, **_):
+        self.region = region
+        self.batch_size = batch_size
+
+    def poll(self, jobs):
+        from .launchers.ec2_launch import ec2_client
+
+        ec2 = ec2_client(self.region)
+        states, instances = {}, {}
+        spot_requests = [j for j in jobs if j.startswith("sir-")]
+        for i in range(0, len(spot_requests), self.batch_size):
+            response = ec2.describe_spot_instance_requests(SpotInstanceRequestIds=spot_requests[i:i + self.batch_size])
+            for request in response["SpotInstanceRequests"]:
+                if request.get("InstanceId"):
+                    instances[request["InstanceId"]] = request["SpotInstanceRequestId"]
+                elif request["State"] in ("cancelled", "closed", "failed"):
+                    states[request["SpotInstanceRequestId"]] = FAILED
+        instances.update({j: j for j in jobs if not j.startswith("sir-")})
+
+        ids, listed = list(instances), set()
+        for i in range(0, len(ids), self.batch_size):
+            # a filter, because InstanceIds fails the whole call on an id that is no longer listed.
+            filters = [{"Name": "instance-id", "Values": ids[i:i + self.batch_size]}]
+            for page in ec2.get_paginator("describe_instances").paginate(Filters=filters):
+                for reservation in page["Reservations"]:
+                    for instance in reservation["Instances"]:
+                        listed.add(instance["InstanceId"])
+                        if instance["State"]["Name"] in ("stopped", "terminated"):
+                            states[instances[instance["InstanceId"]]] = DONE
+        for instance_id in set(ids) - listed:
+            states[instances[instance_id]] = DONE
+        return {j: states.get(j, RUNNING) for j in jobs}
+
+
+class KubeJobs(Watcher):
+    """
+    the names of Kubernetes jobs. Lists the jobs of the namespace through the API, and watches them with one
+    watch stream, which returns on the first Complete or Failed condition. See Kube.watcher.
+
+    :param namespace: default to the namespace of the client.
+    :param client: a jaynes.kube.KubeClient. Made from the kubeconfig and context when None.
+    """
+
+    def __init__(self, namespace=None, context=None, kubeconfig=None, client=None, **_):
+        self.namespace = namespace
+        self.context = context
+        self.kubeconfig = kubeconfig
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            from .kube import KubeClient
+
+            self._client = KubeClient(kubeconfig=self.kubeconfig, context=self.context)
+        return self._client
+
+    def poll(self, jobs):
+        from .kube import job_state
+
+        states = {job["metadata"]["name"]: job_state(job) for job in self.client.list("batch/v1", "Job", self.namespace)}
+        return {j: states.get(j, RUNNING) for j in jobs}
+
+    def watch(self, jobs, timeout):
+        from .kube import job_state
+
+        states = {j: RUNNING for j in jobs}
+        for _, job in self.client.watch("batch/v1", "Job", self.namespace, timeout=timeout):
+            name = job["metadata"]["name"]
+            if name in states:
+                states[name] = job_state(job)
+                if states[name] != RUNNING:
+                    break
+        return states
+
+
+def infer_watcher(jobs):
+    """picks the watcher for handles, EC2 ids and Slurm ids. Kubernetes jobs need a KubeJobs."""
+    from .results import Handle
+
+    if all(isinstance(j, Handle) for j in jobs):
+        return Handles()
+    if all(isinstance(j, str) and j.startswith(("i-", "sir-")) for j in jobs):
+        return EC2Instances()
+    if all(isinstance(j, str) and j.split("_")[0].isdigit() for j in jobs):
+        return SlurmJobs()
+    raise ValueError(f"can not tell how to wait for {jobs[:3]}, pass a watcher.")
+
+
+def wait(jobs, watcher=None, return_when=ALL_COMPLETED, timeout=None, initial=1, maximum=60, verbose=False):
+    """
+    blocks until the first, or all of the jobs finish.
+
+    :param jobs: the ids returned by jaynes.execute, or handles.
+    :param watcher: a Watcher for the backend. Inferred from the jobs when None.
+    :param return_when: FIRST_COMPLETED or ALL_COMPLETED.
+    :param timeout: seconds. Waits forever when None.
+    :param initial: the first polling interval, doubled up to maximum while nothing finishes.
+    :return: (done, pending), where done maps the finished jobs to DONE or FAILED.
+    """
+    from termcolor import cprint
+
+    jobs = list(jobs)
+    watcher = watcher or infer_watcher(jobs)
+    deadline = None if timeout is None else time.time() + timeout
+    done, pending = {}, jobs
+    intervals = backoff(initial, maximum=maximum)
+    while pending:
+        remaining = None if deadline is None else deadline - time.time()
+        states = watcher.watch(pending, maximum if remaining is None else min(maximum, remaining))
+        watched = states is not None
+        if not watched:
+            states = watcher.poll(pending)
+
+        finished = {j: s for j, s in states.items() if s != RUNNING}
+        done.update(finished)
+        pending = [j for j in pending if j not in finished]
+        if verbose and finished:
+            cprint(f"jaynes.wait: {len(done)} done, {len(pending)} pending", "green")
+        if finished and return_when == FIRST_COMPLETED:
+            break
+        if not pending or deadline is not None and time.time() >= deadline:
+            break
+        if finished:
+            # jobs of a sweep tend to finish together, so look again soon.
+            intervals = backoff(initial, maximum=maximum)
+        if not watched:
+            remaining = None if deadline is None else deadline - time.time()
+            interval = next(intervals)
+            time.sleep(interval if remaining is None else max(0, min(interval, remaining)))
+    return done, pending
@@ -0,0 +1,38 @@
+import os
+import re
+import subprocess
+
+from jaynes.constants import JAYNES_PARAMS_KEY
+from jaynes.runners import Simple
+
+
+def touch(path):
+    open(path, "w").close()
+
+
+def fail():
+    raise ValueError("bad seed")
+
+
+def run_entry(script):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(__file__))
+    return subprocess.run(script, shell=True, env=env, capture_output=True, cwd=os.path.dirname(os.path.dirname(__file__)))
+
+
+def test_batch_runs_all_thunks(tmp_path):
+    for workers in [1, 2]:
+        runner = Simple(work_dir=".", batch=True, workers=workers, shell="sh")
+        runner.build(touch, str(tmp_path / f"a-{workers}"))
+        runner.pack(fail)
+        runner.chain(touch, str(tmp_path / f"b-{workers}"))
+
+        assert runner.pack_table().run_script.count("jaynes.entry") == 1, "one interpreter for the whole batch"
+        main_script = re.search(f"{JAYNES_PARAMS_KEY}=.*", runner.main_script).group(0)
+        result = run_entry(main_script)
+
+        assert result.returncode == 1, "a failed thunk fails the batch"
+        assert (tmp_path / f"a-{workers}").exists() and (tmp_path / f"b-{workers}").exists()
+        report = result.stderr.decode()
+        assert re.search(r"jaynes thunk 0: ok in \d", report)
+        assert "jaynes thunk 1: failed with ValueError('bad seed')" in report
+        assert re.search(r"jaynes thunk 2: ok in \d", report)
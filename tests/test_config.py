@@ -0,0 +1,77 @@
+import yaml
+
+import jaynes.mounts
+from jaynes.jaynes import RUN, Jaynes
+
+CONFIG = """
+mounts: &shared
+  - !mounts.Counted {name: shared}
+run:
+  mounts: *shared
+  runner: !runners.Simple {work_dir: /tmp}
+  launch: {type: ssh, ip: localhost}
+modes:
+  a:
+    mounts: [!mounts.Counted {name: "a-{env.JAYNES_TEST_USER}"}]
+    runner: !runners.Simple {work_dir: /tmp}
+    launch: {type: ssh, ip: localhost}
+  b:
+    mounts: [!mounts.Counted {name: b}, !mounts.Counted {name: c}]
+    runner: !runners.Simple {work_dir: /tmp}
+    launch: {type: ssh, ip: localhost}
+"""
+
+
+class Counted:
+    created = []
+
+    def __init__(self, name):
+        self.name = name
+        Counted.created.append(name)
+
+    def upload(self, **_):
+        pass
+
+
+def configure(monkeypatch, config_path, mode):
+    for k, v in dict(launcher=None, runner_config=None, _raw_config=None, _uploaded=set()).items():
+        monkeypatch.setattr(Jaynes, k, v)
+    Jaynes.config(mode, config_path=str(config_path))
+    return Jaynes.mounts
+
+
+def test_only_the_selected_mode_is_constructed(tmp_path, monkeypatch):
+    monkeypatch.setenv("JAYNES_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("JAYNES_TEST_USER", "ge")
+    monkeypatch.setattr(jaynes.mounts, "Counted", Counted, raising=False)
+    monkeypatch.setattr(Counted, "created", [])
+    monkeypatch.setattr(RUN, "config_root", None)
+    config_path = tmp_path / ".jaynes.yml"
+    config_path.write_text(CONFIG)
+
+    mounts = configure(monkeypatch, config_path, "a")
+    assert [m.name for m in mounts] == ["a-ge"]
+    assert Counted.created == ["a-ge"], "the root mounts are overridden by the mode, and the other modes are unused"
+
+    mounts = configure(monkeypatch, config_path, None)
+    assert mounts[0] is Jaynes.raw_config(str(config_path))["mounts"][0], "the anchor points at one mount"
+
+
+def test_parse_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("JAYNES_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(jaynes.mounts, "Counted", Counted, raising=False)
+    monkeypatch.setattr(Counted, "created", [])
+    monkeypatch.setattr(RUN, "config_root", None)
+    config_path = tmp_path / ".jaynes.yml"
+    config_path.write_text(CONFIG)
+    configure(monkeypatch, config_path, "b")
+
+    def no_parse(*_):
+        raise AssertionError("the cached parse is used")
+
+    with monkeypatch.context() as m:
+        m.setattr(yaml, "safe_load", no_parse)
+        assert [m.name for m in configure(m, config_path, "b")] == ["b", "c"]
+
+    config_path.write_text(CONFIG.replace("name: c", "name: d"))
+    assert [m.name for m in configure(monkeypatch, config_path, "b")] == ["b", "d"]
@@ -0,0 +1,64 @@
+import asyncio
+import os
+
+from jaynes.daemon import JaynesDaemon
+from jaynes.manifest import diff, is_excluded, scan
+
+
+def test_excludes():
+    assert is_excluded("a/__pycache__", ["*__pycache__"])
+    assert is_excluded(".git", ["*.git"])
+    assert is_excluded("src/model.pkl", ["*.pkl"])
+    assert is_excluded("build/lib/x.py", ["build"]), "matches a leading component"
+    assert not is_excluded("src/model.py", ["*.pkl"])
+
+
+def test_scan_and_diff(tmp_path):
+    (tmp_path / "a.py").write_text("a")
+    (tmp_path / "__pycache__").mkdir()
+    (tmp_path / "__pycache__" / "a.pyc").write_text("cache")
+
+    manifest = scan(str(tmp_path))
+    assert list(manifest) == ["a.py"]
+
+    (tmp_path / "b.py").write_text("b")
+    os.utime(tmp_path / "a.py", ns=(0, 0))
+    new = scan(str(tmp_path), previous=manifest)
+    changed, deleted = diff(manifest, new)
+    assert changed == ["b.py"], "touching a file without changing it does not count as a change"
+
+    (tmp_path / "a.py").unlink()
+    changed, deleted = diff(new, scan(str(tmp_path), previous=new))
+    assert (changed, deleted) == ([], ["a.py"])
+
+
+class FakeClient:
+    def __init__(self, server):
+        self.server = server
+        self.updated, self.commands = [], []
+
+    async def update_file(self, file, remote_path=None, overwrite=True):
+        self.updated.append(remote_path)
+        return {"status": 1}
+
+    async def execute(self, cmd, timeout=None):
+        self.commands.append(cmd)
+        return ["", "", 0]
+
+
+def test_daemon_pushes_delta(tmp_path):
+    (tmp_path / "a.py").write_text("a")
+    (tmp_path / "b.py").write_text("b")
+
+    daemon = JaynesDaemon(local_path=str(tmp_path), remote_path="/mnt/code", debounce=0.01)
+    daemon.clients = [FakeClient("a"), FakeClient("b")]
+    daemon.manifest = daemon.scan()
+
+    (tmp_path / "a.py").write_text("changed")
+    (tmp_path / "b.py").unlink()
+    changed, deleted = asyncio.run(daemon.sync_once())
+
+    assert (changed, deleted) == (["a.py"], ["b.py"])
+    for client in daemon.clients:
+        assert client.updated == ["/mnt/code/a.py"]
+        assert client.commands == ["rm -f /mnt/code/b.py"]
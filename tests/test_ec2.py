@@ -0,0 +1,219 @@
+import base64
+import os
+import re
+import subprocess
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from jaynes.constants import JAYNES_PARAMS_KEY  # noqa: E402
+from jaynes.jaynes import RUN, Jaynes  # noqa: E402
+from jaynes.launchers import ec2_launch  # noqa: E402
+from jaynes.launchers.base_launcher import bootstrap_script  # noqa: E402
+from jaynes.launchers.ec2_launch import EC2  # noqa: E402
+from jaynes.param_codec import PayloadTooLarge, decode  # noqa: E402
+from jaynes.runners import Simple  # noqa: E402
+from jaynes.stores import S3, digest  # noqa: E402
+from moto.core import DEFAULT_ACCOUNT_ID as ACCOUNT_ID  # noqa: E402
+
+
+@pytest.fixture
+def moto_aws(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        ec2_launch.ec2_client.cache_clear()
+        boto3.client("iam").create_instance_profile(InstanceProfileName="jaynes")
+        yield
+    ec2_launch.ec2_client.cache_clear()
+
+
+@pytest.fixture
+def aws(moto_aws, monkeypatch):
+    # the plan is set by the test.
+    monkeypatch.setattr(EC2, "plan_instance", lambda self, verbose=None: None)
+
+
+def square(x):
+    return x * x
+
+
+class MotoS3(S3):
+    """uploads with boto3, instead of the aws cli."""
+
+    def upload(self, verbose=None, **_):
+        bucket, prefix = self.prefix[len("s3://"):].split("/", 1)
+        for key, path in self.staged.items():
+            boto3.client("s3").upload_file(path, bucket, f"{prefix}/{key}")
+
+
+def read(ref):
+    bucket, key = ref[len("s3://"):].split("/", 1)
+    return boto3.client("s3").get_object(Bucket=bucket, Key=key)["Body"].read().decode()
+
+
+def spec(script, region="us-east-1", **kwargs):
+    return {**dict(launch_script=script, image_id="ami-12c6146b", instance_type="t2.micro", key_name="key",
+                   security_group="default", region=region, tags={"sweep": "lr"}, name="jaynes",
+                   iam_instance_profile_arn=f"arn:aws:iam::{ACCOUNT_ID}:instance-profile/jaynes"), **kwargs}
+
+
+def test_grouped_spot_requests(aws):
+    launcher = EC2()
+    launcher.instance_plan.extend([spec("echo a", spot_price=0.1), spec("echo b", spot_price=0.1),
+                                   spec("echo a", spot_price=0.1), spec("echo a", "us-west-2", spot_price=0.1)])
+    ids = launcher.execute()
+    assert len(ids) == 4 and all(i.startswith("sir-") for i in ids) and len(set(ids)) == 4
+    assert ec2_launch.ec2_client.cache_info().currsize == 2, "one client per region"
+
+    requests = boto3.client("ec2", region_name="us-east-1").describe_spot_instance_requests()["SpotInstanceRequests"]
+    assert sorted(r["SpotInstanceRequestId"] for r in requests) == sorted(ids[:3])
+    assert all({"Key": "Name", "Value": "jaynes"} in r["Tags"] for r in requests), "tagged at creation"
+
+
+def test_on_demand_and_failures(aws):
+    launcher = EC2()
+    launcher.instance_plan.extend([spec("echo a"), spec("echo a"), spec("echo c", instance_type=None)])
+    with pytest.raises(RuntimeError, match="ec2 launch failed\n1 x None in us-east-1") as e:
+        launcher.execute()
+    assert launcher.instance_plan == []
+
+    reservations = boto3.client("ec2", region_name="us-east-1").describe_instances()["Reservations"]
+    instances = [i for r in reservations for i in r["Instances"]]
+    assert len(reservations) == 1 and len(instances) == 2, "one request for the identical instances"
+    assert all(i["InstanceId"] in str(e.value) for i in instances)
+
+
+class Runner:
+    def __init__(self, thunk_store):
+        self.thunk_store = thunk_store
+
+
+def test_instance_states(moto_aws):
+    from jaynes.wait import DONE, RUNNING, EC2Instances
+
+    ec2 = boto3.client("ec2", region_name="us-east-1")
+    ids = [i["InstanceId"] for i in ec2.run_instances(ImageId="ami-12c6146b", MinCount=2, MaxCount=2)["Instances"]]
+    ec2.terminate_instances(InstanceIds=ids[1:])
+    # terminated an hour ago, and no longer listed.
+    gone = "i-0123456789abcdef0"
+    states = EC2Instances(region="us-east-1", batch_size=2).poll([*ids, gone])
+    assert states == {ids[0]: RUNNING, ids[1]: DONE, gone: DONE}
+
+
+def test_bootstrap_stub(tmp_path):
+    store = S3("s3://jaynes-test/thunks")
+    launcher = EC2()
+    launcher.runners = [Runner(store)]
+    launch_script = "#!/bin/bash\necho " + "x" * 20_000
+    stub = launcher.instance_script(launch_script, "ec2")
+    assert len(stub) < 2000 and "aws s3 cp --only-show-errors $1" in stub and "s3://jaynes-test/thunks/" in stub
+    assert launcher.thunk_store is store and len(store.staged) == 1
+
+    launcher = EC2(bootstrap=False)
+    launcher.runners = [Runner(store)]
+    with pytest.raises(PayloadTooLarge):
+        launcher.instance_script(launch_script, "ec2")
+
+    # the first boot fetches the script, with an aws cli that copies the staged file.
+    script = "#!/bin/bash\necho hello"
+    stub = bootstrap_script(script, store, cache_dir=str(tmp_path / "cache"))
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "aws").write_text(f"#!/bin/sh\necho fetched >&2\ncp {store.staged[digest(script.encode())]} $5\n")
+    (bin_dir / "aws").chmod(0o755)
+    env = dict(os.environ, PATH=f"{bin_dir}:{os.environ['PATH']}")
+    first = subprocess.run(["bash", "-c", stub], env=env, capture_output=True)
+    assert (first.stdout, first.stderr) == (b"hello\n", b"fetched\n")
+    # and the next boots use the cache.
+    assert subprocess.run(["bash", "-c", stub], env=env, capture_output=True).stderr == b""
+
+
+def test_bootstrap_failure_terminates(tmp_path):
+    """an instance that can not fetch its launch script terminates, instead of idling."""
+    stub = bootstrap_script("#!/bin/bash\necho hello", S3("s3://jaynes-test/thunks"), cache_dir=str(tmp_path / "cache"))
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for command, body in [("aws", 'echo "aws $*" >> $LOG; [ "$2" = terminate-instances ]'), ("wget", "echo i-123"),
+                          ("sleep", "true"), ("shutdown", 'echo "shutdown $*" >> $LOG')]:
+        (bin_dir / command).write_text(f"#!/bin/sh\n{body}\n")
+        (bin_dir / command).chmod(0o755)
+    log = tmp_path / "log"
+    env = dict(os.environ, PATH=f"{bin_dir}:{os.environ['PATH']}", LOG=str(log))
+    p = subprocess.run(["bash", "-c", stub], env=env, capture_output=True)
+    assert p.returncode == 1 and b"hello" not in p.stdout and b"jaynes bootstrap failed" in p.stderr
+    calls = log.read_text().splitlines()
+    assert sum(c.startswith("aws s3 cp") for c in calls) == 5, "retries the download"
+    assert "aws ec2 terminate-instances --instance-ids i-123 --region i-123" in calls and calls[-1] == "shutdown -h now"
+
+
+def test_table_stub_reads_the_launch_index_with_imdsv2(tmp_path):
+    store = S3("s3://jaynes-test/thunks")
+    table = "\n".join(store.put(f"#!/bin/bash\necho row {i}".encode()) for i in range(3))
+    stub = ec2_launch.table_script(store.put(table.encode()), offset=1, cache_dir=str(tmp_path / "cache"))
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    copies = "".join(f'[ "${{4##*/}}" = {key} ] && cp {path} $5\n' for key, path in store.staged.items())
+    # the metadata service of an instance that requires IMDSv2 answers 401 without a token.
+    curl = """case "$*" in
+    *"-X PUT -H X-aws-ec2-metadata-token-ttl-seconds: 300 "*/latest/api/token) echo token-1 ;;
+    *"-H X-aws-ec2-metadata-token: token-1 "*/meta-data/ami-launch-index) echo 1 ;;
+    *) exit 22 ;;
+    esac"""
+    for command, body in [("aws", copies + "true"), ("curl", curl)]:
+        (bin_dir / command).write_text(f"#!/bin/sh\n{body}\n")
+        (bin_dir / command).chmod(0o755)
+    env = dict(os.environ, PATH=f"{bin_dir}:{os.environ['PATH']}")
+    p = subprocess.run(["bash", "-c", stub], env=env, capture_output=True)
+    assert (p.stdout, p.stderr) == (b"row 2\n", b""), "the instance with launch index 1 runs the row 1 + offset"
+
+
+def test_sweep_goes_out_in_one_request(moto_aws, monkeypatch, tmp_path):
+    """each instance of the reservation runs the row of its ami-launch-index, from a table in the store."""
+    boto3.client("s3").create_bucket(Bucket="jaynes-test")
+    store = MotoS3("s3://jaynes-test/thunks")
+    config = {k: v for k, v in spec(None).items() if k != "launch_script"}
+    monkeypatch.setattr(RUN, "config_root", str(tmp_path))
+    monkeypatch.setattr(Jaynes, "mode", "ec2")
+    monkeypatch.setattr(Jaynes, "launcher", EC2(type="ec2", spot_price=0.1, terminate_after=True, **config))
+    monkeypatch.setattr(Jaynes, "runner_config", (Simple, {"work_dir": str(tmp_path)}))
+    monkeypatch.setattr(Jaynes, "mounts", [])
+    monkeypatch.setattr(Jaynes, "thunk_store", store)
+
+    ids = Jaynes.map(square, [dict(x=x) for x in range(3)])
+
+    reservation, = boto3.client("ec2", region_name="us-east-1").describe_instances()["Reservations"]
+    instances = sorted(reservation["Instances"], key=lambda i: i["AmiLaunchIndex"])
+    assert ids == [i["InstanceId"] for i in instances]
+    assert all(i["InstanceLifecycle"] == "spot" for i in instances)
+    user_data = boto3.client("ec2", region_name="us-east-1").describe_instance_attribute(
+        InstanceId=ids[0], Attribute="userData")["UserData"]["Value"]
+    stub = base64.b64decode(user_data).decode()
+    table = re.search(r"jaynes_fetch (s3://\S+)", stub).group(1)
+    assert "ami-launch-index" in stub and len(stub) < 2000
+
+    for x, ref in enumerate(read(table).splitlines()):
+        payload = re.search(f"{JAYNES_PARAMS_KEY}=(\\S+)", read(ref)).group(1)
+        assert decode(read(payload))["kwargs"] == {"x": x}, "the rows are in the order of the sweep"
+
+
+def test_table_launches_the_rest_without_capacity():
+    from botocore.exceptions import ClientError
+
+    class Client:
+        calls = []
+
+        def run_instances(self, MinCount, MaxCount, UserData, **_):
+            Client.calls.append((MinCount, MaxCount, re.search(r"JAYNES_INDEX \+ (\d+)", UserData).group(1)))
+            if MinCount > 1:
+                raise ClientError({"Error": {"Code": "InsufficientInstanceCapacity"}}, "RunInstances")
+            launched = len(Client.calls)
+            return {"Instances": [{"InstanceId": f"i-{launched}{n}", "AmiLaunchIndex": n} for n in range(min(2, MaxCount))]}
+
+    spec_ = {k: v for k, v in spec(None).items() if k != "launch_script"}
+    ids = ec2_launch.launch_table("s3://jaynes-test/thunks/table", 5, client=Client(), **spec_)
+    assert ids == ["i-20", "i-21", "i-30", "i-31", "i-40"]
+    assert Client.calls == [(5, 5, "0"), (1, 5, "0"), (1, 3, "2"), (1, 1, "4")], "the offset moves with the launched rows"
@@ -0,0 +1,343 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import yaml
+from io import StringIO
+from urllib.parse import parse_qs, urlparse
+
+from jaynes.constants import JAYNES_INDEX_VAR_KEY, JAYNES_PARAMS_KEY
+from jaynes.kube import JOB_LABEL, KubeClient, Monitor, load_config
+from jaynes.launchers.kube_launch import Kube
+from jaynes.runners import Container
+from jaynes.wait import DONE
+
+
+def square(x):
+    print(x * x)
+
+
+def job(name):
+    return {"apiVersion": "batch/v1", "kind": "Job", "metadata": {"name": name, "namespace": "test"},
+            "spec": {"template": {"spec": {"containers": [{"name": name, "image": "python"}]}}}}
+
+
+@pytest.fixture
+def api():
+    """a fake API server. Throttles the first request to throttled-job, and rejects bad-job."""
+    state = dict(applied={}, requests=[], throttled=False)
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *_):
+            pass
+
+        def reply(self, status, body, headers={}):
+            blob = json.dumps(body).encode()
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(blob)))
+            self.end_headers()
+            self.wfile.write(blob)
+
+        def do_PATCH(self):
+            state["requests"].append((self.path, self.headers["Content-Type"]))
+            obj = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if self.headers["Content-Type"] == "application/merge-patch+json":
+                applied = state["applied"][urlparse(self.path).path.split("/")[-1]]
+                applied["metadata"].update(obj["metadata"])
+                return self.reply(200, applied)
+            name = obj["metadata"]["name"]
+            obj["metadata"]["uid"] = f"uid-{name}"
+            if name == "throttled-job" and not state["throttled"]:
+                state["throttled"] = True
+                return self.reply(429, {"kind": "Status", "message": "too many requests"}, {"Retry-After": "0"})
+            if name == "bad-job":
+                return self.reply(422, {"kind": "Status", "message": 'Job.batch "bad-job" is invalid'})
+            state["applied"][name] = obj
+            self.reply(200, obj)
+
+        def do_GET(self):
+            name = urlparse(self.path).path.split("/")[-1]
+            if name in state["applied"]:
+                return self.reply(200, state["applied"][name])
+            names = sorted(state["applied"])
+            start = int(self.path.split("continue=")[1]) if "continue=" in self.path else 0
+            self.reply(200, {"items": [state["applied"][n] for n in names[start:start + 2]],
+                             "metadata": {"continue": str(start + 2) if start + 2 < len(names) else ""}})
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state["server"] = f"http://127.0.0.1:{server.server_port}"
+    yield state
+    server.shutdown()
+
+
+def test_apply_all(api):
+    client = KubeClient(server=api["server"])
+    results = client.apply_all([job("a-job"), job("throttled-job"), job("bad-job"), job("c-job")],
+                               concurrency=2, chunk_size=3)
+    assert [name for name, _ in results] == ["a-job", "throttled-job", "bad-job", "c-job"]
+    (name, error), = [r for r in results if r[1] is not None]
+    assert name == "bad-job" and error.status == 422 and "is invalid" in str(error)
+    assert api["throttled"] and sorted(api["applied"]) == ["a-job", "c-job", "throttled-job"]
+
+    path, content_type = api["requests"][0]
+    assert path.startswith("/apis/batch/v1/namespaces/test/jobs/") and "fieldManager=jaynes" in path
+    assert content_type == "application/apply-patch+yaml"
+    listed = client.list("batch/v1", "Job", namespace="test", limit=2)
+    assert [j["metadata"]["name"] for j in listed] == ["a-job", "c-job", "throttled-job"]
+
+
+def test_launcher(api, tmp_path):
+    launcher = Kube(namespace="test", server=api["server"], concurrency=4)
+    launcher.jobs = [job("a-job"), job("bad-job")]
+    with pytest.raises(RuntimeError, match="1 of 2 kubernetes jobs failed\nbad-job: 422"):
+        launcher.execute()
+    assert launcher.jobs == [] and "a-job" in api["applied"]
+
+    launcher = Kube(namespace="test", server=api["server"], dry=True)
+    launcher.jobs = [job("dry-job")]
+    with open(launcher.execute()) as f:
+        assert [j["metadata"]["name"] for j in yaml.safe_load_all(f)] == ["dry-job"]
+    assert "dry-job" not in api["applied"]
+
+
+def test_namespace_of_the_context(api, tmp_path, monkeypatch):
+    kubeconfig = tmp_path / "config"
+    kubeconfig.write_text(yaml.safe_dump({
+        "current-context": "sweeps",
+        "contexts": [{"name": "sweeps", "context": {"cluster": "fake", "namespace": "team"}}],
+        "clusters": [{"name": "fake", "cluster": {"server": api["server"]}}]}))
+    launcher = Kube(kubeconfig=str(kubeconfig))
+    unnamed = job("a-job")
+    del unnamed["metadata"]["namespace"]
+    launcher.jobs = [unnamed]
+    launcher.execute()
+    assert api["requests"][-1][0].startswith("/apis/batch/v1/namespaces/team/jobs/a-job")
+    assert launcher.watcher().client.namespace == "team"
+
+    # inside a cluster, from the service account.
+    (tmp_path / "token").write_text("secret")
+    (tmp_path / "namespace").write_text("runner\n")
+    monkeypatch.setattr("jaynes.kube.IN_CLUSTER_DIR", str(tmp_path))
+    monkeypatch.setenv("KUBERNETES_SERVICE_HOST", "10.0.0.1")
+    assert load_config(str(tmp_path / "missing"))["namespace"] == "runner"
+
+
+def test_certificates_are_written_once(tmp_path):
+    import base64
+
+    data = {name: base64.b64encode(name.encode()).decode() for name in ("ca", "crt", "key")}
+    kubeconfig = tmp_path / "config"
+    kubeconfig.write_text(yaml.safe_dump({
+        "current-context": "c",
+        "contexts": [{"name": "c", "context": {"cluster": "fake", "user": "me"}}],
+        "clusters": [{"name": "fake", "cluster": {"server": "https://k8s", "certificate-authority-data": data["ca"]}}],
+        "users": [{"name": "me", "user": {"client-certificate-data": data["crt"], "client-key-data": data["key"]}}]}))
+
+    first, second = load_config(str(kubeconfig)), load_config(str(kubeconfig))
+    assert (first["verify"], first["cert"]) == (second["verify"], second["cert"]), "one directory per process"
+    paths = [first["verify"], *first["cert"]]
+    assert [open(p).read() for p in paths] == ["ca", "crt", "key"]
+    assert len({os.path.dirname(p) for p in paths}) == 1
+
+
+def test_indexed_job(tmp_path):
+    runner = Container(image="python", name="sweep", mounts=[], indexed=True, parallelism=2, backoff_limit_per_index=2)
+    runner.build(square, 1)
+    for x in range(2, 5):
+        runner.pack(square, x)
+
+    config_map, job = runner.manifests
+    assert config_map["kind"] == "ConfigMap" and sorted(config_map["data"]) == ["0", "1", "2", "3"]
+    assert job["spec"]["completionMode"] == "Indexed"
+    assert (job["spec"]["completions"], job["spec"]["parallelism"]) == (4, 2)
+    assert (job["spec"]["backoffLimit"], job["spec"]["backoffLimitPerIndex"]) == (1, 2)
+    container, = job["spec"]["template"]["spec"]["containers"]
+    assert container["volumeMounts"][0]["mountPath"] == Container.THUNK_DIR
+
+    # the pod of index 2, with the ConfigMap mounted.
+    for key, payload in config_map["data"].items():
+        (tmp_path / key).write_text(payload)
+    table = re.search(f"{JAYNES_PARAMS_KEY}=(\\S+)", container["command"][-1]).group(1)
+    assert table == f"file://{Container.THUNK_DIR}/"
+    env = dict(os.environ, **{JAYNES_PARAMS_KEY: f"file://{tmp_path}/", JAYNES_INDEX_VAR_KEY: "JOB_COMPLETION_INDEX",
+                              "JOB_COMPLETION_INDEX": "2", "PYTHONPATH": os.path.dirname(__file__)})
+    assert subprocess.check_output([sys.executable, "-m", "jaynes.entry"], env=env) == b"9\n"
+
+
+def test_thunks_owned_by_the_job(api):
+    """the ConfigMap of an indexed job is garbage collected with the job."""
+    runner = Container(image="python", name="sweep", mounts=[], indexed=True)
+    runner.build(square, 1)
+    runner.pack(square, 2)
+    launcher = Kube(namespace="test", server=api["server"])
+    launcher.jobs = runner.manifests
+    config_map, job = launcher.jobs
+    assert launcher.execute() == [job["metadata"]["name"]], "only the jobs are watched"
+
+    owner, = api["applied"][config_map["metadata"]["name"]]["metadata"]["ownerReferences"]
+    assert owner == {"apiVersion": "batch/v1", "kind": "Job", "name": job["metadata"]["name"],
+                     "uid": f"uid-{job['metadata']['name']}", "blockOwnerDeletion": True}
+
+
+def pod(name, job, index, phase):
+    return {"metadata": {"name": name, "resourceVersion": "1", "labels": {JOB_LABEL: job},
+                         "annotations": {"batch.kubernetes.io/job-completion-index": str(index)}},
+            "spec": {"containers": [{"name": job}]}, "status": {"phase": phase}}
+
+
+def test_monitor():
+    """one watch stream per kind, and at most one log stream at a time."""
+    streams = dict(open=0, most=0, watches=[])
+    lock = threading.Lock()
+    job = {"metadata": {"name": "sweep", "resourceVersion": "1", "labels": {JOB_LABEL: "sweep"}}}
+    done = {**job, "status": {"conditions": [{"type": "Complete", "status": "True"}]}}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *_):
+            pass
+
+        def send(self, *lines, delay=0.0):
+            for line in lines:
+                self.wfile.write(line.encode() + b"\n")
+                self.wfile.flush()
+                time.sleep(delay)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            self.send_response(200)
+            self.end_headers()
+            if "resourceVersion" in query:
+                # nothing new since the first stream.
+                return time.sleep(0.2)
+            if url.path.endswith("/log"):
+                with lock:
+                    streams["open"] += 1
+                    streams["most"] = max(streams["most"], streams["open"])
+                assert query["timestamps"] == ["true"]
+                self.send("2026-01-01T00:00:00.5Z line 0", "2026-01-01T00:00:01Z line 1", delay=0.05)
+                with lock:
+                    streams["open"] -= 1
+                return
+            streams["watches"].append((url.path, query["labelSelector"]))
+            if url.path.endswith("/jobs"):
+                self.send(json.dumps(dict(type="ADDED", object=job)), delay=0.5)
+                self.send(json.dumps(dict(type="MODIFIED", object=done)))
+            else:
+                self.send(*[json.dumps(dict(type="ADDED", object=pod(f"sweep-{i}", "sweep", i, "Running")))
+                            for i in range(3)],
+                          json.dumps(dict(type="ADDED", object=pod("other-0", "other", 0, "Running"))))
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        out = StringIO()
+        client = KubeClient(server=f"http://127.0.0.1:{server.server_port}")
+        assert Monitor(client, ["sweep"], "test", out=out, max_streams=1).run(timeout=10) == {"sweep": DONE}
+    finally:
+        server.shutdown()
+
+    lines = out.getvalue().splitlines()
+    assert "sweep | job submitted -> running" in lines and "sweep | job running -> done" in lines
+    assert "sweep[1] | pod sweep-1 created -> Running" in lines
+    assert all(f"sweep[{i}] | line {j}" in lines for i in range(3) for j in range(2))
+    assert not any(line.startswith("other") for line in lines), "filtered by the job label"
+    assert streams["most"] == 1
+    assert sorted(path for path, _ in streams["watches"]) == ["/api/v1/namespaces/test/pods",
+                                                              "/apis/batch/v1/namespaces/test/jobs"]
+
+
+def test_logs_resume_after_a_read_timeout():
+    """an idle log stream reconnects from the second of its last line, and skips the lines it already printed."""
+    since = []
+
+    class Handler(BaseHTTPRequestHandler):
+        # the api server sends the logs it follows in chunks.
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *_):
+            pass
+
+        def send(self, data):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            since.append(query.get("sinceTime"))
+            self.send(b"2026-01-01T00:00:01.25Z line 0\n2026-01-01T00:00:01.5Z line 1\n")
+            if len(since) == 1:
+                time.sleep(2)
+            else:
+                self.send(b"2026-01-01T00:00:01.75Z line 2\n")
+                self.send(b"")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        out = StringIO()
+        monitor = Monitor(KubeClient(server=f"http://127.0.0.1:{server.server_port}"), [], "test", out=out,
+                          read_timeout=0.5)
+        monitor._follow("sweep-0", "sweep[0]", "sweep")
+        while not monitor.queue.empty():
+            kind, prefix, line = monitor.queue.get()
+            if kind == "log":
+                monitor.write(prefix, line)
+    finally:
+        server.shutdown()
+    assert since == [None, ["2026-01-01T00:00:01Z"]]
+    assert out.getvalue().splitlines() == ["sweep[0] | line 0", "sweep[0] | line 1", "sweep[0] | line 2"]
+
+
+def test_monitor_threads_end():
+    """a monitor that times out closes its streams, and its threads do not block on the full queue."""
+    job = {"metadata": {"name": "sweep", "resourceVersion": "1", "labels": {JOB_LABEL: "sweep"}}}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *_):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.end_headers()
+            try:
+                if self.path.split("?")[0].endswith("/log"):
+                    self.wfile.write(b"line\n" * 100)
+                elif "/jobs" in self.path:
+                    self.wfile.write(json.dumps(dict(type="ADDED", object=job)).encode() + b"\n")
+                else:
+                    self.wfile.write(json.dumps(dict(type="ADDED", object=pod("sweep-0", "sweep", 0, "Running")))
+                                     .encode() + b"\n")
+                self.wfile.flush()
+                time.sleep(10)
+            except OSError:
+                pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = KubeClient(server=f"http://127.0.0.1:{server.server_port}")
+        monitor = Monitor(client, ["sweep"], "test", out=StringIO(), buffer=2)
+        assert monitor.run(timeout=1) == {"sweep": "running"}
+        for _ in range(50):
+            if not any(t.name == "jaynes-monitor" for t in threading.enumerate()):
+                break
+            time.sleep(0.1)
+        assert not any(t.name == "jaynes-monitor" for t in threading.enumerate())
+        assert monitor.responses == {}
+    finally:
+        server.shutdown()
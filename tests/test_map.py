@@ -0,0 +1,44 @@
+from jaynes.jaynes import RUN, Jaynes
+from jaynes.launchers.base_launcher import Launcher
+from jaynes.param_codec import deserialize
+from jaynes.runners import Simple
+from jaynes.stores import Local, fetch
+
+
+class RecordingLauncher(Launcher):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.planned = []
+        self.executed = 0
+
+    def plan_instance(self, verbose=False):
+        self.planned.extend(self.runners)
+        self.runners.clear()
+
+    def execute(self, verbose=None):
+        self.plan_instance()
+        self.executed += 1
+        return len(self.planned)
+
+
+def test_map_ships_the_function_once(tmp_path, monkeypatch):
+    store = Local(str(tmp_path / "thunks"))
+    launcher = RecordingLauncher()
+    monkeypatch.setattr(RUN, "config_root", str(tmp_path))
+    monkeypatch.setattr(Jaynes, "mode", None)
+    monkeypatch.setattr(Jaynes, "launcher", launcher)
+    monkeypatch.setattr(Jaynes, "runner_config", (Simple, {"work_dir": str(tmp_path)}))
+    monkeypatch.setattr(Jaynes, "mounts", [])
+    monkeypatch.setattr(Jaynes, "thunk_store", store)
+
+    def train(seed, lr=0.1):
+        return seed, lr
+
+    assert Jaynes.map(train, [dict(seed=s) for s in range(3)], lr=0.3) == 3
+    assert launcher.executed == 1, "all jobs go out in one execute"
+    # one blob for the function, and one for the arguments of each job.
+    assert len(list((tmp_path / "thunks").iterdir())) == 4
+
+    payloads = [r.main_script.split("JAYNES_PARAMS_KEY=")[-1].split()[0] for r in launcher.planned]
+    results = [(lambda fn, a, k: fn(*a, **k))(*deserialize(fetch(p).decode("ascii"))) for p in payloads]
+    assert results == [(0, 0.3), (1, 0.3), (2, 0.3)]
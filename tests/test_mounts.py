@@ -0,0 +1,121 @@
+import os
+import time
+
+import jaynes.mounts
+from jaynes.manifest import fingerprint, tar_excludes
+from jaynes.mounts import prune_tar_cache
+
+
+def test_tar_excludes(tmp_path):
+    ignore = tmp_path / ".gitignore"
+    ignore.write_text("# comment\n*.pkl\n\nwandb\n")
+
+    patterns = tar_excludes(f"--exclude='*__pycache__' --exclude '*.idea' --exclude-from='{ignore}'")
+    assert patterns == ["*__pycache__", "*.idea", "*.pkl", "wandb"]
+    assert ".git" in tar_excludes("--exclude-vcs")
+
+
+def test_fingerprint_respects_excludes(tmp_path):
+    (tmp_path / "a.py").write_text("a")
+    digest = fingerprint(str(tmp_path), excludes=["*.pkl"])
+
+    (tmp_path / "model.pkl").write_text("weights")
+    assert fingerprint(str(tmp_path), excludes=["*.pkl"]) == digest, "excluded files do not change the fingerprint"
+
+    (tmp_path / "b.py").write_text("b")
+    assert fingerprint(str(tmp_path), excludes=["*.pkl"]) != digest
+
+
+def test_prune_tar_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("JAYNES_CACHE_DIR", str(tmp_path))
+    cache_dir = tmp_path / "tarballs"
+    cache_dir.mkdir()
+    for i, name in enumerate(["old.tar", "mid.tar", "new.tar"]):
+        (cache_dir / name).write_bytes(b"0" * 10)
+        os.utime(cache_dir / name, (i, i))
+
+    prune_tar_cache(max_bytes=25)
+    assert sorted(os.listdir(cache_dir)) == ["mid.tar", "new.tar"], "the least recently used tar ball is removed"
+
+    # the tar balls used since the launch started are kept, even over the limit.
+    os.utime(cache_dir / "mid.tar", (100, 100))
+    prune_tar_cache(max_bytes=5, since=50)
+    assert sorted(os.listdir(cache_dir)) == ["mid.tar"]
+
+
+def test_prune_after_the_uploads(tmp_path, monkeypatch):
+    """a tar ball another upload of the launch just packed is not pruned from under it."""
+    from jaynes.jaynes import Jaynes
+
+    monkeypatch.setenv("JAYNES_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(jaynes.mounts, "TAR_CACHE_SIZE", 0)
+    monkeypatch.setattr(Jaynes, "_uploaded", set())
+    (tmp_path / "tarballs").mkdir()
+    (tmp_path / "tarballs" / "old.tar").write_bytes(b"0" * 10)
+    os.utime(tmp_path / "tarballs" / "old.tar", (0, 0))
+
+    class Mount:
+        def __init__(self, name):
+            self.name = name
+
+        def upload(self, **_):
+            path = tmp_path / "tarballs" / self.name
+            path.write_bytes(b"0" * 10)
+            time.sleep(0.1)
+            assert path.exists()
+
+    Jaynes.upload_mount([Mount("a.tar"), Mount("b.tar")])
+    assert sorted(os.listdir(tmp_path / "tarballs")) == ["a.tar", "b.tar"]
+
+
+def test_code_mounts_resolve_against_the_config_root(tmp_path, monkeypatch):
+    """the tar ball of a relative local_path is keyed on the tree under the config root, not under the cwd."""
+    from jaynes.jaynes import RUN
+    from jaynes.mounts import GSCode, S3Code, SSHCode, TarMount
+
+    monkeypatch.setenv("JAYNES_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(RUN, "config_root", str(tmp_path))
+    (tmp_path / "code").mkdir()
+    (tmp_path / "code" / "main.py").write_text("print(1)")
+    monkeypatch.chdir(tmp_path / "code")
+
+    mounts = [S3Code(local_path="code", prefix="s3://bucket/code", packer="tar"),
+              GSCode(local_path="code", prefix="gs://bucket/code", packer="tar"),
+              SSHCode(local_path="code", host_path="/tmp/code", packer="tar"),
+              TarMount(local_path="code", host_path="/tmp/code", packer="tar")]
+    digest = mounts[0].digest
+    assert digest and all(m.digest == digest for m in mounts)
+    assert all(m.local_tar == str(tmp_path / "cache" / "tarballs" / f"{digest}.tar") for m in mounts)
+
+
+def test_s3_output_scripts(tmp_path):
+    """with inotify, the host syncs on writes, but at most once every interval seconds."""
+    import signal
+    import subprocess
+    from textwrap import dedent
+
+    from jaynes.mounts import S3Output
+
+    host_path = tmp_path / "outputs"
+    mount = S3Output(container_path="/outputs", prefix="s3://bucket/run/", host_path=str(host_path), interval=30)
+    assert "aws s3 sync {} s3://bucket/run/ --only-show-errors".format(host_path) in " ".join(mount.upload_script.split())
+    assert mount.docker_mount == f"-v {host_path}:/outputs"
+
+    # files are always written, the clock stands still, and the instance is not marked for termination.
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    log = tmp_path / "log"
+    for command, body in [("inotifywait", "true"), ("date", "echo 1000"), ("curl", "echo 'HTTP/1.1 404'"),
+                          ("sleep", 'echo "sleep $1" >> $LOG; exec /bin/sleep 0.01'), ("aws", 'echo "aws $*" >> $LOG')]:
+        (bin_dir / command).write_text(f"#!/bin/sh\n{body}\n")
+        (bin_dir / command).chmod(0o755)
+    env = dict(os.environ, PATH=f"{bin_dir}:{os.environ['PATH']}", LOG=str(log))
+    p = subprocess.Popen(["bash", "-c", dedent(mount.host_setup)], env=env, stdout=subprocess.DEVNULL,
+                         start_new_session=True)
+    time.sleep(1)
+    os.killpg(p.pid, signal.SIGKILL)
+    p.wait()
+
+    calls = [c for c in log.read_text().splitlines() if c != "sleep 3"]
+    assert host_path.is_dir() and calls[:4] == ["sleep 1", f"aws s3 sync {host_path} s3://bucket/run/ --only-show-errors",
+                                                "sleep 30", f"aws s3 sync {host_path} s3://bucket/run/ --only-show-errors"]
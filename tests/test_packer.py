@@ -0,0 +1,95 @@
+import io
+import os
+import tarfile
+import threading
+
+import pytest
+
+from jaynes.mounts import Mount, make_packer
+from jaynes.packer import Packer, ParallelGzipWriter
+
+
+def make_tree(root):
+    (root / "pkg" / "__pycache__").mkdir(parents=True)
+    (root / "pkg" / "__init__.py").write_text("x = 1\n")
+    (root / "pkg" / "__pycache__" / "x.pyc").write_bytes(b"\0")
+    (root / "data.bin").write_bytes(bytes(range(256)) * 5000)
+
+
+def test_parallel_gzip_is_valid_gzip():
+    import gzip
+
+    sink = io.BytesIO()
+    writer = ParallelGzipWriter(sink, block_size=1000, workers=3)
+    payload = b"jaynes " * 10000
+    writer.write(payload)
+    writer.close()
+    assert gzip.decompress(sink.getvalue()) == payload
+
+
+def test_packer_follows_excludes(tmp_path, capsys):
+    make_tree(tmp_path)
+    sink = io.BytesIO()
+    Packer(str(tmp_path), excludes=["*__pycache__"], workers=2).pack(sink)
+    assert capsys.readouterr().out == "", "the throughput is only reported with verbose"
+
+    with tarfile.open(fileobj=io.BytesIO(sink.getvalue()), mode="r:gz") as tar:
+        names = tar.getnames()
+        assert tar.extractfile("./pkg/__init__.py").read() == b"x = 1\n"
+    assert names == [".", "./data.bin", "./pkg", "./pkg/__init__.py"]
+
+
+def test_failed_pack_stops_the_compression_threads(tmp_path, monkeypatch):
+    make_tree(tmp_path)
+
+    added = []
+    original = tarfile.TarFile.add
+
+    def add(tar, name, *args, **kwargs):
+        # fails after data.bin, which fills a block for the compression threads.
+        if added == [".", "data.bin"]:
+            raise PermissionError(name)
+        added.append(os.path.basename(name) or ".")
+        return original(tar, name, *args, **kwargs)
+
+    monkeypatch.setattr(tarfile.TarFile, "add", add)
+    before = threading.active_count()
+    with pytest.raises(PermissionError):
+        Packer(str(tmp_path), workers=2).pack(io.BytesIO())
+    assert threading.active_count() == before
+
+
+def test_auto_packer_leaves_wildcards_to_tar(tmp_path):
+    assert isinstance(make_packer("auto", str(tmp_path), ".", [], "", {}, True), Packer)
+    assert make_packer("auto", str(tmp_path), "*.py", [], "", {}, True) is None, "the shell expands the mask for tar"
+    assert make_packer("auto", str(tmp_path), ".", [], "", {"owner": "root"}, True) is None
+
+
+def test_stream_upload(tmp_path):
+    make_tree(tmp_path)
+    target = tmp_path / "uploaded.tar"
+
+    mount = Mount()
+    mount.digest = "test"
+    mount.packer = Packer(str(tmp_path / "pkg"), compress=False)
+    mount.exists_script = f"test -f {target}"
+    mount.stream_script = f"cat > {target}"
+    mount.upload()
+
+    with tarfile.open(target) as tar:
+        assert "./__init__.py" in tar.getnames()
+
+
+def test_chunks_stop_with_the_consumer(tmp_path):
+    import time
+
+    make_tree(tmp_path)
+    chunks = Packer(str(tmp_path), workers=2).chunks(max_chunks=1)
+    next(chunks)
+    # e.g. the upload failed after the first chunk.
+    chunks.close()
+    for _ in range(50):
+        if not any(t.name == "jaynes-packer" for t in threading.enumerate()):
+            break
+        time.sleep(0.1)
+    assert not any(t.name == "jaynes-packer" for t in threading.enumerate())
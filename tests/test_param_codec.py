@@ -1,4 +1,22 @@
-from jaynes.param_codec import serialize, deserialize
+import base64
+import mmap
+import pickle
+
+import cloudpickle
+import pytest
+
+from jaynes.param_codec import PayloadTooLarge, check_size, describe, serialize, deserialize, serialize_thunk
+from jaynes.stores import Local
+
+
+class Blob:
+    """a stand-in for a numpy array, which pickles its data out-of-band with protocol 5."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        return Blob, (pickle.PickleBuffer(self.data) if protocol >= 5 else bytes(self.data),)
 
 
 def test():
@@ -22,6 +40,69 @@ def test_empty():
     assert 1 == thunk(*args, **kwargs), "result should be 1"
     print('test empty input succeeded!')
 
+
+def test_shared_thunk(tmp_path):
+    def fn(a, b=0):
+        return a * 10 + b
+
+    thunk = serialize_thunk(fn)
+    ref = Local(str(tmp_path)).put(thunk)
+
+    for shared in [thunk, ref]:
+        thunk_fn, args, kwargs = deserialize(serialize(shared, [1], {"b": 2}))
+        assert thunk_fn(*args, **kwargs) == 12
+
+
+def test_compressed_payload():
+    code = serialize(len, ["a" * 100_000])
+    assert code.startswith("JYN2") and "," not in code and "://" not in code
+    assert len(code) < 1000, "repetitive payloads compress"
+    assert deserialize(code)[1] == ["a" * 100_000]
+    assert serialize(len, compression=None).startswith("JYN2n.")
+
+    legacy = base64.b64encode(cloudpickle.dumps(dict(thunk=len, args=[[1]], kwargs=None))).decode()
+    assert deserialize(legacy)[0]([1]) == 1
+
+
+def test_codec_errors():
+    assert serialize(len, ["a" * 1000]).startswith("JYN2z."), "zlib by default, the workers may not have zstd"
+    with pytest.raises(ValueError, match="version 9 is not supported"):
+        deserialize("JYN9z." + serialize(len)[6:])
+    with pytest.raises(ValueError, match="unknown compression"):
+        serialize(len, compression="lz4")
+
+
+def test_out_of_band_buffers():
+    blob = Blob(bytearray(b"weights" * 1000))
+    code = serialize(len, [blob], compression=None)
+    stats = describe(code)
+    assert stats["buffers"] == 7000 and stats["pickled"] < 1000
+    data = deserialize(code)[1][0].data
+    assert bytes(data) == b"weights" * 1000 and not data.readonly
+
+
+def test_buffers_in_the_store(tmp_path):
+    weights = bytearray(b"w" * (2 << 20))
+    code = serialize(len, [Blob(weights), Blob(bytearray(b"small"))], store=Local(str(tmp_path)))
+    assert len(code) < 1000, "the large buffer is not inlined"
+    assert describe(code)["stored"] == 1 and describe(code)["buffers"] == 5
+
+    large, small = deserialize(code)[1]
+    assert isinstance(large.data.obj, mmap.mmap), "memory-mapped from the blob"
+    large.data[0] = ord("x")
+    (blob,) = [p for p in tmp_path.iterdir() if p.stat().st_size == len(weights)]
+    assert blob.read_bytes()[:1] == b"w", "copy-on-write, the blob is not modified"
+    assert bytes(small.data) == b"small"
+
+
+def test_size_limits():
+    with pytest.raises(PayloadTooLarge, match="the ec2 payload is 20000 bytes, over the limit of 16384 bytes"):
+        check_size("x" * 20000, "ec2", [serialize(len)])
+    with pytest.warns(UserWarning, match="close to"):
+        check_size("x" * 15000, "ec2")
+    assert check_size("x" * 100, "ec2") == 100
+
+
 if __name__ == "__main__":
     test()
     test_empty()
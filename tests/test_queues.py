@@ -0,0 +1,77 @@
+import os
+import subprocess
+import sys
+import time
+
+from jaynes.param_codec import serialize
+from jaynes.queues import FileQueue, open_queue
+
+
+def append(path, line):
+    with open(path, "a") as f:
+        f.write(line + "\n")
+
+
+def fail():
+    raise KeyError("missing")
+
+
+def test_file_queue_claims_once(tmp_path):
+    tasks = FileQueue(str(tmp_path), poll=0.01)
+    first, second = tasks.put("a", "b")
+    assert tasks.get(timeout=0) == (first, "a"), "first in, first out"
+    assert tasks.get(timeout=0) == (second, "b")
+    assert tasks.get(timeout=0) is None
+
+    tasks.done(first, {"error": None})
+    assert tasks.result(first) == {"error": None}
+    assert tasks.result(second) is None
+
+
+def test_leases(tmp_path):
+    tasks = FileQueue(str(tmp_path), poll=0.01, lease=0.3)
+    first, = tasks.put("a")
+    assert tasks.get(timeout=0) == (first, "a")
+    time.sleep(0.6)
+    assert tasks.get(timeout=0) is None, "the worker renews the lease while it runs the task"
+    tasks.done(first, {"error": None})
+    assert sorted(os.listdir(tmp_path)) == [f"{first}.result"]
+
+
+def test_task_of_a_killed_worker_is_picked_up_again(tmp_path):
+    tasks = open_queue(str(tmp_path), "killed")
+    task_id, = tasks.put(serialize(time.sleep, [60]))
+
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(__file__))
+    worker = subprocess.Popen([sys.executable, "-m", "jaynes.entry", "--worker", str(tmp_path), "--queue", "killed"],
+                              env=env, stderr=subprocess.DEVNULL)
+    claimed = tmp_path / "killed" / f"{task_id}.running"
+    try:
+        for _ in range(300):
+            if claimed.exists():
+                break
+            time.sleep(0.1)
+        assert claimed.exists(), "the worker claims the task"
+    finally:
+        worker.kill()
+        worker.wait()
+
+    tasks = FileQueue(str(tmp_path / "killed"), poll=0.05, lease=0.5)
+    assert tasks.get(timeout=0) is None, "the lease is still valid"
+    assert tasks.get(timeout=5) == (task_id, serialize(time.sleep, [60])), "the lease expired"
+
+
+def test_warm_worker(tmp_path):
+    log = str(tmp_path / "log.txt")
+    tasks = open_queue(str(tmp_path), "eval")
+    ok_1, failed, ok_2 = tasks.put(serialize(append, [log, "one"]), serialize(fail), serialize(append, [log, "two"]))
+
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(__file__))
+    subprocess.run([sys.executable, "-m", "jaynes.entry", "--worker", str(tmp_path), "--queue", "eval",
+                    "--idle-timeout", "1"], env=env, check=True, timeout=30)
+
+    with open(log) as f:
+        assert f.read() == "one\ntwo\n", "one worker runs all the thunks, in order"
+    assert tasks.result(ok_1)["error"] is None
+    assert tasks.result(failed)["error"] == "KeyError('missing')"
+    assert tasks.result(ok_2)["error"] is None
@@ -0,0 +1,55 @@
+import os
+import re
+import subprocess
+
+import pytest
+
+from jaynes.constants import JAYNES_PARAMS_KEY
+from jaynes.results import RemoteError
+from jaynes.runners import Simple
+
+
+def add(a, b):
+    return {"sum": a + b}
+
+
+def fail():
+    raise ValueError("bad seed")
+
+
+def run_entry(script):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(__file__))
+    return subprocess.run(script, shell=True, env=env, capture_output=True, cwd=os.path.dirname(os.path.dirname(__file__)))
+
+
+def test_results_are_piped_back(tmp_path):
+    runner = Simple(work_dir=".", shell="sh")
+    runner.result_channel = str(tmp_path / "results")
+    runner.build(add, 1, b=2)
+    runner.chain(fail)
+    done, failed = runner.handles
+
+    assert not done.done()
+    with pytest.raises(TimeoutError):
+        done.result(timeout=0.1)
+
+    for main_script in re.findall(f"{JAYNES_PARAMS_KEY}=.*?jaynes.entry", runner.main_script):
+        run_entry(main_script)
+
+    assert done.result(timeout=5) == {"sum": 3}
+    with pytest.raises(RemoteError) as e:
+        failed.result(timeout=5)
+    assert "ValueError('bad seed')" in str(e.value)
+    assert "in fail" in e.value.traceback
+
+
+def test_batched_results(tmp_path):
+    runner = Simple(work_dir=".", batch=True, workers=2, shell="sh")
+    runner.result_channel = "file://" + str(tmp_path)
+    runner.build(add, 1, 2)
+    runner.pack(add, 3, 4)
+
+    runner.pack_table()
+    main_script = re.search(f"{JAYNES_PARAMS_KEY}=.*", runner.main_script).group(0)
+    assert run_entry(main_script).returncode == 0
+    assert [h.result(timeout=5) for h in runner.handles] == [{"sum": 3}, {"sum": 7}]
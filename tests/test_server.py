@@ -0,0 +1,173 @@
+import hashlib
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+
+from jaynes.client import JaynesClient
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    """a jaynes server on a free port, working in a temporary directory."""
+    work_dir = tmp_path_factory.mktemp("server")
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__)), JAYNES_MAX_RESULTS="5")
+    proc = subprocess.Popen([sys.executable, "-m", "jaynes.server", "--host", "127.0.0.1", "--port", str(port)],
+                            cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(200):
+            try:
+                requests.get(url + "/uploads/ready")
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        yield url, work_dir
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def test_resumed_upload(server, tmp_path):
+    url, work_dir = server
+    client = JaynesClient(url)
+    blob = os.urandom(3000)
+    (tmp_path / "weights.bin").write_bytes(blob)
+
+    # the connection dropped after the first 1000 bytes.
+    assert client.put("/files/resume/weights.bin", data=blob[:1000], partial="true") == {"status": 1, "offset": 1000}
+    assert client.get("/uploads/resume/weights.bin") == {"offset": 1000, "exists": False}
+
+    assert client.upload_file(str(tmp_path / "weights.bin"), "resume/weights.bin", resume=True)["offset"] == 3000
+    assert (work_dir / "resume" / "weights.bin").read_bytes() == blob
+    assert client.get("/uploads/resume/weights.bin") == {"offset": 0, "exists": True}
+
+
+def test_upload_errors(server):
+    url, work_dir = server
+    session = JaynesClient(url).session
+
+    r = session.put(url + "/files/errors/offset.bin?offset=5", data=b"abc")
+    assert r.status_code == 409 and r.json()["offset"] == 0, "the offset to resume from"
+
+    r = session.put(url + "/files/errors/digest.bin?sha256=" + hashlib.sha256(b"abd").hexdigest(), data=b"abc")
+    assert r.status_code == 422 and "sha256 mismatch" in r.json()["error"]
+    assert os.listdir(work_dir / "errors") == [], "neither the file, nor the part is kept"
+
+    # the connection dropped, the part is kept for the upload to resume.
+    digest = hashlib.sha256(b"abcdef").hexdigest()
+    r = session.put(url + f"/files/errors/short.bin?sha256={digest}&size=6", data=b"abc")
+    assert r.status_code == 409 and r.json()["offset"] == 3
+    r = session.put(url + f"/files/errors/short.bin?offset=3&sha256={digest}&size=6", data=b"def")
+    assert r.status_code == 200 and (work_dir / "errors" / "short.bin").read_bytes() == b"abcdef"
+
+    r = session.put(url + "/files/errors/digest.bin?sha256=" + hashlib.sha256(b"abc").hexdigest(), data=b"abc")
+    assert r.status_code == 200 and (work_dir / "errors" / "digest.bin").read_bytes() == b"abc"
+
+
+def test_async_client(server, tmp_path):
+    import asyncio
+
+    from jaynes.client import AsyncJaynesClient, broadcast
+
+    url, work_dir = server
+    blob = os.urandom(2000)
+    (tmp_path / "async.bin").write_bytes(blob)
+
+    async def main():
+        async with AsyncJaynesClient(url, pool_size=2) as client:
+            await client.put("/files/async/resumed.bin", data=blob[:500], partial="true")
+            uploaded = await client.upload_file(str(tmp_path / "async.bin"), "async/resumed.bin", resume=True)
+            results = await asyncio.gather(*[client.execute(f"echo {i}") for i in range(4)])
+            assert client.session.connector.limit == 2
+        return uploaded, results
+
+    uploaded, results = asyncio.run(main())
+    assert uploaded == {"status": 1, "offset": 2000} and (work_dir / "async" / "resumed.bin").read_bytes() == blob
+    assert results == [[f"{i}\n", "", 0] for i in range(4)]
+
+    async def fan_out():
+        clients = [AsyncJaynesClient(url), AsyncJaynesClient("http://127.0.0.1:1")]
+        try:
+            return await broadcast(clients, "execute", "echo hi")
+        finally:
+            await asyncio.gather(*[c.close() for c in clients])
+
+    ok, unreachable = asyncio.run(fan_out())
+    assert ok == ["hi\n", "", 0] and isinstance(unreachable, OSError), "failures are returned in place"
+
+
+def test_pooled_session():
+    """one session per server, which retries the 503s of GETs, but not of exec calls."""
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *_):
+            pass
+
+        def reply(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            requests_seen.append(self.command)
+            status = 503 if len(requests_seen) == 1 or self.command == "POST" else 200
+            self.send_response(status)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        do_GET = do_POST = reply
+
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{stub.server_port}"
+        client = JaynesClient(url)
+        assert JaynesClient(url).session is client.session
+        assert client.session.get_adapter(url)._pool_maxsize == 10
+
+        assert client.get("/uploads/x") == {} and requests_seen == ["GET", "GET"], "retried"
+        client.post_json("/exec", dict(cmd="ls"))
+        assert requests_seen[2:] == ["POST"], "a 503 of an exec call is not retried"
+    finally:
+        stub.shutdown()
+
+
+def test_queue_leases(server):
+    """a task goes back into the queue when its lease expires without a result, and fails after 3 leases."""
+    url, _ = server
+    client = JaynesClient(url)
+    first, second = client.enqueue("leases", "thunk-1", "thunk-2")
+
+    assert client.dequeue("leases", timeout=1, lease=0.2) == (first, "thunk-1")
+    time.sleep(0.3)
+    # the worker of the first died, the task is back behind the second.
+    assert client.dequeue("leases", timeout=1) == (second, "thunk-2")
+    client.post_result(second, {"error": None, "seconds": 1})
+    assert client.dequeue("leases", timeout=1, lease=0.2) == (first, "thunk-1")
+
+    assert client.get_result(second) == {"error": None, "seconds": 1}
+    assert client.get_result(second) is None, "results are handed out once"
+
+    time.sleep(0.3)
+    assert client.dequeue("leases", timeout=1, lease=0.2) == (first, "thunk-1")
+    time.sleep(0.3)
+    assert client.dequeue("leases", timeout=0.1) is None
+    assert client.get_result(first, timeout=1) == {"error": "the lease of the task expired 3 times", "seconds": 0}
+
+
+def test_results_are_bounded(server):
+    url, _ = server
+    client = JaynesClient(url)
+    for i in range(7):
+        client.post_result(f"bounded-{i}", {"value": i})
+    assert client.get_result("bounded-0") is None and client.get_result("bounded-1") is None, "the oldest are dropped"
+    assert [client.get_result(f"bounded-{i}")["value"] for i in range(2, 7)] == [2, 3, 4, 5, 6]
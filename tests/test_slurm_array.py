@@ -0,0 +1,60 @@
+import os
+import re
+import subprocess
+import sys
+
+from jaynes.constants import JAYNES_INDEX_VAR_KEY, JAYNES_PARAMS_KEY
+from jaynes.runners import Slurm
+
+
+def square(x):
+    print(x * x)
+
+
+def test_job_array_packs_thunks():
+    runner = Slurm(work_dir="/tmp", interactive=False, array=True, array_limit=2)
+    runner.build(square, 1)
+    runner.pack(square, 2)
+    runner.pack(square, 3)
+
+    script = runner.pack_table().run_script
+    assert script.count("sbatch") == 1, "one submission for the whole array"
+    assert "--array=0-2%2 --parsable" in script
+    assert f"{JAYNES_INDEX_VAR_KEY}=SLURM_ARRAY_TASK_ID" in script
+    assert Slurm.job_ids("Submitted\njaynes-array-job-id: 4242\n") == ["4242"]
+
+    table = re.search(f"{JAYNES_PARAMS_KEY}=(\\S+)", script).group(1)
+    env = dict(os.environ, **{JAYNES_PARAMS_KEY: table, JAYNES_INDEX_VAR_KEY: "SLURM_ARRAY_TASK_ID",
+                              "SLURM_ARRAY_TASK_ID": "2", "PYTHONPATH": os.path.dirname(__file__)})
+    out = subprocess.check_output([sys.executable, "-m", "jaynes.entry"], env=env)
+    assert out == b"9\n"
+
+
+def test_without_array_nothing_is_packed():
+    runner = Slurm(work_dir="/tmp", interactive=False)
+    assert runner.pack is None
+    runner.build(square, 1)
+    assert "--array" not in runner.run_script
+
+
+def test_ssh_launch_returns_the_array_job_id(tmp_path, monkeypatch):
+    """the SSH launcher reads the array job id from the output of sbatch on the login node."""
+    from jaynes.launchers.ssh_launch import SSH
+
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    # ssh runs the piped launch script here, where sbatch queues the array.
+    for command, body in [("ssh", "exec bash -s"), ("sbatch", 'cat > /dev/null; echo "$*" >> $LOG; echo 4242')]:
+        (bin_dir / command).write_text(f"#!/bin/bash\n{body}\n")
+        (bin_dir / command).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("LOG", str(tmp_path / "log"))
+
+    runner = Slurm(mounts=[], work_dir="/tmp", interactive=False, array=True)
+    runner.build(square, 1)
+    runner.pack(square, 2)
+    launcher = SSH(type="ssh", ip="login-node", username="me", launch_dir=str(tmp_path / "launch"))
+    launcher.add_runner(runner)
+
+    assert launcher.execute() == ["4242"]
+    assert "--array=0-1 --parsable" in (tmp_path / "log").read_text()
@@ -0,0 +1,40 @@
+import os
+import re
+import subprocess
+import sys
+
+from jaynes.constants import JAYNES_PARAMS_KEY
+from jaynes.param_codec import serialize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = {"yaml", "termcolor", "requests", "boto3", "googleapiclient", "jaynes.launchers", "jaynes.mounts"}
+
+
+def imported(*args, env=None):
+    """:return: the modules that python -X importtime imports for the command."""
+    env = dict(os.environ, PYTHONPATH=ROOT, **(env or {}))
+    stderr = subprocess.run([sys.executable, "-X", "importtime", *args], env=env, check=True,
+                            capture_output=True).stderr.decode()
+    return set(re.findall(r"^import time:.*\|\s*(\S+)$", stderr, re.MULTILINE))
+
+
+def test_import_budget():
+    modules = imported("-c", "import jaynes")
+    assert {m for m in modules if m.startswith("jaynes")} == {"jaynes"}
+    assert not modules & HEAVY
+
+
+def test_entry_imports_param_codec_only():
+    modules = imported("-m", "jaynes.entry", env={JAYNES_PARAMS_KEY: serialize(print, ("hello",))})
+    assert {m for m in modules if m.startswith("jaynes")} == {"jaynes", "jaynes.param_codec", "jaynes.constants"}
+    assert not modules & HEAVY
+
+
+def test_lazy_attributes():
+    import jaynes
+    import jaynes.launchers
+
+    assert jaynes.launchers.ec2 is jaynes.launchers.EC2
+    assert jaynes.Jaynes.config.__func__ is jaynes.config.__func__
+    assert jaynes.map.__func__ is jaynes.Jaynes.map.__func__
+    assert "map" not in vars(jaynes.jaynes), "does not shadow the builtin map"
@@ -0,0 +1,36 @@
+import pytest
+
+from jaynes.constants import JAYNES_PARAMS_KEY
+from jaynes.param_codec import serialize
+from jaynes.shell import run
+from jaynes.stores import Local, digest, download_command, fetch, is_ref
+
+
+def test_local_store(tmp_path):
+    store = Local(str(tmp_path))
+    blob = serialize(print, ["hey"]).encode("ascii")
+
+    ref = store.put(blob)
+    assert is_ref(ref), "the store returns a reference"
+    assert ref == f"file://{tmp_path}/{digest(blob)}"
+    assert store.put(blob) == ref, "the same payload maps to the same reference"
+    assert fetch(ref) == blob
+
+
+def test_entry_with_ref(tmp_path):
+    def fn(b):
+        print(b + 5)
+
+    store = Local(str(tmp_path))
+    ref = store.put(serialize(fn, [10]).encode("ascii"))
+
+    cmd = f"{JAYNES_PARAMS_KEY}={ref} python -m jaynes.entry"
+    stdout, err = run(cmd, verbose=True, shell=True)
+    assert stdout == b"15\n"
+
+
+def test_download_command():
+    assert download_command("gs://bucket/thunks/abc", "/tmp/abc") == "gsutil -q cp gs://bucket/thunks/abc /tmp/abc"
+    assert download_command("$1", "$2", scheme="s3") == "aws s3 cp --only-show-errors $1 $2"
+    with pytest.raises(ValueError, match="ftp:// is not supported"):
+        download_command("ftp://host/abc", "/tmp/abc")
@@ -0,0 +1,27 @@
+from jaynes.launchers.base_launcher import compile_launch_script, make_launch_script
+from jaynes.runners import Simple
+from jaynes.templates import Template
+
+
+def test_template_matches_format():
+    source = "cd {{dir}}; {JYNS_main_script} & wait '{JYNS_array}'"
+    values = dict(JYNS_main_script="echo {x}", JYNS_array="0-3%2")
+    assert Template(source)(**values) == source.format(**values)
+    assert Template.from_markers("${A} \0JYNS_run\0 }")(JYNS_run="x") == "${A} x }"
+
+    source = "{x:>4}|{x!r}|{n:03d}|{n:{width}}|{p[0]}"
+    values = dict(x="ab", n=7, width=3, p=["a"])
+    assert Template(source)(**values) == source.format(**values) == "  ab|'ab'|007|  7|a"
+
+
+def test_sweeps_share_the_launch_template():
+    compile_launch_script.cache_clear()
+    scripts = []
+    for seed in range(3):
+        runner = Simple(work_dir="/w", shell="sh")
+        runner.build(print, seed)
+        scripts.append(make_launch_script(runners=[runner], mounts=[], unpack_on_host=True, type="ec2",
+                                          terminate_after=True, instance_name=f"job-{seed}"))
+    assert compile_launch_script.cache_info().misses == 1
+    assert "Key=Name,Value=job-2" in scripts[2] and runner.main_script in scripts[2]
+    assert scripts[0].startswith("#!/bin/bash") and "terminate-instances" in scripts[0]
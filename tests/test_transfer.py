@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from jaynes import transfer  # noqa: E402
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        transfer.s3_client.cache_clear()
+        boto3.client("s3").create_bucket(Bucket="jaynes-test")
+        yield "s3://jaynes-test"
+    transfer.s3_client.cache_clear()
+
+
+def test_multipart_round_trip(bucket, tmp_path):
+    src = tmp_path / "code.tar"
+    src.write_bytes(os.urandom(12 << 20))
+
+    assert not transfer.exists(f"{bucket}/code.tar")
+    # 5 MB is the smallest part S3 accepts.
+    transfer.upload(str(src), f"{bucket}/code.tar", part_size=5 << 20, concurrency=3)
+    assert transfer.exists(f"{bucket}/code.tar")
+
+    transfer.download(f"{bucket}/code.tar", str(tmp_path / "copy.tar"), part_size=5 << 20, concurrency=3)
+    assert (tmp_path / "copy.tar").read_bytes() == src.read_bytes()
+
+
+def test_upload_stream_and_sync(bucket, tmp_path):
+    transfer.upload_stream(lambda sink: sink.write(b"metrics"), f"{bucket}/logs/metrics.pkl")
+    transfer.upload_stream(lambda sink: sink.write(b"x" * 10), f"{bucket}/logs/run/out.txt")
+
+    assert sorted(transfer.sync(f"{bucket}/logs", str(tmp_path))) == ["metrics.pkl", "run/out.txt"]
+    assert (tmp_path / "metrics.pkl").read_bytes() == b"metrics"
+    assert transfer.sync(f"{bucket}/logs", str(tmp_path)) == [], "unchanged objects are skipped"
+
+
+def test_failed_stream_leaves_no_object(bucket):
+    def write(sink):
+        sink.write(b"partial")
+        raise IOError("packing failed")
+
+    with pytest.raises(IOError):
+        transfer.upload_stream(write, f"{bucket}/code.tar")
+    assert not transfer.exists(f"{bucket}/code.tar")
+
+
+def test_poll_s3_channel(bucket):
+    from jaynes.results import poll
+
+    channel = f"{bucket}/results/run-1.json"
+    assert transfer.read(channel) is None and poll(channel) is None
+    transfer.upload_stream(lambda sink: sink.write(b'{"error": null, "value": 3}'), channel)
+    assert poll(channel) == {"error": None, "value": 3}
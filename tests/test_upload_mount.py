@@ -0,0 +1,62 @@
+import threading
+import time
+
+import pytest
+
+from jaynes.jaynes import Jaynes
+from jaynes.shell import check_call
+
+
+class FakeMount:
+    def __init__(self, delay=0.0, error=None, barrier=None):
+        self.delay = delay
+        self.error = error
+        self.barrier = barrier
+        self.calls = 0
+
+    def upload(self, verbose=None, **host):
+        self.calls += 1
+        if self.barrier:
+            # only passes when the other upload runs at the same time.
+            self.barrier.wait(timeout=5)
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+
+
+def test_uploads_run_concurrently_once(monkeypatch):
+    monkeypatch.setattr(Jaynes, "_uploaded", set())
+    barrier = threading.Barrier(2)
+    mounts = [FakeMount(barrier=barrier), FakeMount(barrier=barrier)]
+
+    Jaynes.upload_mount(mounts)
+    Jaynes.upload_mount(mounts)
+    assert [m.calls for m in mounts] == [1, 1]
+
+
+def test_upload_failures_are_aggregated(monkeypatch):
+    monkeypatch.setattr(Jaynes, "_uploaded", set())
+    barrier = threading.Barrier(2)
+    mounts = [FakeMount(error=ValueError("no credentials"), barrier=barrier),
+              FakeMount(error=OSError("disk full"), barrier=barrier)]
+
+    with pytest.raises(RuntimeError, match="(?s)no credentials.*disk full"):
+        Jaynes.upload_mount(mounts)
+    assert not Jaynes._uploaded, "failed uploads are retried on the next call"
+
+
+class CommandMount:
+    def upload(self, verbose=None, **host):
+        check_call("sleep 30; sleep 30", shell=True)
+
+
+def test_running_uploads_are_terminated(monkeypatch, capsys):
+    monkeypatch.setattr(Jaynes, "_uploaded", set())
+    mounts = [CommandMount(), FakeMount(delay=0.5, error=OSError("no route to host"))]
+
+    started = time.time()
+    with pytest.raises(RuntimeError, match="no route to host"):
+        Jaynes.upload_mount(mounts)
+    assert time.time() - started < 10, "the sleep is terminated"
+    assert "CommandMount upload is cancelled" in capsys.readouterr().out
+    assert not Jaynes._uploaded
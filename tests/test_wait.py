@@ -0,0 +1,92 @@
+import threading
+
+from jaynes.results import Handle, encode_value, new_channel, post
+from jaynes.wait import ALL_COMPLETED, DONE, FAILED, FIRST_COMPLETED, RUNNING, SlurmJobs, Watcher, wait
+
+
+class Countdown(Watcher):
+    """finishes job i after i polls."""
+
+    def __init__(self):
+        self.polls = 0
+
+    def poll(self, jobs):
+        self.polls += 1
+        return {j: DONE if j <= self.polls else RUNNING for j in jobs}
+
+
+def test_wait_returns_when():
+    done, pending = wait([1, 2, 3], Countdown(), return_when=FIRST_COMPLETED, initial=0.01)
+    assert done == {1: DONE} and pending == [2, 3]
+
+    watcher = Countdown()
+    done, pending = wait([1, 2, 3], watcher, return_when=ALL_COMPLETED, initial=0.01)
+    assert list(done) == [1, 2, 3] and not pending
+    assert watcher.polls == 3, "one bulk query per round, for all pending jobs"
+
+    done, pending = wait([100], Countdown(), timeout=0.2, initial=0.01, maximum=0.05)
+    assert not done and pending == [100]
+
+
+def test_slurm_array_states():
+    output = "\n".join(["101_0|COMPLETED", "101_1|COMPLETED", "102_0|COMPLETED", "102_[1-3]|PENDING",
+                        "103|CANCELLED by 1001", "104_0|FAILED", "104_1|COMPLETED"])
+    states = SlurmJobs.parse(output, ["101", "102", "103", "104", "105", "102_0"])
+    assert states == {"101": DONE, "102": RUNNING, "103": FAILED, "104": FAILED, "105": RUNNING, "102_0": DONE}
+
+
+def test_wait_on_handles(tmp_path):
+    ok, failed = Handle(new_channel(str(tmp_path))), Handle(new_channel(str(tmp_path)))
+    threading.Timer(0.1, post, [ok.channel, dict(value=encode_value(1), error=None)]).start()
+    threading.Timer(0.2, post, [failed.channel, dict(value=None, error="ValueError()")]).start()
+
+    done, pending = wait([ok, failed], initial=0.05, timeout=10)
+    assert done == {ok: DONE, failed: FAILED} and not pending
+
+
+def test_handles_long_poll_a_few_at_a_time():
+    """the long-polls of a round are bounded, and end with the round."""
+    import json
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    from jaynes.wait import Handles
+
+    results, polls = {}, dict(open=0, most=0)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *_):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            task_id, timeout = url.path.split("/")[-1], float(parse_qs(url.query)["timeout"][0])
+            with lock:
+                polls["open"] += 1
+                polls["most"] = max(polls["most"], polls["open"])
+            deadline = time.time() + timeout
+            while task_id not in results and time.time() < deadline:
+                time.sleep(0.01)
+            with lock:
+                polls["open"] -= 1
+            blob = json.dumps(dict(done=task_id in results, result=results.get(task_id))).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(blob)))
+            self.end_headers()
+            self.wfile.write(blob)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        handles = [Handle(f"http://127.0.0.1:{server.server_port}/results/{i}") for i in range(5)]
+        threading.Timer(0.2, results.update, [{"1": dict(value=encode_value(1), error=None)}]).start()
+        started = time.time()
+        states = Handles(max_polls=2, poll_timeout=0.5).watch(handles, timeout=10)
+        assert time.time() - started < 2 and states[handles[1]] == DONE
+        assert [states[h] for h in handles].count(RUNNING) == 4 and polls["most"] <= 2
+        time.sleep(1)
+        assert not any(t.name.startswith("jaynes-wait") for t in threading.enumerate()), "no poll outlives the round"
+    finally:
+        server.shutdown()